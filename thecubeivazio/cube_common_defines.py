@@ -78,6 +78,8 @@ CUBEMASTER_SQLITE_DATABASE_FILEPATH = os.path.join(SAVES_DIR, "cubemaster_teams_
 # TODO: implement in existing loops
 LOOP_PERIOD_SEC = 0.1
 STATUS_REPLY_TIMEOUT = 2
+# a status reply younger than this is reused instead of sending the same request again
+STATUS_REPLY_MAX_AGE = 0.5
 TIMESTAMP_EPSILON = 0.00001
 
 # defines how we calculate the time a team spent opening a cube
@@ -1,11 +1,16 @@
+import itertools
 import json
 import logging
-from typing import Tuple, Any
+from typing import Any, Dict, Tuple
 
 import thecubeivazio.cube_utils as cube_utils
 from thecubeivazio import cube_logger
 from thecubeivazio.cube_common_defines import *
 
+# every change of a config gives it the next number of this counter:
+# a version number identifies the content of a config among all the CubeConfig instances
+_version_counter = itertools.count(1)
+
 
 class CubeConfig:
     """Class to hold configuration values."""
@@ -42,6 +47,24 @@ class CubeConfig:
         self.use_encryption = config.use_encryption
         self.password = config.password
 
+    @property
+    def config_dict(self) -> Dict[str, Any]:
+        return self._config_dict
+
+    @config_dict.setter
+    def config_dict(self, value: Dict[str, Any]):
+        self._config_dict = value
+        self.bump_version()
+
+    def bump_version(self):
+        """Must be called after modifying the config_dict in place"""
+        self._version = next(_version_counter)
+
+    @property
+    def version(self) -> int:
+        """Changes every time the config changes, so that what is built from it can be cached until then"""
+        return self._version
+
 
     @staticmethod
     def get_config():
@@ -224,6 +247,7 @@ class CubeConfig:
     @cubetry
     def set_field(self, field_name: str, value) -> bool:
         self.config_dict[field_name] = value
+        self.bump_version()
         return True
 
     @cubetry
@@ -238,6 +262,7 @@ class CubeConfig:
     @cubetry
     def set_field(self, field_name: str, value) -> bool:
         self.config_dict[field_name] = value
+        self.bump_version()
         return True
 
     @cubetry
@@ -247,6 +272,7 @@ class CubeConfig:
         if uid not in resetters:
             resetters.append(uid)
             self.config_dict[key] = resetters
+            self.bump_version()
         return True
 
     @cubetry
@@ -256,6 +282,7 @@ class CubeConfig:
         if uid in resetters:
             resetters.remove(uid)
             self.config_dict[key] = resetters
+            self.bump_version()
         return True
 
     @cubetry
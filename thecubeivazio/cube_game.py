@@ -1,10 +1,13 @@
 """Modelises a TheCube game session, i.e. a team trying to open a CubeBox"""
 import enum
 import hashlib
+import itertools
 import json
 import random
+import threading
 import time
-from typing import List, Dict, Tuple, Iterable
+import weakref
+from typing import Any, Callable, List, Dict, Set, Tuple, Iterable
 
 import thecubeivazio.cube_rfid as cube_rfid
 from thecubeivazio import cube_identification as cubeid
@@ -13,6 +16,196 @@ from thecubeivazio.cube_common_defines import *
 from thecubeivazio.cube_config import CubeConfig
 from thecubeivazio.cube_logger import CubeLogger
 
+def hash_of_hash_dict(hash_dict: Dict[str, Hash]) -> Hash:
+    """Hash of the hashes of a list of records, regardless of their order: a node of a hash tree"""
+    return hashlib.sha256(json.dumps(hash_dict, sort_keys=True).encode()).hexdigest()
+
+
+# every change of a versioned object gives it the next number of this counter. Since it only goes up,
+# the version of a container is simply the highest version among itself and its content.
+_version_counter = itertools.count(1)
+_NO_VALUE = object()
+
+
+def next_version() -> int:
+    return next(_version_counter)
+
+
+class CubeVersionCache:
+    """Caches values computed from an object, like its hash, until its `version` changes"""
+
+    def cached_for_version(self, key: str, compute: Callable[[], Any]) -> Any:
+        """Returns the result of compute(), calling it only once per version of this object.
+        The result is shared by all the callers: it must not be modified."""
+        version = self.version
+        cache = self.__dict__.get("_version_cache")
+        if cache is None or cache[0] != version:
+            cache = (version, {})
+            object.__setattr__(self, "_version_cache", cache)
+        if key not in cache[1]:
+            cache[1][key] = compute()
+        return cache[1][key]
+
+
+class CubeVersionTracked(CubeVersionCache):
+    """An object with a stored `version` number, which tells the containers holding it (its owners)
+    when this number changes, so that their own version follows without them having to look at their content.
+    The owners are weakly referenced: a container which does not exist anymore is simply forgotten."""
+    _version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def bump_version(self):
+        self._set_version(next_version())
+
+    def _set_version(self, version: int):
+        if version <= self._version:
+            return
+        object.__setattr__(self, "_version", version)
+        for owner_ref in list(self.__dict__.get("_version_owners", ())):
+            owner = owner_ref()
+            if owner is not None:
+                owner._set_version(version)
+
+    def _add_version_owner(self, owner: 'CubeVersionTracked'):
+        """Called by a container when this object is added to it"""
+        owners = self.__dict__.get("_version_owners")
+        if owners is None:
+            owners = []
+            object.__setattr__(self, "_version_owners", owners)
+        # forget the owners which do not exist anymore
+        owners[:] = [owner_ref for owner_ref in owners if owner_ref() is not None]
+        owners.append(weakref.ref(owner))
+
+    def _remove_version_owner(self, owner: 'CubeVersionTracked'):
+        """Called by a container when this object is removed from it"""
+        owners = self.__dict__.get("_version_owners", [])
+        for i, owner_ref in enumerate(owners):
+            if owner_ref() is owner:
+                del owners[i]
+                return
+
+    def _version_owners_list(self) -> List['CubeVersionTracked']:
+        return [owner for owner in (owner_ref() for owner_ref in self.__dict__.get("_version_owners", ()))
+                if owner is not None]
+
+
+class CubeVersioned(CubeVersionTracked):
+    """Gives an object a `version` number, bumped every time one of its attributes is set to a different value,
+    so that its changes can be detected with an integer comparison instead of a hash.
+    An attribute holding a versioned object (e.g. a CubeVersionedList) makes its changes bump this version too.
+    In-place modifications of another attribute (e.g. appending to a list) must call bump_version() themselves."""
+    # attributes which are not part of the status: setting them does not make a new version
+    UNVERSIONED_ATTRIBUTES: Tuple[str, ...] = ()
+
+    def __setattr__(self, name, value):
+        if name in self.UNVERSIONED_ATTRIBUTES:
+            object.__setattr__(self, name, value)
+            return
+        old_value = self.__dict__.get(name, _NO_VALUE)
+        object.__setattr__(self, name, value)
+        if old_value is value:
+            return
+        if isinstance(old_value, CubeVersionTracked):
+            old_value._remove_version_owner(self)
+        if isinstance(value, CubeVersionTracked):
+            value._add_version_owner(self)
+        # a versioned value replaced by another one is always a change: else, the version of the container
+        # could go back to an older number.
+        # None is not compared: some __eq__ (e.g. CubeRfidLine's) do not expect it
+        if (old_value is _NO_VALUE or old_value is None or value is None
+                or isinstance(value, CubeVersionTracked) or old_value != value):
+            self.bump_version()
+
+
+class CubeVersionedList(CubeVersionTracked, list):
+    """A list of CubeVersioned items whose version changes when an item is added, removed or moved,
+    or when one of its items changes: the items notify the list, which keeps reading the version in constant time.
+    Subclasses which need to know which items are added or removed override _on_items_added and _on_items_removed."""
+
+    def _items_added(self, items: List):
+        for item in items:
+            if isinstance(item, CubeVersionTracked):
+                item._add_version_owner(self)
+        self._on_items_added(items)
+
+    def _items_removed(self, items: List):
+        for item in items:
+            if isinstance(item, CubeVersionTracked):
+                item._remove_version_owner(self)
+        self._on_items_removed(items)
+
+    def _on_items_added(self, items: List):
+        pass
+
+    def _on_items_removed(self, items: List):
+        pass
+
+    def append(self, item):
+        super().append(item)
+        self.bump_version()
+        self._items_added([item])
+
+    def extend(self, items):
+        items = list(items)
+        super().extend(items)
+        self.bump_version()
+        self._items_added(items)
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self.bump_version()
+        self._items_added([item])
+
+    def remove(self, item):
+        # list.remove() removes the first item equal to the given one, which is not necessarily the same object
+        index = self.index(item)
+        removed = self[index]
+        super().__delitem__(index)
+        self.bump_version()
+        self._items_removed([removed])
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self.bump_version()
+        self._items_removed([item])
+        return item
+
+    def clear(self):
+        items = list(self)
+        super().clear()
+        self.bump_version()
+        self._items_removed(items)
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.bump_version()
+
+    def reverse(self):
+        super().reverse()
+        self.bump_version()
+
+    def __setitem__(self, index, item):
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        items = list(item) if isinstance(index, slice) else [item]
+        super().__setitem__(index, items if isinstance(index, slice) else item)
+        self.bump_version()
+        self._items_removed(removed)
+        self._items_added(items)
+
+    def __delitem__(self, index):
+        removed = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        self.bump_version()
+        self._items_removed(removed)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+
 class CubeboxState(enum.Enum):
     # TODO: implement the unknown state, useful for the frontdesk
     STATE_UNKNOWN = "UNKNOWN"
@@ -38,8 +231,9 @@ class CubeboxState(enum.Enum):
 
 
 # TODO safeguard methods liable to raise exceptions
-class CubeboxStatus:
+class CubeboxStatus(CubeVersioned):
     """Represents a game session, i.e. a team trying to open a CubeBox"""
+    UNVERSIONED_ATTRIBUTES = ("_prev_cubebox_win_timestamp",)
 
     def __init__(self, cube_id: CubeId = None, current_team_name: TeamName = None, start_timestamp: Seconds = None,
                  win_timestamp: Seconds = None, last_valid_rfid_line: cube_rfid.CubeRfidLine = None,
@@ -71,7 +265,8 @@ class CubeboxStatus:
     @property
     def hash(self) -> Hash:
         try:
-            return hashlib.sha256(self.to_string().encode()).hexdigest()
+            return self.cached_for_version(
+                "hash", lambda: hashlib.sha256(self.to_string().encode()).hexdigest())
         except Exception as e:
             CubeLogger.static_error(f"CubeboxStatus.hash {e}")
             return ""
@@ -240,25 +435,15 @@ class CubeboxStatus:
 
     @cubetry
     def calculate_box_score(self) -> Optional[int]:
-        # find the preset associated to this cubebox. If not found, use the default one
-        presets = CubeboxesScoringPresets.make_from_config()
-        assert presets, "CubeboxStatus.calculate_score: failed to build scoring presets from config!"
-        calculator = presets.get_calculator_for_cube_id(self.cube_id)
-        if not calculator:
-            calculator = presets.get_default_calculator()
-            CubeLogger.static_warning(
-                f"CubeboxStatus.calculate_score: no preset found for cubebox {self.node_name}. Using default preset.")
-        if not calculator:
-            raise Exception(f"CubeboxStatus.calculate_score: failed to build default score calculator")
-        # calculate the score
-        return calculator.compute_score(self.completion_time_sec)
+        # the preset associated to this cubebox, or the default one, is found by the scoring engine
+        return CubeScoringEngine.get_default().calculate_box_score(self)
 
     @cubetry
     def is_completed(self) -> bool:
         return self.is_valid() and self.win_timestamp is not None and self.start_timestamp is not None
 
 
-class CubeboxesStatusList(List[CubeboxStatus]):
+class CubeboxesStatusList(CubeVersionedList, List[CubeboxStatus]):
     """List of CubeGame instances, one for each CubeBox in TheCube game. Meant to be used by the CubeMaster and FrontDesk."""
     JSON_ROOT_OBJECT_NAME = "cubeboxes"
 
@@ -303,14 +488,21 @@ class CubeboxesStatusList(List[CubeboxStatus]):
     @property
     @cubetry
     def hash(self) -> Hash:
-        return hashlib.sha256(self.to_string().encode()).hexdigest()
+        return self.cached_for_version("hash", lambda: hashlib.sha256(self.to_string().encode()).hexdigest())
+
+    @property
+    def tree_hash(self) -> Hash:
+        """Hash of the cubeboxes hashes, which does not depend on their order"""
+        return self.cached_for_version("tree_hash", lambda: hash_of_hash_dict(self.hash_dict))
 
     def compare_with_hashlist(self, hash_dict: Dict[NodeName, Hash]) -> Optional[Tuple[NodeName, ...]]:
-        """Returns the names of the teams whose hash is different from the one in the hash_dict.
-        If the returned tuple is empty, it means that the hash_dict is up-to-date with the teams list.
+        """Returns the names of the cubeboxes whose hash is different from the one in the hash_dict,
+        or which are not in this list.
+        If the returned tuple is empty, it means that the hash_dict is up-to-date with the cubeboxes list.
         If None is returned, it means that there was an error."""
         try:
             return tuple([node_name for node_name, hash in hash_dict.items() if
+                          self.get_cubebox_by_node_name(node_name) is None or
                           hash != self.get_cubebox_by_node_name(node_name).hash])
         except Exception as e:
             CubeLogger.static_error(f"CubeboxesStatusList.compare_with_hashlist {e}")
@@ -488,9 +680,88 @@ CompletedCubeboxStatus.__doc__ = "Represents a CubeBox that has been successfull
 
 
 class CompletedCubeboxStatusList(CubeboxesStatusList):
+    """The cubeboxes completed by a team, kept sorted by win timestamp as they are added.
+    The set of their IDs is maintained along with them, and their total time and score are cached until they change."""
+
     def __init__(self, cubeboxes: Optional[List[CompletedCubeboxStatus]] = None):
+        self._cube_ids: Set[CubeId] = set()
         super().__init__(cubeboxes, force_complete_list=False)
 
+    @cubetry
+    def copy(self) -> 'CompletedCubeboxStatusList':
+        return CompletedCubeboxStatusList([box.copy() for box in self])
+
+    def _on_items_added(self, boxes: List[CompletedCubeboxStatus]):
+        self._cube_ids.update(box.cube_id for box in boxes)
+        self._link_boxes()
+
+    def _on_items_removed(self, boxes: List[CompletedCubeboxStatus]):
+        self._cube_ids = {box.cube_id for box in self}
+        self._link_boxes()
+
+    def _link_boxes(self):
+        """Gives each box the win timestamp of the previous one, which its completion time may depend on"""
+        previous_win_timestamp = None
+        for box in self:
+            box._prev_cubebox_win_timestamp = previous_win_timestamp
+            previous_win_timestamp = box.win_timestamp
+
+    @cubetry
+    def update_from_cubebox(self, cubebox: CompletedCubeboxStatus) -> bool:
+        if not cubebox:
+            return False
+        if not cubebox.is_completed():
+            CubeLogger.static_critical(
+                f"CompletedCubeboxStatusList.update_from_cubebox: cubebox {cubebox.node_name} is not completed!")
+            return False
+        # if we have it, update it
+        if cubebox.cube_id in self._cube_ids:
+            self.get_cubebox_by_cube_id(cubebox.cube_id).build_from_copy(cubebox)
+            self.restore_order()
+            return True
+        # if we don't have it, add it at its place. The boxes are usually completed in chronological order,
+        # so the place is looked for from the end
+        index = len(self)
+        while index > 0 and self[index - 1].win_timestamp > cubebox.win_timestamp:
+            index -= 1
+        self.insert(index, cubebox)
+        return False
+
+    def restore_order(self) -> bool:
+        """The boxes are sorted as they are added. If one of them is modified in place afterwards,
+        this sorts them again, and drops those which are not completed anymore.
+        Only checks the boxes once per version of the list."""
+        return self.cached_for_version("ordered", self._restore_order)
+
+    def _restore_order(self) -> bool:
+        for box in [box for box in self if not box.is_completed()]:
+            CubeLogger.static_critical(
+                f"CompletedCubeboxStatusList.restore_order: cubebox {box.node_name} is not completed!")
+            del self[next(i for i, b in enumerate(self) if b is box)]
+        if any(self[i - 1].win_timestamp > self[i].win_timestamp for i in range(1, len(self))):
+            self.sort(key=lambda box: box.win_timestamp)
+            self._link_boxes()
+        return True
+
+    @property
+    def cube_ids(self) -> Set[CubeId]:
+        """The IDs of the completed cubeboxes. Must not be modified"""
+        return self._cube_ids
+
+    @property
+    def total_completion_time_sec(self) -> Seconds:
+        self.restore_order()
+        return self.cached_for_version("total_completion_time_sec",
+                                       lambda: sum(box.completion_time_sec for box in self))
+
+    def calculate_score(self, engine: 'CubeScoringEngine' = None) -> int:
+        """The sum of the scores of the boxes, computed once per version of the list and of the config"""
+        engine = engine or CubeScoringEngine.get_default()
+        config_version = engine.config_version
+        self.restore_order()
+        return self.cached_for_version(f"score_{config_version}",
+                                       lambda: sum(engine.calculate_box_score(box) for box in self))
+
     def is_valid(self):
         try:
             assert super().is_valid(), f"CompletedCubeboxStatusList.is_valid: super().is_valid() failed"
@@ -502,11 +773,26 @@ class CompletedCubeboxStatusList(CubeboxesStatusList):
             return False
 
 
-class CubeTeamStatus:
+class CubeTeamStatus(CubeVersioned):
     """Represents a team playing a CubeGame"""
+    UNVERSIONED_ATTRIBUTES = ("pause_timestamps", "resume_timestamps")
+    # the attributes by which the CubeTeamsStatusList instances index their teams.
+    # When one of them changes, the lists holding the team are notified so that they update their indexes.
+    INDEXED_ATTRIBUTES = ("name", "rfid_uid", "creation_timestamp", "current_cubebox_id")
 
     CUSTOM_NAME_MAX_LENGTH = 30
 
+    def __setattr__(self, name, value):
+        if name not in self.INDEXED_ATTRIBUTES or not self.__dict__.get("_version_owners"):
+            super().__setattr__(name, value)
+            return
+        old_value = self.__dict__.get(name, _NO_VALUE)
+        super().__setattr__(name, value)
+        if old_value != value:
+            for owner in self._version_owners_list():
+                if isinstance(owner, CubeTeamsStatusList):
+                    owner._on_team_attribute_changed(self, name, old_value)
+
     def __init__(self, name: str, rfid_uid: str, max_time_sec: Seconds, creation_timestamp: Timestamp = None,
                  custom_name: str = "",
                  start_timestamp: Timestamp = None, current_cubebox_id: int = None,
@@ -586,29 +872,9 @@ class CubeTeamStatus:
     @property
     @cubetry
     def completed_cubeboxes(self) -> CompletedCubeboxStatusList:
-        assert self._update_completed_cubeboxes()
-        return CompletedCubeboxStatusList([box for box in self._completed_cubeboxes])
-
-    @cubetry
-    def _update_completed_cubeboxes(self) -> bool:
-        """updates the time elapsed for each cubebox, according to the rule defined in
-        cube_common_defines"""
-        # if any completed box isnt set properly, remove it.
-        # This shouldn't happen so if one of these cubeboxes is not completed, log it as a critical error
-        for box in self._completed_cubeboxes:
-            if not box.is_completed():
-                CubeLogger.static_critical(
-                    f"CubeTeamStatus._update_completed_cubeboxes: cubebox {box.node_name} is not completed!")
-        self._completed_cubeboxes = [box for box in self._completed_cubeboxes if box.is_completed()]
-        # order the completed cubeboxes by time of completion
-        self._completed_cubeboxes.sort(key=lambda box: box.win_timestamp)
-        # for each completed box, set the _prev_cubebox_win_timestamp
-        for i, box in enumerate(self._completed_cubeboxes):
-            if i == 0:
-                box._prev_cubebox_win_timestamp = None
-            else:
-                box._prev_cubebox_win_timestamp = self._completed_cubeboxes[i - 1].win_timestamp
-        return True
+        """The completed cubeboxes, sorted by time of completion. To add one, use set_completed_cube()"""
+        self._completed_cubeboxes.restore_order()
+        return self._completed_cubeboxes
 
     @property
     def end_timestamp(self) -> Optional[Timestamp]:
@@ -715,8 +981,8 @@ class CubeTeamStatus:
             ret.current_cubebox_id = d.get("current_cubebox_id", None)
             if ret.current_cubebox_id is not None:
                 ret.current_cubebox_id = int(ret.current_cubebox_id)
-            ret._completed_cubeboxes = [
-                CompletedCubeboxStatus.make_from_dict(box) for box in d.get("completed_cubeboxes", [])]
+            ret._completed_cubeboxes = CompletedCubeboxStatusList([
+                CompletedCubeboxStatus.make_from_dict(box) for box in d.get("completed_cubeboxes", [])])
             ret.trophies_names = d.get("trophies_names", [])
             ret.use_alarm = d.get("use_alarm", False)
             if ret.last_modification_timestamp is not None:
@@ -745,7 +1011,8 @@ class CubeTeamStatus:
     @property
     def hash(self) -> Hash:
         try:
-            return hashlib.sha256(self.to_string().encode()).hexdigest()
+            return self.cached_for_version(
+                "hash", lambda: hashlib.sha256(self.to_string().encode()).hexdigest())
         except Exception as e:
             CubeLogger.static_error(f"CubeTeamStatus.hash {e}")
             return ""
@@ -799,7 +1066,7 @@ class CubeTeamStatus:
 
     # TODO: test
     def has_completed_cube(self, cube_id: int) -> bool:
-        return cube_id in [box.cube_id for box in self._completed_cubeboxes]
+        return cube_id in self._completed_cubeboxes.cube_ids
 
     # TODO: test
     def set_completed_cube(self, cube_id: int, start_timestamp: float, win_timestamp: float) -> bool:
@@ -810,6 +1077,7 @@ class CubeTeamStatus:
         self._completed_cubeboxes.append(CompletedCubeboxStatus(
             cube_id=cube_id, current_team_name=self.name, start_timestamp=start_timestamp,
             win_timestamp=win_timestamp))
+        self.bump_version()
         return True
 
     def has_started(self) -> bool:
@@ -818,17 +1086,7 @@ class CubeTeamStatus:
     @cubetry
     def calculate_team_score(self) -> int:
         """Calculate the total score of the team, based on the completion times of the cubeboxes it has played."""
-        # memo: cid means cube_id, cts means completion_time_sec
-        try:
-            boxes_score = sum([box.calculate_box_score() for box in self._completed_cubeboxes])
-        except:
-            boxes_score = 0
-        try:
-            trophy_score = sum([trophy.points for trophy in self.trophies])
-        except:
-            trophy_score = 0
-        # CubeLogger.static_info(f"CubeTeamStatus.calculate_score boxes_score={boxes_score} trophy_score={trophy_score}")
-        return boxes_score + trophy_score
+        return CubeScoringEngine.get_default().calculate_team_score(self)
 
     @cubetry
     def copy(self):
@@ -846,7 +1104,7 @@ class CubeTeamStatus:
 
     @cubetry
     def has_played_cube(self, cubebox_id):
-        return cubebox_id in [box.cube_id for box in self._completed_cubeboxes]
+        return cubebox_id in self._completed_cubeboxes.cube_ids
 
     @cubetry
     def update_from_team(self, team):
@@ -877,11 +1135,13 @@ class CubeTeamStatus:
     def add_trophy_by_name(self, trophy_name: str):
         if not trophy_name in self.trophies_names:
             self.trophies_names.append(trophy_name)
+            self.bump_version()
 
     @cubetry
     def remove_trophy_by_name(self, trophy_name: str):
         if trophy_name in self.trophies_names:
             self.trophies_names.remove(trophy_name)
+            self.bump_version()
 
     @cubetry
     def remove_trophy_by_french_name(self, french_name: str):
@@ -898,17 +1158,140 @@ class CubeTeamStatus:
 
 
 # TODO : add ranks for the day, week, mont, all-time
-class CubeTeamsStatusList(List[CubeTeamStatus]):
-    """List of CubeTeam instances, one for each team playing a CubeGame. Meant to be used by the CubeMaster and FrontDesk."""
+class CubeTeamsIndexes:
+    """Secondary indexes of a CubeTeamsStatusList, so that finding a team does not scan the whole list.
+    Each index maps the keys computed from an attribute of the teams to the teams having these keys.
+    A key may match several teams, or teams which do not match the search exactly (e.g. close timestamps):
+    the lookups filter these candidates."""
+
+    def __init__(self):
+        self._indexes: Dict[str, Dict[Any, List[CubeTeamStatus]]] = {
+            attribute: {} for attribute in CubeTeamStatus.INDEXED_ATTRIBUTES}
+
+    @staticmethod
+    def keys(attribute: str, value) -> List[Any]:
+        """The keys under which a team with this attribute value is indexed"""
+        if attribute == "name":
+            return [value.lower() if isinstance(value, str) else value]
+        if attribute == "rfid_uid":
+            # two UIDs are the same if the shorter one starts the longer one:
+            # index the UID itself, and all its prefixes which could be a valid UID
+            if not isinstance(value, str):
+                return [value]
+            uid = value.lower()
+            return [("=", uid)] + [("^", uid[:length]) for length in
+                                   range(cube_rfid.CubeRfidLine.MIN_UID_LENGTH, len(uid) + 1)]
+        if attribute == "creation_timestamp":
+            # timestamps closer than TIMESTAMP_EPSILON are in the same or in adjacent buckets
+            return [int(value // TIMESTAMP_EPSILON) if isinstance(value, (int, float)) else value]
+        return [value]
+
+    @staticmethod
+    def lookup_keys(attribute: str, value) -> List[Any]:
+        """The keys under which the teams matching this attribute value can be indexed"""
+        if attribute == "rfid_uid" and isinstance(value, str):
+            # the UIDs starting with this one, and the shorter UIDs this one starts with
+            uid = value.lower()
+            return [("^", uid)] + [("=", uid[:length]) for length in
+                                   range(cube_rfid.CubeRfidLine.MIN_UID_LENGTH, len(uid))]
+        if attribute == "creation_timestamp" and isinstance(value, (int, float)):
+            bucket = int(value // TIMESTAMP_EPSILON)
+            return [bucket - 1, bucket, bucket + 1]
+        return CubeTeamsIndexes.keys(attribute, value)
+
+    def add(self, team: CubeTeamStatus, attributes: Iterable[str] = CubeTeamStatus.INDEXED_ATTRIBUTES):
+        for attribute in attributes:
+            for key in self.keys(attribute, getattr(team, attribute, None)):
+                self._indexes[attribute].setdefault(key, []).append(team)
+
+    def remove(self, team: CubeTeamStatus, attributes: Iterable[str] = CubeTeamStatus.INDEXED_ATTRIBUTES,
+               old_value=_NO_VALUE) -> bool:
+        """Removes the team from the indexes. If old_value is given, it is used instead of the current
+        value of the (single) attribute. Returns False if the team was not in the indexes"""
+        found = True
+        for attribute in attributes:
+            value = getattr(team, attribute, None) if old_value is _NO_VALUE else old_value
+            for key in self.keys(attribute, value):
+                candidates = self._indexes[attribute].get(key, [])
+                for i, candidate in enumerate(candidates):
+                    if candidate is team:
+                        del candidates[i]
+                        break
+                else:
+                    found = False
+                if not candidates:
+                    self._indexes[attribute].pop(key, None)
+        return found
+
+    def candidates(self, attribute: str, value) -> List[CubeTeamStatus]:
+        lookup_keys = self.lookup_keys(attribute, value)
+        if len(lookup_keys) == 1:
+            return self._indexes[attribute].get(lookup_keys[0], [])
+        ret = []
+        for key in lookup_keys:
+            ret.extend(team for team in self._indexes[attribute].get(key, []) if all(t is not team for t in ret))
+        return ret
+
+    def to_dict(self) -> Dict[str, Dict[Any, List[int]]]:
+        """The ids of the indexed teams by key, to compare indexes"""
+        return {attribute: {key: sorted(id(team) for team in teams) for key, teams in index.items()}
+                for attribute, index in self._indexes.items()}
+
+
+class CubeTeamsStatusList(CubeVersionedList, List[CubeTeamStatus]):
+    """List of CubeTeam instances, one for each team playing a CubeGame. Meant to be used by the CubeMaster and FrontDesk.
+    The teams are indexed by name, RFID UID, creation timestamp and current cubebox,
+    which keeps the lookups in constant time however many teams the list holds."""
 
     DEFAULT_JSON_FILE = "cube_teams_list.json"
     JSON_ROOT_OBJECT_NAME = "teams"
 
     def __init__(self, teams: Optional[List[CubeTeamStatus]] = None):
         super().__init__()
+        self._teams_indexes = CubeTeamsIndexes()
         if teams:
             self.extend(teams)
 
+    def __getstate__(self):
+        # the indexes reference the teams of this very list: a copy rebuilds its own as its items are added
+        state = dict(self.__dict__)
+        state.pop("_teams_indexes", None)
+        return state
+
+    @property
+    def indexes(self) -> CubeTeamsIndexes:
+        indexes = self.__dict__.get("_teams_indexes")
+        if indexes is None:
+            indexes = self._teams_indexes = CubeTeamsIndexes()
+        return indexes
+
+    def _on_items_added(self, teams: List[CubeTeamStatus]):
+        for team in teams:
+            self.indexes.add(team)
+
+    def _on_items_removed(self, teams: List[CubeTeamStatus]):
+        for team in teams:
+            self.indexes.remove(team)
+
+    def _on_team_attribute_changed(self, team: CubeTeamStatus, attribute: str, old_value):
+        """Called by a team of this list when one of its indexed attributes changes"""
+        if self.indexes.remove(team, (attribute,), old_value=old_value):
+            self.indexes.add(team, (attribute,))
+
+    def _first_in_list_order(self, candidates: List[CubeTeamStatus]) -> Optional[CubeTeamStatus]:
+        """Among several teams matching a lookup, the one a scan of the list would have found"""
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        candidates_ids = {id(team) for team in candidates}
+        return next((team for team in self if id(team) in candidates_ids), None)
+
+    def check_indexes(self) -> bool:
+        """Returns True if the indexes hold exactly the teams of the list, under their current keys"""
+        expected = CubeTeamsIndexes()
+        for team in self:
+            expected.add(team)
+        return expected.to_dict() == self.indexes.to_dict()
+
     def __str__(self):
         return self.to_string()
 
@@ -943,16 +1326,15 @@ class CubeTeamsStatusList(List[CubeTeamStatus]):
     @property
     def hash(self) -> Hash:
         try:
-            return hashlib.sha256(self.to_string().encode()).hexdigest()
+            return self.cached_for_version("hash", lambda: hashlib.sha256(self.to_string().encode()).hexdigest())
         except Exception as e:
             CubeLogger.static_error(f"CubeTeamsStatusList.hash {e}")
             return ""
 
     @cubetry
     def has_team(self, team: CubeTeamStatus) -> bool:
-        for t in self:
-            if t.is_same_team_as(team):
-                return True
+        return any(t.is_same_team_as(team) for t in self.indexes.candidates(
+            "creation_timestamp", team.creation_timestamp))
 
     @cubetry
     def get_team_ranking_among_list(self, team: CubeTeamStatus) -> int:
@@ -991,13 +1373,19 @@ class CubeTeamsStatusList(List[CubeTeamStatus]):
             CubeLogger.static_error(f"CubeTeamsStatusList.is_valid {e}")
             return False
 
+    @property
+    def tree_hash(self) -> Hash:
+        """Hash of the teams hashes, which does not depend on their order"""
+        return hash_of_hash_dict(self.hash_dict)
+
     def compare_with_hashlist(self, hash_dict: Dict[TeamName, Hash]) -> Optional[Tuple[TeamName, ...]]:
-        """Returns the names of the teams whose hash is different from the one in the hash_dict.
+        """Returns the names of the teams whose hash is different from the one in the hash_dict,
+        or which are not in this list.
         If the returned tuple is empty, it means that the hash_dict is up-to-date with the teams list.
         If None is returned, it means that there was an error."""
         try:
-            return tuple(
-                [team_name for team_name, hash in hash_dict.items() if self.get_team_by_name(team_name).hash != hash])
+            return tuple([team_name for team_name, hash in hash_dict.items() if
+                          self.get_team_by_name(team_name) is None or self.get_team_by_name(team_name).hash != hash])
         except Exception as e:
             CubeLogger.static_error(f"CubeTeamsStatusList.compare_with_hashlist {e}")
             return None
@@ -1046,34 +1434,26 @@ class CubeTeamsStatusList(List[CubeTeamStatus]):
 
     @cubetry
     def remove_team_by_name(self, name: str) -> bool:
-        for team in self:
-            if team.name == name:
-                super().remove(team)
-                return True
-        return False
+        team = self._first_in_list_order([t for t in self.indexes.candidates("name", name) if t.name == name])
+        if team is None:
+            return False
+        del self[self._index_of(team)]
+        return True
 
     @cubetry
     def get_team_by_rfid_uid(self, rfid_uid: str) -> Optional[CubeTeamStatus]:
-        for team in self:
-            if cube_rfid.CubeRfidLine.are_uids_the_same(team.rfid_uid, rfid_uid):
-                return team
-        return None
+        return self._first_in_list_order([team for team in self.indexes.candidates("rfid_uid", rfid_uid)
+                                          if cube_rfid.CubeRfidLine.are_uids_the_same(team.rfid_uid, rfid_uid)])
 
     @cubetry
     def get_team_by_name(self, name: str, ignore_case=True) -> Optional[CubeTeamStatus]:
-        for team in self:
-            if ignore_case and team.name.lower() == name.lower():
-                return team
-            if not ignore_case and team.name == name:
-                return team
-        return None
+        name_lower = name.lower()
+        return self._first_in_list_order([team for team in self.indexes.candidates("name", name)
+                                          if (team.name.lower() == name_lower if ignore_case else team.name == name)])
 
     @cubetry
     def get_team_by_current_cube_id(self, cube_id: int) -> Optional[CubeTeamStatus]:
-        for team in self:
-            if team.current_cubebox_id == cube_id:
-                return team
-        return None
+        return self._first_in_list_order(list(self.indexes.candidates("current_cubebox_id", cube_id)))
 
     @cubetry
     def save_to_json_file(self, filename: str = None) -> bool:
@@ -1097,12 +1477,27 @@ class CubeTeamsStatusList(List[CubeTeamStatus]):
     @cubetry
     def update_team(self, team: CubeTeamStatus) -> bool:
         assert team.is_valid()
-        for i, t in enumerate(self):
-            if t.is_same_team_as(team):
-                return self[i].update_from_team(team)
+        existing_team = self.find_team_by_creation_timestamp(team.creation_timestamp, exact=True)
+        if existing_team is not None:
+            return existing_team.update_from_team(team)
+        self.append(team)
+        return True
+
+    @cubetry
+    def replace_team(self, team: CubeTeamStatus) -> bool:
+        """Unlike update_team, which merges the two, replaces our status of this team with the given one"""
+        assert team.is_valid()
+        existing_team = self.find_team_by_creation_timestamp(team.creation_timestamp, exact=True)
+        if existing_team is not None:
+            self[self._index_of(existing_team)] = team
+            return True
         self.append(team)
         return True
 
+    def _index_of(self, team: CubeTeamStatus) -> int:
+        """The position of this very team object in the list (list.index compares the teams by content)"""
+        return next(i for i, t in enumerate(self) if t is team)
+
     def update_from_teams_list(self, teams_list: 'CubeTeamsStatusList') -> bool:
         try:
             for team in teams_list:
@@ -1112,23 +1507,69 @@ class CubeTeamsStatusList(List[CubeTeamStatus]):
             CubeLogger.static_error(f"CubeTeamsStatusList.update_from_teams_list {e}")
             return False
 
+    def replace_from_teams_list(self, teams_list: 'CubeTeamsStatusList') -> bool:
+        """Unlike update_from_teams_list, makes this list the same as the given one:
+        our status of each team is replaced by the given one, and the teams which are not in it are removed"""
+        try:
+            creation_timestamps = {team.creation_timestamp for team in teams_list}
+            for team in [team for team in self if team.creation_timestamp not in creation_timestamps]:
+                del self[self._index_of(team)]
+            for team in teams_list:
+                assert self.replace_team(team), f"replace_team failed for {team.name}"
+            return True
+        except Exception as e:
+            CubeLogger.static_error(f"CubeTeamsStatusList.replace_from_teams_list {e}")
+            return False
+
     def remove_team(self, team_name: str) -> bool:
-        for team in self:
-            if team.name == team_name:
-                self.remove(team)
-                return True
-        return False
+        return bool(self.remove_team_by_name(team_name))
 
     @cubetry
-    def find_team_by_creation_timestamp(self, team_creation_timestamp: Timestamp) -> Optional[CubeTeamStatus]:
-        epsilon = TIMESTAMP_EPSILON
-        for team in self:
-            if abs(team.creation_timestamp - team_creation_timestamp) < epsilon:
-                return team
-        return None
+    def find_team_by_creation_timestamp(self, team_creation_timestamp: Timestamp,
+                                        exact=False) -> Optional[CubeTeamStatus]:
+        """If exact is False, the timestamps only have to be closer than TIMESTAMP_EPSILON"""
+        candidates = self.indexes.candidates("creation_timestamp", team_creation_timestamp)
+        if exact:
+            return self._first_in_list_order([team for team in candidates
+                                              if team.creation_timestamp == team_creation_timestamp])
+        return self._first_in_list_order([team for team in candidates
+                                          if abs(team.creation_timestamp - team_creation_timestamp) < TIMESTAMP_EPSILON])
+
+
+class CubeGameStatusSnapshot:
+    """An immutable serialized view of a CubeGameStatus at a given version.
+    It is made once per version and shared by everything that needs the status as text:
+    its hash, the status messages sent to the frontdesk, the logs."""
+    __slots__ = ("version", "json", "hash")
+
+    def __init__(self, version: int, json_str: str):
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "json", json_str)
+        object.__setattr__(self, "hash", hashlib.sha256(json_str.encode()).hexdigest())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CubeGameStatusSnapshot is immutable")
+
+    def __repr__(self):
+        return f"CubeGameStatusSnapshot(version={self.version}, hash={self.hash}, {len(self.json)} chars)"
+
+    @classmethod
+    def make_from_status(cls, status: 'CubeGameStatus') -> 'CubeGameStatusSnapshot':
+        # read the version first: if the status changes during the serialization,
+        # the snapshot is labeled with the older version and will be made again on the next call
+        version = status.version
+        # the dicts of the teams and cubeboxes are also made once per version,
+        # so that a new snapshot only walks the records which changed
+        status_dict = {
+            CubeboxesStatusList.JSON_ROOT_OBJECT_NAME: {CubeboxesStatusList.JSON_ROOT_OBJECT_NAME: [
+                box.cached_for_version("dict", box.to_dict) for box in status.cubeboxes]},
+            CubeTeamsStatusList.JSON_ROOT_OBJECT_NAME: {CubeTeamsStatusList.JSON_ROOT_OBJECT_NAME: [
+                team.cached_for_version("dict", team.to_dict) for team in status.teams]},
+        }
+        return cls(version, cube_utils.CubeJson.dumps(status_dict))
 
 
-class CubeGameStatus:
+class CubeGameStatus(CubeVersioned):
     """Holds the statuses of all cubeboxes and all teams"""
 
     def __init__(self, cubeboxes: CubeboxesStatusList = None, teams: CubeTeamsStatusList = None):
@@ -1142,14 +1583,32 @@ class CubeGameStatus:
             CubeLogger.static_error(f"CubeGameStatus.__eq__ {e}")
             return False
 
+    @property
+    def snapshot(self) -> CubeGameStatusSnapshot:
+        """The serialized status, made only once per version"""
+        return self.cached_for_version("snapshot", lambda: CubeGameStatusSnapshot.make_from_status(self))
+
     @property
     def hash(self) -> Hash:
         try:
-            return hashlib.sha256(self.to_json().encode()).hexdigest()
+            return self.snapshot.hash
         except Exception as e:
             CubeLogger.static_error(f"CubeGameStatus.hash {e}")
             return ""
 
+    @property
+    def bucket_hashes(self) -> Dict[str, Hash]:
+        """The second level of the status hash tree: the tree hash of the cubeboxes and that of the teams"""
+        return dict(self.cached_for_version("bucket_hashes", lambda: {
+            CubeboxesStatusList.JSON_ROOT_OBJECT_NAME: self.cubeboxes.tree_hash,
+            CubeTeamsStatusList.JSON_ROOT_OBJECT_NAME: self.teams.tree_hash,
+        }))
+
+    @property
+    def tree_hash(self) -> Hash:
+        """The root of the status hash tree. Unlike `hash`, it does not depend on the order of the teams"""
+        return self.cached_for_version("tree_hash", lambda: hash_of_hash_dict(self.bucket_hashes))
+
     def register_win(self, cube_id: int, team_name: str, win_timestamp: Seconds) -> bool:
         cubebox = self.cubeboxes.get_cubebox_by_cube_id(cube_id)
         if cubebox:
@@ -1178,7 +1637,7 @@ class CubeGameStatus:
             return None
 
     def to_json(self) -> str:
-        return json.dumps(self.to_dict())
+        return self.snapshot.json
 
     @classmethod
     def make_from_json(cls, json_str: str):
@@ -1189,6 +1648,132 @@ class CubeGameStatus:
             return None
 
 
+class CubeGameStatusDelta:
+    """The changes of a CubeGameStatus between two versions: the teams and cubeboxes which changed
+    since `base_version`, and the names of the teams which were removed since then."""
+
+    def __init__(self, base_version: int = 0, version: int = 0, teams: CubeTeamsStatusList = None,
+                 cubeboxes: CubeboxesStatusList = None, removed_team_names: List[TeamName] = None):
+        self.base_version = base_version
+        self.version = version
+        self.teams = teams or CubeTeamsStatusList()
+        self.cubeboxes = cubeboxes or CubeboxesStatusList(force_complete_list=False)
+        self.removed_team_names = removed_team_names or []
+
+    def __repr__(self):
+        return (f"CubeGameStatusDelta({self.base_version}->{self.version}, teams={[t.name for t in self.teams]}, "
+                f"cubeboxes={[b.cube_id for b in self.cubeboxes]}, removed={self.removed_team_names})")
+
+    def is_empty(self) -> bool:
+        return not self.teams and not self.cubeboxes and not self.removed_team_names
+
+    @cubetry
+    def apply_to(self, game_status: CubeGameStatus) -> bool:
+        """Patches the given game status with these changes.
+        The teams are replaced, not merged, so that a trophy removed from a team is removed here too"""
+        for team_name in self.removed_team_names:
+            game_status.teams.remove_team(team_name)
+        for team in self.teams:
+            assert game_status.teams.replace_team(team), f"replace_team failed for {team.name}"
+        assert game_status.cubeboxes.update_from_cubeboxes(self.cubeboxes), "update_from_cubeboxes failed"
+        return True
+
+    def to_dict(self) -> Dict:
+        return {
+            "base_version": self.base_version,
+            "version": self.version,
+            CubeTeamsStatusList.JSON_ROOT_OBJECT_NAME: self.teams.to_dict(),
+            CubeboxesStatusList.JSON_ROOT_OBJECT_NAME: self.cubeboxes.to_dict(),
+            "removed_team_names": list(self.removed_team_names),
+        }
+
+    @classmethod
+    def make_from_dict(cls, d: Dict) -> Optional['CubeGameStatusDelta']:
+        try:
+            # only the changed cubeboxes are listed, so CubeboxesStatusList.make_from_dict would not do
+            cubeboxes = CubeboxesStatusList(
+                [CubeboxStatus.make_from_dict(box_data) for box_data in
+                 d[CubeboxesStatusList.JSON_ROOT_OBJECT_NAME][CubeboxesStatusList.JSON_ROOT_OBJECT_NAME]],
+                force_complete_list=False)
+            return cls(
+                base_version=int(d["base_version"]),
+                version=int(d["version"]),
+                teams=CubeTeamsStatusList.make_from_dict(d[CubeTeamsStatusList.JSON_ROOT_OBJECT_NAME]),
+                cubeboxes=cubeboxes,
+                removed_team_names=list(d.get("removed_team_names", [])),
+            )
+        except Exception as e:
+            CubeLogger.static_error(f"CubeGameStatusDelta.make_from_dict {e}")
+            return None
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def make_from_json(cls, json_str: str) -> Optional['CubeGameStatusDelta']:
+        try:
+            return cls.make_from_dict(json.loads(json_str))
+        except Exception as e:
+            CubeLogger.static_error(f"CubeGameStatusDelta.make_from_json {e}")
+            return None
+
+
+class CubeGameStatusVersionTracker:
+    """Keeps track of the version at which each team and cubebox of a game status last changed, so that
+    the changes since a given version can be sent instead of the whole status."""
+
+    def __init__(self, game_status: CubeGameStatus):
+        self.game_status = game_status
+        # the version of the game status at the last update()
+        self.version = 0
+        # for each team and cubebox, the object and its version at the last update()
+        self._seen_teams: Dict[TeamName, Tuple[int, int]] = {}
+        self._seen_cubeboxes: Dict[CubeId, Tuple[int, int]] = {}
+        # version at which each team or cubebox last changed
+        self._team_versions: Dict[TeamName, int] = {}
+        self._cubebox_versions: Dict[CubeId, int] = {}
+        # version at which each team was removed
+        self._removed_team_versions: Dict[TeamName, int] = {}
+
+    def update(self) -> bool:
+        """Finds the teams and cubeboxes that changed since the last call.
+        Returns True if anything changed."""
+        version = self.game_status.version
+        if version == self.version:
+            return False
+        seen_teams = {}
+        for team in self.game_status.teams:
+            # a team object replaced by another one is a change too, even if the other one is older
+            seen_teams[team.name] = (id(team), team.version)
+            if self._seen_teams.get(team.name) != seen_teams[team.name]:
+                self._team_versions[team.name] = version
+                self._removed_team_versions.pop(team.name, None)
+        for team_name in set(self._seen_teams) - set(seen_teams):
+            self._team_versions.pop(team_name, None)
+            self._removed_team_versions[team_name] = version
+        self._seen_teams = seen_teams
+        seen_cubeboxes = {}
+        for box in self.game_status.cubeboxes:
+            seen_cubeboxes[box.cube_id] = (id(box), box.version)
+            if self._seen_cubeboxes.get(box.cube_id) != seen_cubeboxes[box.cube_id]:
+                self._cubebox_versions[box.cube_id] = version
+        self._seen_cubeboxes = seen_cubeboxes
+        self.version = version
+        return True
+
+    def make_delta(self, base_version: int) -> CubeGameStatusDelta:
+        """Returns the changes between `base_version` and the current version"""
+        teams = CubeTeamsStatusList([team.copy() for team in self.game_status.teams
+                                     if self._team_versions.get(team.name, 0) > base_version])
+        cubeboxes = CubeboxesStatusList([box.copy() for box in self.game_status.cubeboxes
+                                         if self._cubebox_versions.get(box.cube_id, 0) > base_version],
+                                        force_complete_list=False)
+        removed_team_names = [team_name for team_name, version in self._removed_team_versions.items()
+                              if version > base_version]
+        return CubeGameStatusDelta(base_version=base_version, version=self.version, teams=teams,
+                                   cubeboxes=cubeboxes, removed_team_names=removed_team_names)
+
+
 class CubeScoreCalculator:
     ScoringFunction = str
     SCORE_FUNCTION_LINEAR = "linear"
@@ -1365,6 +1950,89 @@ class CubeboxesScoringSettings(Dict[CubeId, ScoringPresetName]):
         return ret
 
 
+class CubeScoringEngine:
+    """Computes the scores of the cubeboxes and of the teams.
+    The score calculator of each cubebox and the points of each trophy are built from the config
+    once per config version, and the score of a box or of a team is cached until it changes."""
+    _default_engine: 'CubeScoringEngine' = None
+
+    def __init__(self, config: CubeConfig = None):
+        # if no config is given, the engine follows the global config
+        self._config = config
+        self._config_version: Optional[int] = None
+        self._calculators: Dict[CubeId, CubeScoreCalculator] = {}
+        self._trophies_points: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_default(cls) -> 'CubeScoringEngine':
+        if cls._default_engine is None:
+            cls._default_engine = cls()
+        return cls._default_engine
+
+    @property
+    def config(self) -> CubeConfig:
+        return self._config or CubeConfig.get_config()
+
+    @property
+    def config_version(self) -> int:
+        """The version of the config the calculators were built from. Rebuilds them if the config changed"""
+        config = self.config
+        if config.version != self._config_version:
+            with self._lock:
+                if config.version != self._config_version:
+                    self._build_from_config(config)
+        return self._config_version
+
+    def _build_from_config(self, config: CubeConfig):
+        config_version = config.version
+        presets = CubeboxesScoringPresets.make_from_config(config)
+        assert presets, "CubeScoringEngine: failed to build scoring presets from config!"
+        settings = CubeboxesScoringSettings.make_from_config(config) or CubeboxesScoringSettings()
+        calculators = {}
+        for cube_id in cubeid.CUBEBOX_IDS:
+            calculator = presets.get_calculator_by_preset_name(settings.get_preset_name_for_cube_id(cube_id))
+            if not calculator:
+                CubeLogger.static_warning(
+                    f"CubeScoringEngine: no preset found for cubebox {cube_id}. Using default preset.")
+                calculator = presets.get_default_calculator()
+            calculators[cube_id] = calculator
+        self._calculators = calculators
+        self._trophies_points = {trophy.name: trophy.points for trophy in config.defined_trophies or []}
+        self._config_version = config_version
+
+    @cubetry
+    def get_calculator_for_cube_id(self, cube_id: CubeId) -> Optional[CubeScoreCalculator]:
+        _ = self.config_version
+        return self._calculators.get(cube_id)
+
+    @cubetry
+    def calculate_box_score(self, box: CubeboxStatus) -> Optional[int]:
+        config_version = self.config_version
+        calculator = self._calculators.get(box.cube_id)
+        if not calculator:
+            raise Exception(f"CubeScoringEngine.calculate_box_score: no score calculator for cubebox {box.cube_id}")
+        # the completion time may depend on the previous box of the team, which is not part of the box's version
+        return box.cached_for_version(f"score_{config_version}_{box._prev_cubebox_win_timestamp}",
+                                      lambda: calculator.compute_score(box.completion_time_sec))
+
+    def calculate_team_score(self, team: CubeTeamStatus) -> int:
+        config_version = self.config_version
+
+        def compute_team_score() -> int:
+            try:
+                boxes_score = team.completed_cubeboxes.calculate_score(self)
+            except:
+                boxes_score = 0
+            try:
+                trophy_score = sum([self._trophies_points[name] for name in team.trophies_names])
+            except:
+                trophy_score = 0
+            return boxes_score + trophy_score
+
+        return team.cached_for_version(f"score_{config_version}", compute_team_score)
+
+
 def test_hashes():
     team1 = CubeTeamStatus(rfid_uid="1234567890", name="Budapest", max_time_sec=60.0)
     team1_2 = team1.copy()
@@ -1500,6 +2168,49 @@ def test_cubeboxes_scoring():
     exit(0)
 
 
+def test_scoring_engine():
+    """the scores are those of the presets, and are only computed again when the team or the config changes"""
+    config = CubeConfig.get_config()
+    config = CubeConfig.make_from_json(config.to_json())
+    engine = CubeScoringEngine(config)
+    team = CubeTeamStatus(name="Budapest", rfid_uid="1234567890", max_time_sec=3600.0)
+    for cube_id, start_timestamp, win_timestamp in ((1, 10.0, 300.0), (4, 320.0, 900.0), (12, 950.0, 1200.0)):
+        team.set_completed_cube(cube_id, start_timestamp, win_timestamp)
+    trophy = config.defined_trophies[0]
+    team.add_trophy_by_name(trophy.name)
+
+    presets = CubeboxesScoringPresets.make_from_config(config)
+    settings = CubeboxesScoringSettings.make_from_config(config)
+    expected = sum(presets.get_calculator_by_preset_name(settings.get_preset_name_for_cube_id(box.cube_id))
+                   .compute_score(box.completion_time_sec) for box in team.completed_cubeboxes) + trophy.points
+    assert engine.calculate_team_score(team) == expected
+
+    nb_builds = 0
+    make_from_config = CubeboxesScoringPresets.make_from_config
+
+    def counting_make_from_config(*args, **kwargs):
+        nonlocal nb_builds
+        nb_builds += 1
+        return make_from_config(*args, **kwargs)
+
+    CubeboxesScoringPresets.make_from_config = counting_make_from_config
+    try:
+        for _ in range(10):
+            assert engine.calculate_team_score(team) == expected
+        assert nb_builds == 0, "the presets were built again without any config change"
+        team.remove_trophy_by_name(trophy.name)
+        assert engine.calculate_team_score(team) == expected - trophy.points and nb_builds == 0
+        # doubling the points of every preset doubles the score of the boxes
+        presets_dict = {name: dict(calculator.to_dict(), max_score=calculator.max_score * 2,
+                                   min_score=calculator.min_score * 2) for name, calculator in presets.items()}
+        config.set_field(CubeboxesScoringPresets.JSON_ROOT_OBJECT_NAME, presets_dict)
+        assert abs(engine.calculate_team_score(team) - 2 * (expected - trophy.points)) <= len(team.completed_cubeboxes)
+        assert nb_builds == 1
+    finally:
+        CubeboxesScoringPresets.make_from_config = make_from_config
+    print("test_scoring_engine OK")
+
+
 def test_completion_time_sec():
     """generate a few completed cubeboxes in a team, then test the box.completion_time_sec method"""
     global CUBE_TIME_METHOD
@@ -1634,7 +2345,286 @@ def test_custom_name():
     assert team.custom_name == "A"*CubeTeamStatus.CUSTOM_NAME_MAX_LENGTH, f"team.custom_name='{team.custom_name}'"
     exit(0)
 
+def test_status_delta():
+    """apply the deltas of a tracked game status to a copy of it, check that the copy stays the same"""
+    master_status = CubeGameStatus()
+    tracker = CubeGameStatusVersionTracker(master_status)
+    tracker.update()
+    replica = CubeGameStatus.make_from_json(master_status.to_json())
+    replica_version = tracker.version
+    assert tracker.make_delta(replica_version).is_empty()
+
+    team1 = CubeTeamStatus(rfid_uid="1234567890", name="Budapest", max_time_sec=60.0)
+    team2 = CubeTeamStatus(rfid_uid="1234567891", name="Paris", max_time_sec=60.0)
+    master_status.teams.add_team(team1)
+    master_status.teams.add_team(team2)
+    assert tracker.update()
+    assert not tracker.update()
+    delta = tracker.make_delta(replica_version)
+    assert [team.name for team in delta.teams] == ["Budapest", "Paris"] and not delta.cubeboxes, delta
+    delta = CubeGameStatusDelta.make_from_json(delta.to_json())
+    assert delta.apply_to(replica)
+    replica_version = delta.version
+    assert replica == master_status
+
+    # only the cubebox that changed is sent
+    master_status.cubeboxes.get_cubebox_by_cube_id(3).set_state_playing("Budapest", time.time())
+    tracker.update()
+    delta = CubeGameStatusDelta.make_from_json(tracker.make_delta(replica_version).to_json())
+    assert [box.cube_id for box in delta.cubeboxes] == [3] and not delta.teams, delta
+    assert delta.apply_to(replica)
+    replica_version = delta.version
+    assert replica == master_status
+
+    # a delta from an older version includes all the changes since then, and the removed teams
+    base_version = replica_version
+    team1.set_completed_cube(3, time.time() - 10, time.time())
+    tracker.update()
+    master_status.teams.remove_team("Paris")
+    tracker.update()
+    delta = CubeGameStatusDelta.make_from_json(tracker.make_delta(base_version).to_json())
+    assert [team.name for team in delta.teams] == ["Budapest"] and delta.removed_team_names == ["Paris"], delta
+    assert delta.apply_to(replica)
+    replica_version = delta.version
+    assert replica == master_status
+
+    # the changes which merging cannot express are applied too
+    team1.add_trophy_by_name("FOO")
+    tracker.update()
+    replica_version = tracker.version
+    replica.teams.replace_team(team1.copy())
+    team1.remove_trophy_by_name("FOO")
+    tracker.update()
+    delta = CubeGameStatusDelta.make_from_json(tracker.make_delta(replica_version).to_json())
+    assert delta.apply_to(replica)
+    assert replica.teams.get_team_by_name("Budapest").trophies_names == [], replica.teams.get_team_by_name("Budapest")
+    assert replica == master_status
+
+    # a full status replaces the teams: those the master no longer has are removed
+    replica.teams.add_team(CubeTeamStatus(rfid_uid="1234567892", name="Rome", max_time_sec=60.0))
+    assert replica.teams.replace_from_teams_list(CubeGameStatus.make_from_json(master_status.to_json()).teams)
+    assert [team.name for team in replica.teams] == ["Budapest"]
+    assert replica == master_status
+    print("test_status_delta OK")
+
+
+def test_hash_tree():
+    """the tree hash of a game status does not depend on the order of the teams,
+    and the mismatched records are found by comparing the hash lists"""
+    team1 = CubeTeamStatus(rfid_uid="1234567890", name="Budapest", max_time_sec=60.0)
+    team2 = CubeTeamStatus(rfid_uid="1234567891", name="Paris", max_time_sec=60.0)
+    status1 = CubeGameStatus(teams=CubeTeamsStatusList([team1, team2]))
+    status2 = CubeGameStatus(teams=CubeTeamsStatusList([team2.copy(), team1.copy()]))
+    assert status1.hash != status2.hash
+    assert status1.tree_hash == status2.tree_hash
+    status2.teams.get_team_by_name("Paris").add_trophy_by_name("X")
+    status2.teams.remove_team("Budapest")
+    status2.cubeboxes.get_cubebox_by_cube_id(4).set_state_playing("Paris", time.time())
+    assert status1.tree_hash != status2.tree_hash
+    assert status1.bucket_hashes != status2.bucket_hashes
+    assert status1.teams.compare_with_hashlist(status2.teams.hash_dict) == ("Paris",)
+    assert status2.teams.compare_with_hashlist(status1.teams.hash_dict) == ("Budapest", "Paris")
+    assert status1.cubeboxes.compare_with_hashlist(status2.cubeboxes.hash_dict) == ("CubeBox4",)
+    # a replaced team is not merged: the trophy is gone
+    assert status2.teams.replace_team(team2.copy())
+    assert status2.teams.get_team_by_name("Paris") == team2
+    print("test_hash_tree OK")
+
+
+def test_versions():
+    """the versions change with the content of the game status, and only then"""
+    status = CubeGameStatus()
+    team = CubeTeamStatus(rfid_uid="1234567890", name="Budapest", max_time_sec=60.0)
+    status.teams.add_team(team)
+    box = status.cubeboxes.get_cubebox_by_cube_id(1)
+
+    version = status.version
+    team.max_time_sec = 60.0
+    box.set_state(box.get_state())
+    _ = team.completed_cubeboxes
+    _ = status.to_json()
+    assert status.version == version, "the version changed without any change"
+
+    for change in (lambda: team.add_trophy_by_name("X"),
+                   lambda: team.remove_trophy_by_name("X"),
+                   lambda: team.set_completed_cube(1, time.time() - 10, time.time()),
+                   lambda: setattr(team.completed_cubeboxes[0], "win_timestamp", time.time() - 1),
+                   lambda: box.set_state_playing("Budapest", time.time()),
+                   lambda: setattr(team, "current_cubebox_id", 2),
+                   lambda: status.teams.remove_team("Budapest"),
+                   lambda: setattr(status, "teams", CubeTeamsStatusList())):
+        team_version = team.version
+        change()
+        assert status.version > version, "the version did not change"
+        assert team.version >= team_version
+        version = status.version
+    # the versions are stored: the items notify their containers, which do not look at their content
+    status.teams.add_team(CubeTeamStatus(rfid_uid="1234567891", name="Paris", max_time_sec=60.0))
+    assert status.version == status._version == status.teams.version > version
+    version = status.version
+    # the teams removed from the status do not change its version anymore
+    team.add_trophy_by_name("Y")
+    assert status.version == version, "a removed team changed the version"
+    print("test_versions OK")
+
+
+def test_teams_indexes():
+    """the indexes of a CubeTeamsStatusList stay consistent with its teams, whatever changes them"""
+    teams = CubeTeamsStatusList()
+    for i, name in enumerate(("Budapest", "Paris", "Tokyo", "Lima")):
+        assert teams.add_team(CubeTeamStatus(rfid_uid=f"ABCD{i:04}", name=name, max_time_sec=60.0,
+                                             creation_timestamp=1000.0 + i, current_cubebox_id=i + 1))
+    assert teams.check_indexes()
+    assert teams.get_team_by_name("budapest") is teams[0] and teams.get_team_by_name("budapest", False) is None
+    assert teams.get_team_by_rfid_uid("abcd0001") is teams[1] and teams.get_team_by_rfid_uid("abcd0001ff") is teams[1]
+    assert teams.get_team_by_rfid_uid("ABCE0001") is None and teams.get_team_by_rfid_uid("abcd000") is teams[0]
+    assert teams.find_team_by_creation_timestamp(1002.0 + TIMESTAMP_EPSILON / 2) is teams[2]
+    assert teams.find_team_by_creation_timestamp(1002.0 + TIMESTAMP_EPSILON / 2, exact=True) is None
+    assert teams.get_team_by_current_cube_id(4) is teams[3] and teams.get_team_by_current_cube_id(5) is None
+    assert not teams.add_team(teams[0].copy())
+
+    tokyo = teams.get_team_by_name("Tokyo")
+    for change in (lambda: setattr(tokyo, "current_cubebox_id", 7),
+                   lambda: setattr(tokyo, "name", "Kyoto"),
+                   lambda: setattr(tokyo, "rfid_uid", "FFFF0000"),
+                   lambda: tokyo.update_from_team(CubeTeamStatus(rfid_uid="FFFF0000", name="Kyoto", max_time_sec=60.0,
+                                                                 creation_timestamp=1002.0, current_cubebox_id=8)),
+                   lambda: teams.update_team(CubeTeamStatus(rfid_uid="0123ABCD", name="Oslo", max_time_sec=60.0)),
+                   lambda: teams.replace_team(tokyo.copy()),
+                   lambda: teams.remove_team_by_name("Paris"),
+                   lambda: teams.sort(key=lambda t: t.name),
+                   lambda: teams.pop(0),
+                   lambda: teams.__setitem__(slice(-1, None), []),
+                   lambda: teams.load_from_json_file("/nonexistent")):
+        change()
+        assert teams.check_indexes(), "the indexes are not consistent with the teams"
+    # a team removed from the list does not change its indexes anymore
+    assert tokyo not in [t for t in teams if t is tokyo]
+    tokyo.name = "Nara"
+    assert teams.check_indexes() and teams.get_team_by_name("Nara") is None
+    assert teams.get_team_by_current_cube_id(8).name == "Kyoto"
+
+    loaded_teams = CubeTeamsStatusList.make_from_json(teams.to_json())
+    assert loaded_teams.check_indexes() and loaded_teams.get_team_by_name("kyoto").current_cubebox_id == 8
+    teams.clear()
+    assert teams.check_indexes() and teams.get_team_by_name("Kyoto") is None
+    print("test_teams_indexes OK")
+
+
+def test_completed_cubeboxes():
+    """the completed cubeboxes stay sorted and their aggregates up to date, however they are added or modified"""
+    team = CubeTeamStatus(name="Budapest", rfid_uid="1234567890", max_time_sec=3600.0)
+    for cube_id, start_timestamp, win_timestamp in ((4, 320.0, 900.0), (1, 10.0, 300.0), (12, 950.0, 1200.0)):
+        assert team.set_completed_cube(cube_id, start_timestamp, win_timestamp)
+    assert not team.set_completed_cube(1, 10.0, 300.0)
+    boxes = team.completed_cubeboxes
+    assert boxes is team.completed_cubeboxes, "reading the completed cubeboxes made a new list"
+    assert [box.cube_id for box in boxes] == [1, 4, 12] and boxes.cube_ids == {1, 4, 12}
+    assert team.has_completed_cube(4) and not team.has_completed_cube(5) and len(boxes) == 3
+    assert boxes.total_completion_time_sec == sum(box.completion_time_sec for box in boxes)
+    assert [box._prev_cubebox_win_timestamp for box in boxes] == [None, 300.0, 900.0]
+    assert boxes.calculate_score() == sum(box.calculate_box_score() for box in boxes)
+
+    # a box modified in place is put back at its place
+    version = team.version
+    score = team.calculate_team_score()
+    boxes[0].win_timestamp = 1000.0
+    assert team.version > version
+    assert [box.cube_id for box in team.completed_cubeboxes] == [4, 1, 12]
+    assert [box._prev_cubebox_win_timestamp for box in boxes] == [None, 900.0, 1000.0]
+    assert team.calculate_team_score() != score
+    # a box updated from another one too
+    boxes.update_from_cubebox(CompletedCubeboxStatus(cube_id=12, start_timestamp=0.0, win_timestamp=5.0))
+    assert [box.cube_id for box in team.completed_cubeboxes] == [12, 4, 1]
+    # a box which is not completed is not added
+    boxes.update_from_cubebox(CompletedCubeboxStatus(cube_id=2, start_timestamp=0.0))
+    assert boxes.cube_ids == {1, 4, 12}
+    boxes.remove(boxes.get_cubebox_by_cube_id(4))
+    assert boxes.cube_ids == {1, 12} and [box._prev_cubebox_win_timestamp for box in boxes] == [None, 5.0]
+
+    loaded_team = CubeTeamStatus.make_from_json(team.to_json())
+    assert isinstance(loaded_team.completed_cubeboxes, CompletedCubeboxStatusList)
+    assert loaded_team.completed_cubeboxes.cube_ids == {1, 12} and loaded_team == team
+    assert team.copy().completed_cubeboxes.cube_ids == {1, 12}
+    print("test_completed_cubeboxes OK")
+
+
+def make_sample_game_status(nb_teams: int) -> CubeGameStatus:
+    status = CubeGameStatus()
+    for i in range(nb_teams):
+        team = CubeTeamStatus(rfid_uid=f"{1234567890 + i}", name=f"Team{i}", max_time_sec=3600.0,
+                              start_timestamp=time.time() - 600)
+        for cube_id in cubeid.CUBEBOX_IDS[:i % 6]:
+            team.set_completed_cube(cube_id, time.time() - 500 + cube_id * 60, time.time() - 480 + cube_id * 60)
+        status.teams.add_team(team)
+    return status
+
+
+def test_status_snapshot():
+    """the snapshot is made once per version, and matches the status it was made from"""
+    status = make_sample_game_status(20)
+    snapshot = status.snapshot
+    assert status.to_json() is snapshot.json and status.hash == snapshot.hash
+    assert status.snapshot is snapshot, "the snapshot was made again without any change"
+    assert CubeGameStatus.make_from_json(snapshot.json) == status
+    try:
+        snapshot.json = ""
+        assert False, "the snapshot could be modified"
+    except AttributeError:
+        pass
+
+    status.teams.get_team_by_name("Team3").add_trophy_by_name("X")
+    assert status.snapshot is not snapshot and status.hash != snapshot.hash
+    assert CubeGameStatus.make_from_json(status.to_json()) == status
+    assert status.tree_hash == CubeGameStatus.make_from_json(status.to_json()).tree_hash
+
+    # both backends make the same text, hence the same hashes on every node
+    backend_name = cube_utils.CubeJson.backend_name
+    cube_utils.CubeJson.use_default_backend()
+    default_json = CubeGameStatusSnapshot.make_from_status(status).json
+    cube_utils.CubeJson.use_fastest_backend()
+    assert CubeGameStatusSnapshot.make_from_status(status).json == default_json
+    assert cube_utils.CubeJson.backend_name == backend_name
+    print("test_status_snapshot OK")
+
+
+def benchmark_status_snapshot(nb_teams_list: Iterable[int] = (10, 50, 200, 1000), nb_iterations: int = 20):
+    """Compares the cost of a snapshot of the game status made from scratch with the JSON module,
+    with the current JSON backend, and after a change of a single team, for increasing numbers of teams"""
+    log = CubeLogger("benchmark_status_snapshot")
+    log.info(f"JSON backend: {cube_utils.CubeJson.backend_name}")
+    log.info(f"{'nb teams':>8} {'size':>9} {'json.dumps ms':>13} {'from scratch ms':>15} {'one change ms':>13}")
+    for nb_teams in nb_teams_list:
+        status = make_sample_game_status(nb_teams)
+        timings = []
+        start = time.perf_counter()
+        for _ in range(nb_iterations):
+            json.dumps(status.to_dict())
+        timings.append((time.perf_counter() - start) / nb_iterations * 1e3)
+        start = time.perf_counter()
+        for _ in range(nb_iterations):
+            for team in status.teams:
+                team.bump_version()
+            _ = status.snapshot
+        timings.append((time.perf_counter() - start) / nb_iterations * 1e3)
+        start = time.perf_counter()
+        for _ in range(nb_iterations):
+            status.teams[0].bump_version()
+            _ = status.snapshot
+        timings.append((time.perf_counter() - start) / nb_iterations * 1e3)
+        log.info(f"{nb_teams:>8} {len(status.to_json()):>9} "
+                 f"{timings[0]:>13.2f} {timings[1]:>15.2f} {timings[2]:>13.2f}")
+
+
 if __name__ == "__main__":
+    # test_status_delta()
+    # test_hash_tree()
+    # test_versions()
+    # test_status_snapshot()
+    # test_teams_indexes()
+    # test_scoring_engine()
+    # test_completed_cubeboxes()
+    # benchmark_status_snapshot()
     test_custom_name()
     import thecubeivazio.cube_database as cubedb
 
@@ -13,10 +13,14 @@ CUBEFRONTDESK_NODENAME = "CubeFrontdesk"
 CUBEMASTER_NODENAME = "CubeMaster"
 CUBEBOX_NODENAME_PREFIX = "CubeBox"
 EVERYONE_NODENAME = "CubeEveryone"
+# group of all the cubeboxes, used as a message destination
+ALL_CUBEBOXES_NODENAME = "CubeAllBoxes"
 
 NB_CUBEBOXES = 12
 FIRST_CUBEBOX_INDEX = 1
 CUBEBOX_IDS = tuple(range(FIRST_CUBEBOX_INDEX, FIRST_CUBEBOX_INDEX + NB_CUBEBOXES))
+# cube ID meaning "every cubebox", used in the requests sent to ALL_CUBEBOXES_NODENAME
+ALL_CUBEBOXES_CUBE_ID = 0
 CUBEBOXES_NODENAMES = tuple(f"{CUBEBOX_NODENAME_PREFIX}{i}" for i in CUBEBOX_IDS)
 ALL_NODENAMES = (CUBEFRONTDESK_NODENAME, CUBEMASTER_NODENAME) + CUBEBOXES_NODENAMES
 
@@ -48,6 +52,60 @@ def cubebox_index_to_node_name(index: int) -> str:
     return f"{CUBEBOX_NODENAME_PREFIX}{index}"
 
 
+# compact numeric IDs of the nodes, used in the binary wire format (see cube_messages.CubeMsgBinaryCodec).
+# The cubeboxes use their index (1 to 127)
+CUBEMASTER_NODE_ID = 0x80
+CUBEFRONTDESK_NODE_ID = 0x81
+ALL_CUBEBOXES_NODE_ID = 0xFE
+EVERYONE_NODE_ID = 0xFF
+MAX_CUBEBOX_NODE_ID = 0x7F
+
+
+def node_name_to_node_id(name: NodeName) -> Optional[int]:
+    """Returns the numeric ID of a node, or None if the node name is not valid"""
+    if name == CUBEMASTER_NODENAME:
+        return CUBEMASTER_NODE_ID
+    elif name == CUBEFRONTDESK_NODENAME:
+        return CUBEFRONTDESK_NODE_ID
+    elif name == EVERYONE_NODENAME:
+        return EVERYONE_NODE_ID
+    elif name == ALL_CUBEBOXES_NODENAME:
+        return ALL_CUBEBOXES_NODE_ID
+    cubebox_index = node_name_to_cubebox_index(name) if isinstance(name, str) else None
+    # only accept the canonical form of the name, else it could not be rebuilt from the ID
+    if cubebox_index is not None and 0 < cubebox_index <= MAX_CUBEBOX_NODE_ID \
+            and name == cubebox_index_to_node_name(cubebox_index):
+        return cubebox_index
+    return None
+
+
+def node_id_to_node_name(node_id: int) -> Optional[NodeName]:
+    """Returns the name of a node from its numeric ID, or None if the ID is not valid"""
+    if node_id == CUBEMASTER_NODE_ID:
+        return CUBEMASTER_NODENAME
+    elif node_id == CUBEFRONTDESK_NODE_ID:
+        return CUBEFRONTDESK_NODENAME
+    elif node_id == EVERYONE_NODE_ID:
+        return EVERYONE_NODENAME
+    elif node_id == ALL_CUBEBOXES_NODE_ID:
+        return ALL_CUBEBOXES_NODENAME
+    elif 0 < node_id <= MAX_CUBEBOX_NODE_ID:
+        return cubebox_index_to_node_name(node_id)
+    return None
+
+
+def node_ids_addressing(node_name: NodeName) -> frozenset:
+    """Returns the destination IDs of the messages the given node has to handle:
+    its own ID, everyone, and its group if it has one"""
+    node_ids = {EVERYONE_NODE_ID}
+    node_id = node_name_to_node_id(node_name)
+    if node_id is not None:
+        node_ids.add(node_id)
+    if node_name_to_cubebox_index(node_name) is not None:
+        node_ids.add(ALL_CUBEBOXES_NODE_ID)
+    return frozenset(node_ids)
+
+
 def hostname_to_valid_cubebox_name(username: str=None) -> Optional[str]:
     """checks the system username. if there's a number in it,
     returns the corresponding cubebox name, else returns CubeEveryone"""
@@ -1,7 +1,11 @@
 """Defines the messages that are sent by the cubeboxes, the cubeserver, and the frontdesk."""
 import enum
 import json
-from typing import Dict, Type
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Type, Tuple, List
 
 import thecubeivazio.cube_game as cube_game
 import thecubeivazio.cube_identification as cubeid
@@ -62,6 +66,8 @@ class CubeMsgTypes(enum.Enum):
 
     # Messages sent by the CubeMaster besides status messages
     NOTIFY_TEAM_TIME_UP = "NOTIFY_TEAM_TIME_UP"
+    # sent by the cubemaster to the frontdesk: the teams and cubeboxes that changed since the last version it got
+    CUBEMASTER_STATUS_DELTA = "CUBEMASTER_STATUS_DELTA"
 
     # Messages sent by the Frontdesk
     FRONTDESK_NEW_TEAM = "FRONTDESK_NEW_TEAM"
@@ -95,10 +101,16 @@ class CubeAckInfos(enum.Enum):
         return str(self) == str(other)
 
 
+# identifies a message: its sender and its message ID
+# (or its content hash for messages which have not been given an ID)
+CubeMsgKey = Tuple[NodeName, Union[int, Hash]]
+
+
 class CubeMessage:
     """Base class for all messages."""
     SEPARATOR = "|"
     PREFIX = "CUBEMSG"
+    MSG_ID_KEY = "msgid"
 
     def __init__(self, msgtype: CubeMsgTypes = None, sender: str = None, copy_msg: 'CubeMessage' = None, **kwargs):
         if copy_msg is not None:
@@ -108,24 +120,56 @@ class CubeMessage:
         self.sender = sender
         self.sender_ip = None
         self.kwargs = kwargs
+        # sequence number of the message, unique for its sender. Assigned by CubeNetworking when first sent.
+        # A resent message keeps its ID, so that the receiver can recognize it and the ACK can reference it.
+        self.msg_id: Optional[int] = None
+        # node (or group of nodes) the message is meant for, None meaning everyone. Set by CubeNetworking
+        # when sending; receivers drop the binary messages which are not for them without decoding them.
+        self.destination: Optional[NodeName] = None
         # must be manually set to False if no acknowledgement is required
         self.require_ack = True
 
     def __eq__(self, other):
+        if not isinstance(other, CubeMessage):
+            return NotImplemented
+        if self.msg_id is not None and other.msg_id is not None:
+            return self.sender == other.sender and self.msg_id == other.msg_id
         return self.to_string() == other.to_string()
 
+    def __hash__(self):
+        return hash(self.key)
+
+    @property
+    def key(self) -> CubeMsgKey:
+        """Identifies the message: (sender, msg_id), or (sender, hash) if the message has no ID"""
+        if self.msg_id is not None:
+            return self.sender, self.msg_id
+        return self.sender, self.hash
+
     @property
     def hash(self):
         """Returns an alphanumeric hash of the message, using SHA256"""
         import hashlib
         return hashlib.sha256(self.to_string().encode()).hexdigest()
 
+    @property
+    def legacy_hash(self):
+        """Returns the hash that a node which does not know about message IDs computes for this message:
+        it parses 'msgid' as an ordinary field, so it hashes a message with 'msgid' as its first kwarg"""
+        if self.msg_id is None:
+            return self.hash
+        return CubeMessage(self.msgtype, self.sender, **{self.MSG_ID_KEY: self.msg_id, **self.kwargs}).hash
+
     @property
     def shortinfo(self):
+        if self.msg_id is not None:
+            return f"Message [{self.msgtype.name}] ({self.sender}#{self.msg_id})"
         return f"Message [{self.msgtype.name}] ({self.hash})"
 
     def copy(self):
         ret = CubeMessage(self.msgtype, self.sender, **self.kwargs)
+        ret.msg_id = self.msg_id
+        ret.destination = self.destination
         ret.require_ack = self.require_ack
         return ret
 
@@ -135,10 +179,18 @@ class CubeMessage:
 
     def to_string(self):
         sep = self.SEPARATOR
-        return f"{self.PREFIX}{sep}sender={self.sender}{sep}msgtype={self.msgtype.name}{sep}{sep.join([f'{k}={v}' for k, v in self.kwargs.items()])}"
-
-    def to_bytes(self):
-        return self.to_string().encode()
+        msg_id = f"{sep}{self.MSG_ID_KEY}={self.msg_id}" if self.msg_id is not None else ""
+        return f"{self.PREFIX}{sep}sender={self.sender}{sep}msgtype={self.msgtype.name}{msg_id}{sep}{sep.join([f'{k}={v}' for k, v in self.kwargs.items()])}"
+
+    def to_bytes(self, binary: bool = False) -> bytes:
+        """Encodes the message in the text format, or in the binary format if `binary` is True.
+        Messages that cannot be encoded in binary (e.g. unknown sender) fall back to the text format."""
+        if binary and CubeMsgBinaryCodec.can_encode(self):
+            return CubeMsgBinaryCodec.encode(self)
+        data = self.to_string().encode()
+        if isinstance(self.msgtype, CubeMsgTypes):
+            CubeMsgBinaryCodec.size_stats.record(self.msgtype.name, len(data), len(data))
+        return data
 
     # NOTE: DO NOT USE THIS METHOD
     # NOTE: uh, why?
@@ -154,10 +206,16 @@ class CubeMessage:
         self.sender = msg.sender
         self.kwargs = msg.kwargs
         self.sender_ip = msg.sender_ip
+        self.msg_id = msg.msg_id
+        self.destination = msg.destination
         self.require_ack = msg.require_ack
 
     def build_from_bytes(self, msg_bytes: bytes):
-        self.build_from_string(msg_bytes.decode())
+        """Builds the message from bytes in either wire format. The first byte tells which one."""
+        if CubeMsgBinaryCodec.is_binary(msg_bytes):
+            self.build_from_message(CubeMsgBinaryCodec.decode(msg_bytes))
+        else:
+            self.build_from_string(msg_bytes.decode())
 
     @classmethod
     def make_from_string(cls, msg_str: str):
@@ -175,6 +233,7 @@ class CubeMessage:
             return None
         sender = None
         msgtype = None
+        msg_id = None
         kwargs = {}
         # print(parts)
         # print(parts[1:])
@@ -187,15 +246,23 @@ class CubeMessage:
                 sender = value
             elif key == "msgtype":
                 msgtype = value
+            elif key == self.MSG_ID_KEY:
+                msg_id = int(value)
             else:
                 kwargs[key] = value
         if not all([sender, msgtype]):
             return None
         self.build_from_message(CubeMessage(CubeMsgTypes[msgtype], sender, **kwargs))
+        self.msg_id = msg_id
 
     def is_ack_of(self, other: 'CubeMessage'):
         """Returns True if this message is an acknowledgement of the other message."""
-        return self.msgtype == CubeMsgTypes.ACK and self.kwargs.get("acked_hash") == other.hash
+        if self.msgtype != CubeMsgTypes.ACK:
+            return False
+        if "acked_id" in self.kwargs:
+            return other.msg_id is not None and self.kwargs.get("acked_sender") == other.sender \
+                and int(self.kwargs["acked_id"]) == other.msg_id
+        return self.kwargs.get("acked_hash") == other.hash
 
     def __str__(self):
         return self.to_string()
@@ -204,6 +271,272 @@ class CubeMessage:
         return self.to_string()
 
 
+class CubeMsgSizeStats:
+    """Thread-safe per-message-type statistics on the encoded sizes of the messages:
+    raw size (before compression), wire size (what is actually sent),
+    and how many of them fit in a single Ethernet frame."""
+
+    # largest UDP payload that fits in a 1500-byte MTU without IP fragmentation
+    SINGLE_FRAME_SIZE = 1472
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, msgtype_name: str, raw_size: int, wire_size: int):
+        with self._lock:
+            stats = self._stats.setdefault(msgtype_name, {
+                "count": 0, "raw_bytes": 0, "wire_bytes": 0, "max_wire_size": 0,
+                "compressed": 0, "single_frame": 0})
+            stats["count"] += 1
+            stats["raw_bytes"] += raw_size
+            stats["wire_bytes"] += wire_size
+            stats["max_wire_size"] = max(stats["max_wire_size"], wire_size)
+            if wire_size < raw_size:
+                stats["compressed"] += 1
+            if wire_size <= self.SINGLE_FRAME_SIZE:
+                stats["single_frame"] += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def to_dict(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def __str__(self):
+        return f"CubeMsgSizeStats({self.to_dict()})"
+
+    def __repr__(self):
+        return str(self)
+
+
+class CubeMsgBinaryCodec:
+    """Compact binary encoding of CubeMessages, used beside the text encoding.
+    The first byte of a datagram tells its format: text messages start with 'C' (from CubeMessage.PREFIX)
+    and binary messages with their wire version, so that both can be received during a rolling upgrade.
+
+    Layout, in network byte order:
+    - header: wire version (1 byte), destination node ID (1), flags (1), msgtype code (1), sender node ID (1),
+      message ID (4), payload length (4).
+      The destination is at DESTINATION_OFFSET so that receivers can drop the messages which are not for them
+      before decoding anything. Version 1 headers have no destination and are still decoded.
+    - payload: the kwargs, as a msgpack-style map of typed values.
+      Payloads of at least COMPRESSION_THRESHOLD bytes are zlib-compressed if that makes them smaller,
+      which is told by FLAG_COMPRESSED.
+    """
+    WIRE_VERSION = 0x02
+    HEADER_STRUCT = struct.Struct("!BBBBBII")
+    HEADER_SIZE = HEADER_STRUCT.size
+    DESTINATION_OFFSET = 1
+    FLAGS_OFFSET = 2
+    WIRE_VERSION_1 = 0x01
+    HEADER_STRUCT_V1 = struct.Struct("!BBBBII")
+
+    FLAG_HAS_MSG_ID = 0x01
+    FLAG_COMPRESSED = 0x02
+
+    # status replies and configs are large, repetitive JSON strings which compress very well
+    COMPRESSION_THRESHOLD = 512
+    COMPRESSION_LEVEL = 6
+    # protects the receivers against decompression bombs
+    MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+    # sizes of all the messages encoded by this process, in either format
+    size_stats = CubeMsgSizeStats()
+
+    # the code of a message type is its index in this tuple. Only ever append to it.
+    MSGTYPES = (
+        CubeMsgTypes.HEARTBEAT, CubeMsgTypes.ACK, CubeMsgTypes.WHO_IS, CubeMsgTypes.CONFIG, CubeMsgTypes.ALERT,
+        CubeMsgTypes.REQUEST_VISION, CubeMsgTypes.REQUEST_CUBEMASTER_STATUS,
+        CubeMsgTypes.REQUEST_CUBEMASTER_STATUS_HASH, CubeMsgTypes.REQUEST_ALL_CUBEBOXES_STATUSES,
+        CubeMsgTypes.REQUEST_CUBEBOX_STATUS, CubeMsgTypes.REQUEST_TEAM_STATUS,
+        CubeMsgTypes.REQUEST_ALL_TEAMS_STATUSES, CubeMsgTypes.REQUEST_ALL_TEAMS_STATUS_HASHES,
+        CubeMsgTypes.REQUEST_ALL_CUBEBOXES_STATUS_HASHES, CubeMsgTypes.REQUEST_DATABASE_TEAMS,
+        CubeMsgTypes.REPLY_VERSION, CubeMsgTypes.REPLY_CUBEMASTER_STATUS, CubeMsgTypes.REPLY_CUBEMASTER_STATUS_HASH,
+        CubeMsgTypes.REPLY_CUBEBOX_STATUS, CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUSES, CubeMsgTypes.REPLY_TEAM_STATUS,
+        CubeMsgTypes.REPLY_ALL_TEAMS_STATUSES, CubeMsgTypes.REPLY_ALL_TEAMS_STATUS_HASHES,
+        CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUS_HASHES, CubeMsgTypes.REPLY_DATABASE_TEAMS,
+        CubeMsgTypes.ORDER_CUBEBOX_TO_WAIT_FOR_RESET, CubeMsgTypes.ORDER_CUBEBOX_TO_RESET,
+        CubeMsgTypes.ORDER_TEAM_PAUSE, CubeMsgTypes.ORDER_TEAM_RESUME, CubeMsgTypes.ORDER_CUBEBOX_TEAM_BADGE_OUT,
+        CubeMsgTypes.CUBEBOX_RFID_READ, CubeMsgTypes.CUBEBOX_BUTTON_PRESS, CubeMsgTypes.NOTIFY_TEAM_TIME_UP,
+        CubeMsgTypes.FRONTDESK_NEW_TEAM, CubeMsgTypes.FRONTDESK_REMOVE_TEAM, CubeMsgTypes.COMMAND,
+        CubeMsgTypes.CUBEMASTER_STATUS_DELTA,
+    )
+    # indexed by name, as CubeMsgTypes members are not hashable
+    MSGTYPE_TO_CODE: Dict[str, int] = {msgtype.name: code for code, msgtype in enumerate(MSGTYPES)}
+
+    # type tags of the payload values
+    TAG_NONE = 0x00
+    TAG_FALSE = 0x01
+    TAG_TRUE = 0x02
+    TAG_INT = 0x03
+    TAG_FLOAT = 0x04
+    TAG_STR = 0x05
+    TAG_BYTES = 0x06
+
+    _U8 = struct.Struct("!B")
+    _U16 = struct.Struct("!H")
+    _U32 = struct.Struct("!I")
+    _I64 = struct.Struct("!q")
+    _F64 = struct.Struct("!d")
+
+    @classmethod
+    def is_binary(cls, data: bytes) -> bool:
+        return len(data) > 0 and data[0] in (cls.WIRE_VERSION, cls.WIRE_VERSION_1)
+
+    @classmethod
+    def peek_destination_id(cls, data: bytes) -> Optional[int]:
+        """Returns the destination node ID of a binary message without decoding it,
+        or None if the data does not tell (text or version 1 messages)"""
+        if len(data) > cls.DESTINATION_OFFSET and data[0] == cls.WIRE_VERSION:
+            return data[cls.DESTINATION_OFFSET]
+        return None
+
+    @staticmethod
+    def destination_to_node_id(destination: Optional[NodeName]) -> int:
+        """Unknown destinations are sent to everyone, like the text format does"""
+        node_id = cubeid.node_name_to_node_id(destination) if destination else None
+        return cubeid.EVERYONE_NODE_ID if node_id is None else node_id
+
+    @classmethod
+    def can_encode(cls, message: CubeMessage) -> bool:
+        return isinstance(message.msgtype, CubeMsgTypes) and message.msgtype.name in cls.MSGTYPE_TO_CODE \
+            and cubeid.node_name_to_node_id(message.sender) is not None
+
+    @classmethod
+    def encode(cls, message: CubeMessage) -> bytes:
+        payload = cls.pack_kwargs(message.kwargs)
+        raw_size = cls.HEADER_SIZE + len(payload)
+        flags = 0
+        msg_id = 0
+        if message.msg_id is not None:
+            flags |= cls.FLAG_HAS_MSG_ID
+            msg_id = message.msg_id
+        if len(payload) >= cls.COMPRESSION_THRESHOLD:
+            compressed_payload = zlib.compress(payload, cls.COMPRESSION_LEVEL)
+            if len(compressed_payload) < len(payload):
+                flags |= cls.FLAG_COMPRESSED
+                payload = compressed_payload
+        header = cls.HEADER_STRUCT.pack(cls.WIRE_VERSION, cls.destination_to_node_id(message.destination), flags,
+                                        cls.MSGTYPE_TO_CODE[message.msgtype.name],
+                                        cubeid.node_name_to_node_id(message.sender), msg_id, len(payload))
+        cls.size_stats.record(message.msgtype.name, raw_size, cls.HEADER_SIZE + len(payload))
+        return header + payload
+
+    @classmethod
+    def decode(cls, data: bytes) -> CubeMessage:
+        """Builds a CubeMessage from binary data. Raises ValueError if the data is not a valid binary message."""
+        if len(data) > 0 and data[0] == cls.WIRE_VERSION_1:
+            header_size = cls.HEADER_STRUCT_V1.size
+            if len(data) < header_size:
+                raise ValueError(f"Binary message too short: {len(data)} bytes")
+            version, flags, msgtype_code, sender_id, msg_id, payload_length = cls.HEADER_STRUCT_V1.unpack_from(data)
+            destination_id = cubeid.EVERYONE_NODE_ID
+        else:
+            header_size = cls.HEADER_SIZE
+            if len(data) < header_size:
+                raise ValueError(f"Binary message too short: {len(data)} bytes")
+            version, destination_id, flags, msgtype_code, sender_id, msg_id, payload_length = \
+                cls.HEADER_STRUCT.unpack_from(data)
+            if version != cls.WIRE_VERSION:
+                raise ValueError(f"Unsupported wire version: {version}")
+        if msgtype_code >= len(cls.MSGTYPES):
+            raise ValueError(f"Unknown msgtype code: {msgtype_code}")
+        sender = cubeid.node_id_to_node_name(sender_id)
+        if sender is None:
+            raise ValueError(f"Unknown sender ID: {sender_id}")
+        destination = cubeid.node_id_to_node_name(destination_id)
+        if destination is None:
+            raise ValueError(f"Unknown destination ID: {destination_id}")
+        if len(data) != header_size + payload_length:
+            raise ValueError(f"Invalid payload length: {payload_length} for {len(data)} bytes")
+        if flags & cls.FLAG_COMPRESSED:
+            decompressor = zlib.decompressobj()
+            try:
+                payload = decompressor.decompress(data[header_size:], cls.MAX_DECOMPRESSED_SIZE)
+            except zlib.error as e:
+                raise ValueError(f"Invalid compressed payload: {e}")
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError("Compressed payload too large or truncated")
+            kwargs = cls.unpack_kwargs(payload, 0)
+        else:
+            kwargs = cls.unpack_kwargs(data, header_size)
+        message = CubeMessage(cls.MSGTYPES[msgtype_code], sender, **kwargs)
+        if flags & cls.FLAG_HAS_MSG_ID:
+            message.msg_id = msg_id
+        if destination_id != cubeid.EVERYONE_NODE_ID:
+            message.destination = destination
+        return message
+
+    @classmethod
+    def pack_kwargs(cls, kwargs: dict) -> bytes:
+        parts = [cls._U16.pack(len(kwargs))]
+        for key, value in kwargs.items():
+            key_bytes = str(key).encode()
+            parts.append(cls._U16.pack(len(key_bytes)))
+            parts.append(key_bytes)
+            parts.append(cls.pack_value(value))
+        return b"".join(parts)
+
+    @classmethod
+    def unpack_kwargs(cls, data: bytes, offset: int) -> dict:
+        kwargs = {}
+        (nb_items,), offset = cls._U16.unpack_from(data, offset), offset + cls._U16.size
+        for _ in range(nb_items):
+            (key_length,), offset = cls._U16.unpack_from(data, offset), offset + cls._U16.size
+            key = data[offset:offset + key_length].decode()
+            offset += key_length
+            kwargs[key], offset = cls.unpack_value(data, offset)
+        if offset != len(data):
+            raise ValueError(f"Unexpected trailing bytes in payload: {len(data) - offset}")
+        return kwargs
+
+    @classmethod
+    def pack_value(cls, value) -> bytes:
+        """Values which are not None, bool, int, float, str or bytes are sent as their str(),
+        like the text format does"""
+        if value is None:
+            return cls._U8.pack(cls.TAG_NONE)
+        elif value is True:
+            return cls._U8.pack(cls.TAG_TRUE)
+        elif value is False:
+            return cls._U8.pack(cls.TAG_FALSE)
+        elif isinstance(value, int) and not isinstance(value, enum.Enum) and -2 ** 63 <= value < 2 ** 63:
+            return cls._U8.pack(cls.TAG_INT) + cls._I64.pack(value)
+        elif isinstance(value, float):
+            return cls._U8.pack(cls.TAG_FLOAT) + cls._F64.pack(value)
+        elif isinstance(value, bytes):
+            return cls._U8.pack(cls.TAG_BYTES) + cls._U32.pack(len(value)) + value
+        value_bytes = str(value).encode()
+        return cls._U8.pack(cls.TAG_STR) + cls._U32.pack(len(value_bytes)) + value_bytes
+
+    @classmethod
+    def unpack_value(cls, data: bytes, offset: int) -> Tuple[object, int]:
+        """Returns the value and the offset right after it"""
+        tag = data[offset]
+        offset += 1
+        if tag == cls.TAG_NONE:
+            return None, offset
+        elif tag == cls.TAG_TRUE:
+            return True, offset
+        elif tag == cls.TAG_FALSE:
+            return False, offset
+        elif tag == cls.TAG_INT:
+            return cls._I64.unpack_from(data, offset)[0], offset + cls._I64.size
+        elif tag == cls.TAG_FLOAT:
+            return cls._F64.unpack_from(data, offset)[0], offset + cls._F64.size
+        elif tag in (cls.TAG_STR, cls.TAG_BYTES):
+            length = cls._U32.unpack_from(data, offset)[0]
+            offset += cls._U32.size
+            value = data[offset:offset + length]
+            if len(value) != length:
+                raise ValueError("Truncated payload value")
+            return (value.decode() if tag == cls.TAG_STR else bytes(value)), offset + length
+        raise ValueError(f"Unknown payload value tag: {tag}")
+
+
 # messages sent by the Frontdesk besides status messages
 
 class CubeMsgFrontdeskNewTeam(CubeMessage):
@@ -356,19 +689,47 @@ class CubeMsgRequestCubemasterStatus(CubeMessage):
 class CubeMsgReplyCubemasterStatus(CubeMessage):
     """Sent from the CubeMaster to a node in response to a REQUEST_CUBEMASTER_STATUS message."""
 
-    def __init__(self, sender=None, status: cube_game.CubeGameStatus = None, copy_msg: CubeMessage = None):
+    def __init__(self, sender=None, status: cube_game.CubeGameStatus = None, copy_msg: CubeMessage = None,
+                 status_version: int = None):
         if copy_msg is not None:
             super().__init__(copy_msg=copy_msg)
         else:
             super().__init__(CubeMsgTypes.REPLY_CUBEMASTER_STATUS, sender)
             if status:
                 self.kwargs["cubemaster_status"] = status.to_json()
+            if status_version is not None:
+                self.kwargs["status_version"] = status_version
         self.require_ack = False
 
     @property
     def cubemaster_status(self) -> cube_game.CubeGameStatus:
         return cube_game.CubeGameStatus.make_from_json(self.kwargs.get("cubemaster_status"))
 
+    @property
+    def status_version(self) -> Optional[int]:
+        """The version of the status, to which the next CUBEMASTER_STATUS_DELTA messages apply"""
+        version = self.kwargs.get("status_version")
+        return int(version) if version is not None else None
+
+
+class CubeMsgCubemasterStatusDelta(CubeMessage):
+    """Sent from the CubeMaster to the frontdesk with the teams and cubeboxes that changed since
+    the status version the frontdesk last acknowledged. The frontdesk acks with INVALID
+    if it does not have that base version, in which case the CubeMaster sends it the full status."""
+
+    def __init__(self, sender=None, delta: cube_game.CubeGameStatusDelta = None, copy_msg: CubeMessage = None):
+        if copy_msg is not None:
+            super().__init__(copy_msg=copy_msg)
+        else:
+            super().__init__(CubeMsgTypes.CUBEMASTER_STATUS_DELTA, sender)
+            if delta:
+                self.kwargs["delta"] = delta.to_json()
+        self.require_ack = True
+
+    @property
+    def delta(self) -> Optional[cube_game.CubeGameStatusDelta]:
+        return cube_game.CubeGameStatusDelta.make_from_json(self.kwargs.get("delta"))
+
 
 class CubeMsgRequestCubeMasterStatusHash(CubeMessage):
     """Sent from a node to the CubeMaster to ask for its status hash."""
@@ -382,22 +743,31 @@ class CubeMsgRequestCubeMasterStatusHash(CubeMessage):
 class CubeMsgReplyCubeMasterStatusHash(CubeMessage):
     """Sent from the CubeMaster to a node in response to a REQUEST_CUBEMASTER_STATUS_HASH message."""
 
-    def __init__(self, sender=None, hash: Hash = None, copy_msg: CubeMessage = None):
+    def __init__(self, sender=None, hash: Hash = None, copy_msg: CubeMessage = None,
+                 bucket_hashes: Dict[str, Hash] = None):
         if copy_msg is not None:
             super().__init__(copy_msg=copy_msg)
         else:
             super().__init__(CubeMsgTypes.REPLY_CUBEMASTER_STATUS_HASH, sender, hash=hash)
+            if bucket_hashes:
+                self.kwargs["bucket_hashes"] = json.dumps(bucket_hashes)
         self.require_ack = False
 
     @property
     def hash(self) -> str:
         return str(self.kwargs.get("hash"))
 
+    @property
+    def bucket_hashes(self) -> Dict[str, Hash]:
+        """The hashes of the cubeboxes and of the teams, see CubeGameStatus.bucket_hashes"""
+        return json.loads(self.kwargs.get("bucket_hashes") or "{}")
+
 
 # cubebox status request & reply
 
 class CubeMsgRequestCubeboxStatus(CubeMessage):
-    """Sent from the Frontdesk to the CubeMaster to ask for the status of a cubebox."""
+    """Sent from the Frontdesk to the CubeMaster to ask for the status of a cubebox.
+    Can also be sent to the cubeboxes: with cube_id=cubeid.ALL_CUBEBOXES_CUBE_ID, every cubebox replies."""
 
     def __init__(self, sender=None, cube_id=None, copy_msg: CubeMessage = None):
         if copy_msg is not None:
@@ -491,8 +861,8 @@ class CubeMsgReplyAllCubeboxesStatusHashes(CubeMessage):
 
     @property
     def hash_dict(self) -> dict:
-        # parse self.kwargs.get("hashes") to a dict
-        return json.loads(self.kwargs.get("hashes"))
+        # parse self.kwargs.get("hashes") to a dict. An empty dict is not sent at all
+        return json.loads(self.kwargs.get("hashes") or "{}")
 
 
 class CubeMsgRequestDatabaseTeams(CubeMessage):
@@ -616,8 +986,8 @@ class CubeMsgReplyAllTeamsStatusHashes(CubeMessage):
 
     @property
     def hash_dict(self) -> dict:
-        # parse self.kwargs.get("hashes") to a dict
-        return json.loads(self.kwargs.get("hashes"))
+        # parse self.kwargs.get("hashes") to a dict. An empty dict is not sent at all
+        return json.loads(self.kwargs.get("hashes") or "{}")
 
 
 class CubeMsgRequestAllTeamsStatuses(CubeMessage):
@@ -742,13 +1112,30 @@ class CubeMsgAck(CubeMessage):
         if copy_msg is not None:
             super().__init__(copy_msg=copy_msg)
         else:
-            super().__init__(msgtype=CubeMsgTypes.ACK, sender=sender, acked_hash=acked_msg.hash, ack_info=ack_info)
+            if acked_msg.msg_id is not None:
+                super().__init__(msgtype=CubeMsgTypes.ACK, sender=sender, acked_sender=acked_msg.sender,
+                                 acked_id=acked_msg.msg_id, ack_info=ack_info)
+            else:
+                # the acked message comes from a node which does not give IDs to its messages
+                super().__init__(msgtype=CubeMsgTypes.ACK, sender=sender, acked_hash=acked_msg.hash, ack_info=ack_info)
         self.require_ack = False
 
     @property
     def ack_info(self) -> CubeAckInfos:
         return self.kwargs.get("ack_info", CubeAckInfos.NONE)
 
+    @property
+    def acked_hash(self) -> Optional[Hash]:
+        return self.kwargs.get("acked_hash")
+
+    @property
+    def acked_key(self) -> CubeMsgKey:
+        """The key of the acknowledged message. See CubeMessage.key.
+        For ACKs referencing a content hash, the sender of the acked message is unknown and set to None"""
+        if "acked_id" in self.kwargs:
+            return self.kwargs.get("acked_sender"), int(self.kwargs["acked_id"])
+        return None, self.acked_hash
+
 
 class CubeMsgHeartbeat(CubeMessage):
     """Sent from a node to everyone to signal its presence."""
@@ -1146,7 +1533,182 @@ def test_request_database_teams():
     print("test_request_database_teams PASSED")
     exit(0)
 
+def test_message_ids():
+    msg = CubeMsgButtonPress("CubeBox1", start_timestamp=10, press_timestamp=20)
+    msg.msg_id = 42
+    msg2 = CubeMessage.make_from_string(msg.to_string())
+    assert msg2.msg_id == 42
+    assert msg2 == msg
+    assert msg2.key == ("CubeBox1", 42)
+    assert CubeMsgButtonPress(copy_msg=msg2).msg_id == 42
+    # same content, different ID: not the same message
+    msg3 = CubeMsgButtonPress("CubeBox1", start_timestamp=10, press_timestamp=20)
+    msg3.msg_id = 43
+    assert msg3 != msg
+    assert len({msg, msg2, msg3}) == 2
+    # the ACK references the ID
+    ack = CubeMsgAck("CubeMaster", msg2, ack_info=CubeAckInfos.OK)
+    ack2 = CubeMsgAck(copy_msg=CubeMessage.make_from_string(ack.to_string()))
+    assert ack2.acked_key == msg.key
+    assert ack2.is_ack_of(msg)
+    assert not ack2.is_ack_of(msg3)
+    # messages without an ID are still acknowledged by hash
+    msg4 = CubeMsgButtonPress("CubeBox1", start_timestamp=10, press_timestamp=20)
+    ack4 = CubeMsgAck("CubeMaster", msg4, ack_info=CubeAckInfos.OK)
+    assert ack4.is_ack_of(msg4)
+    assert ack4.acked_key == (None, msg4.hash)
+    # a node which does not know about IDs parses msgid as an ordinary field and acks by hash
+    for sent in (msg, CubeMsgHeartbeat("CubeBox1")):
+        sent.msg_id = 44
+        parts = [part.split("=") for part in sent.to_string().split(CubeMessage.SEPARATOR)[3:] if part]
+        old_view = CubeMessage(sent.msgtype, sent.sender, **dict(parts))
+        assert old_view.msg_id is None and old_view.kwargs[CubeMessage.MSG_ID_KEY] == "44"
+        assert old_view.hash == sent.legacy_hash
+        assert CubeMsgAck("CubeMaster", old_view).acked_key == (None, sent.legacy_hash)
+    print("test_message_ids PASSED")
+
+def make_sample_messages() -> List[CubeMessage]:
+    """Returns one sample message of each CubeMessage subclass, with realistic contents and valid senders"""
+    fd = cubeid.CUBEFRONTDESK_NODENAME
+    master = cubeid.CUBEMASTER_NODENAME
+    box = cubeid.cubebox_index_to_node_name(1)
+    teams = cube_game.generate_sample_teams()
+    team = teams[0]
+    cubebox = cube_game.CubeboxStatus(cube_id=1, current_team_name=team.name, start_timestamp=11,
+                                      last_valid_rfid_line=cube_rfid.CubeRfidLine(uid=team.rfid_uid, timestamp=10),
+                                      state=cube_game.CubeboxState.STATE_PLAYING)
+    cubeboxes = cube_game.CubeboxesStatusList()
+    game_status = cube_game.CubeGameStatus(cubeboxes=cubeboxes, teams=teams)
+    factories = [
+        lambda: CubeMsgFrontdeskNewTeam(fd, team),
+        lambda: CubeMsgFrontdeskDeleteTeam(fd, team_name=team.name),
+        lambda: CubeMsgButtonPress(box, start_timestamp=10.5, press_timestamp=20.25),
+        lambda: CubeMsgRfidRead(box, uid=team.rfid_uid, timestamp=10.5),
+        lambda: CubeMsgRequestVersion(fd),
+        lambda: CubeMsgReplyVersion(master),
+        lambda: CubeMsgRequestCubemasterStatus(fd),
+        lambda: CubeMsgReplyCubemasterStatus(master, game_status),
+        lambda: CubeMsgRequestCubeMasterStatusHash(fd),
+        lambda: CubeMsgReplyCubeMasterStatusHash(master, hash=game_status.hash),
+        lambda: CubeMsgRequestCubeboxStatus(fd, cube_id=1),
+        lambda: CubeMsgReplyCubeboxStatus(box, cubebox),
+        lambda: CubeMsgRequestAllCubeboxesStatuses(fd),
+        lambda: CubeMsgReplyAllCubeboxesStatuses(master, cubeboxes),
+        lambda: CubeMsgRequestAllCubeboxesStatusHashes(fd),
+        lambda: CubeMsgReplyAllCubeboxesStatusHashes(master, hashes=cubeboxes.hash_dict),
+        lambda: CubeMsgRequestDatabaseTeams(master, oldest_timestamp=10),
+        lambda: CubeMsgReplyDatabaseTeams(fd, team=team),
+        lambda: CubeMsgRequestTeamStatus(fd, team_name=team.name),
+        lambda: CubeMsgReplyTeamStatus(master, team_status=team),
+        lambda: CubeMsgRequestAllTeamsStatusHashes(fd),
+        lambda: CubeMsgReplyAllTeamsStatusHashes(master, hashes=teams.hash_dict),
+        lambda: CubeMsgRequestAllTeamsStatuses(fd),
+        lambda: CubeMsgReplyAllTeamsStatuses(master, statuses=teams),
+        lambda: CubeMsgOrderCubeboxToWaitForReset(master, cube_id=1),
+        lambda: CubeMsgOrderCubeboxToReset(master, cube_id=1),
+        lambda: CubeMsgOrderTeamPause(fd, team_name=team.name),
+        lambda: CubeMsgOrderTeamResume(fd, team_name=team.name),
+        lambda: CubeMsgOrderCubeboxTeamBadgeOut(master, team_name=team.name, cube_id=1),
+        lambda: CubeMsgAck(master, CubeMsgButtonPress(box, start_timestamp=10.5, press_timestamp=20.25),
+                           ack_info=CubeAckInfos.OK),
+        lambda: CubeMsgHeartbeat(box),
+        lambda: CubeMsgWhoIs(fd, node_name_to_find=master),
+        lambda: CubeMsgConfig(fd, config=CubeConfig.get_config()),
+        lambda: CubeMsgCommand(fd, full_command=f"{master} reset"),
+        lambda: CubeMsgAlert(box, alert="Test alert"),
+        lambda: CubeMsgNotifyTeamTimeUp(master, team_name=team.name),
+    ]
+    messages = []
+    for msg_id, factory in enumerate(factories):
+        # noinspection PyBroadException
+        try:
+            msg = factory()
+        except Exception as e:
+            CubeLogger.static_error(f"make_sample_messages: could not build a sample message: {e}")
+            continue
+        msg.msg_id = msg_id
+        messages.append(msg)
+    return messages
+
+
+def test_binary_codec():
+    """for each message class, test that the binary encoding gives back the same message as the text encoding"""
+    for msg in make_sample_messages():
+        classname = type(msg).__name__
+        data = msg.to_bytes(binary=True)
+        assert CubeMsgBinaryCodec.is_binary(data), classname
+        msg2 = CubeMessage()
+        msg2.build_from_bytes(data)
+        assert msg2.msg_id == msg.msg_id, classname
+        assert msg2.to_string() == msg.to_string(), f"{classname}: {msg2.to_string()} != {msg.to_string()}"
+        # the text encoding is still understood
+        msg3 = CubeMessage()
+        msg3.build_from_bytes(msg.to_bytes())
+        assert msg3.to_string() == msg.to_string(), classname
+    # the binary format does not care about separators in the values
+    msg = CubeMsgFrontdeskDeleteTeam(cubeid.CUBEFRONTDESK_NODENAME, team_name="a|b=c")
+    msg2 = CubeMessage()
+    msg2.build_from_bytes(msg.to_bytes(binary=True))
+    assert CubeMsgFrontdeskDeleteTeam(copy_msg=msg2).team_name == "a|b=c"
+    # unknown senders fall back to the text format
+    assert not CubeMsgBinaryCodec.is_binary(CubeMsgHeartbeat("NotANode").to_bytes(binary=True))
+    # large payloads are compressed, small ones are not
+    msg = CubeMsgAlert(cubeid.CUBEMASTER_NODENAME, alert="status " * 500)
+    data = msg.to_bytes(binary=True)
+    assert data[CubeMsgBinaryCodec.FLAGS_OFFSET] & CubeMsgBinaryCodec.FLAG_COMPRESSED and len(data) < 500
+    msg2 = CubeMessage()
+    msg2.build_from_bytes(data)
+    assert msg2.to_string() == msg.to_string()
+    assert not CubeMsgHeartbeat(cubeid.CUBEMASTER_NODENAME).to_bytes(binary=True)[CubeMsgBinaryCodec.FLAGS_OFFSET] \
+               & CubeMsgBinaryCodec.FLAG_COMPRESSED
+    assert CubeMsgBinaryCodec.size_stats.to_dict()[CubeMsgTypes.ALERT.name]["compressed"] > 0
+    # the destination can be read without decoding the message
+    msg = CubeMsgHeartbeat(cubeid.CUBEMASTER_NODENAME)
+    msg.destination = cubeid.cubebox_index_to_node_name(3)
+    data = msg.to_bytes(binary=True)
+    assert CubeMsgBinaryCodec.peek_destination_id(data) == 3
+    msg2 = CubeMessage()
+    msg2.build_from_bytes(data)
+    assert msg2.destination == msg.destination
+    # version 1 messages, which have no destination, are still understood
+    data_v1 = CubeMsgBinaryCodec.HEADER_STRUCT_V1.pack(
+        CubeMsgBinaryCodec.WIRE_VERSION_1, *CubeMsgBinaryCodec.HEADER_STRUCT.unpack_from(data)[2:]) \
+              + data[CubeMsgBinaryCodec.HEADER_SIZE:]
+    assert CubeMsgBinaryCodec.peek_destination_id(data_v1) is None
+    msg2.build_from_bytes(data_v1)
+    assert msg2.destination is None and msg2.msgtype == CubeMsgTypes.HEARTBEAT
+    print("test_binary_codec PASSED")
+
+
+def benchmark_codecs(nb_iterations: int = 1000):
+    """Compares the encoding and decoding times of the text and binary formats for each message class"""
+    log = CubeLogger("benchmark_codecs")
+    log.info(f"{'message class':<40} {'text size':>9} {'bin size':>9} "
+             f"{'text enc us':>11} {'bin enc us':>10} {'text dec us':>11} {'bin dec us':>10}")
+    for msg in make_sample_messages():
+        text_bytes = msg.to_bytes()
+        binary_bytes = msg.to_bytes(binary=True)
+        timings = []
+        for encode in (lambda: msg.to_bytes(), lambda: msg.to_bytes(binary=True)):
+            start = time.perf_counter()
+            for _ in range(nb_iterations):
+                encode()
+            timings.append((time.perf_counter() - start) / nb_iterations * 1e6)
+        for data in (text_bytes, binary_bytes):
+            start = time.perf_counter()
+            for _ in range(nb_iterations):
+                CubeMessage().build_from_bytes(data)
+            timings.append((time.perf_counter() - start) / nb_iterations * 1e6)
+        log.info(f"{type(msg).__name__:<40} {len(text_bytes):>9} {len(binary_bytes):>9} "
+                 f"{timings[0]:>11.1f} {timings[1]:>10.1f} {timings[2]:>11.1f} {timings[3]:>10.1f}")
+    # the encodings done by the benchmark are not representative of the real traffic
+    CubeMsgBinaryCodec.size_stats.reset()
+
+
 if __name__ == "__main__":
+    test_message_ids()
+    test_binary_codec()
+    # benchmark_codecs()
     test_request_database_teams()
     # test_config_message()
     test_all_message_classes_to_and_from_string()
@@ -1,10 +1,18 @@
 """Handles everything related to networking communications"""
+import errno
+import random
+import select
 import socket
+import struct
+import sys
 import threading
 import time
-from collections import deque
-from typing import Deque, Tuple, Dict
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Deque, Tuple, Dict, List, Callable, Iterable, Iterator
 
+import thecubeivazio.cube_game as cube_game
 import thecubeivazio.cube_identification as cubeid
 import thecubeivazio.cube_logger as cube_logger
 import thecubeivazio.cube_messages as cm
@@ -63,12 +71,361 @@ class SendReport:
         return str(self)
 
 
+class CubeScatterGatherReport:
+    """Result of CubeNetworking.scatter_gather(): the replies, indexed by sender,
+    and the nodes which did not reply before the deadline"""
+
+    def __init__(self, sent_ok: bool, replies: Dict[NodeName, cm.CubeMessage] = None,
+                 missing_nodes: List[NodeName] = None, elapsed: Seconds = 0.0):
+        self.sent_ok = sent_ok
+        self.replies = replies or {}
+        self.missing_nodes = missing_nodes or []
+        self.elapsed = elapsed
+
+    @property
+    def all_replied(self) -> bool:
+        return self.sent_ok and not self.missing_nodes
+
+    def __bool__(self):
+        """True if the request was sent and every expected node replied"""
+        return self.all_replied
+
+    def __str__(self):
+        return (f"CubeScatterGatherReport(sent_ok={self.sent_ok}, replied={sorted(self.replies)}, "
+                f"missing={self.missing_nodes}, elapsed={self.elapsed:.3f})")
+
+    def __repr__(self):
+        return str(self)
+
+
+class CubePendingAck:
+    """An acknowledgement we're waiting for.
+    The listen thread completes it as soon as a matching ACK arrives, which wakes up the waiting thread."""
+
+    def __init__(self, acked_key: cm.CubeMsgKey, ack_sender: NodeName = None, legacy_key: cm.CubeMsgKey = None):
+        self.acked_key = acked_key
+        # key under which a node that does not know about message IDs acknowledges the message (by content hash)
+        self.legacy_key = legacy_key
+        # if set, only an ACK from this node will complete this pending ACK
+        self.ack_sender = ack_sender
+        self.ack_msg: Optional[cm.CubeMsgAck] = None
+        self.completion_timestamp: Optional[Timestamp] = None
+        self._event = threading.Event()
+
+    @property
+    def keys(self) -> Tuple[cm.CubeMsgKey, ...]:
+        """The keys an ACK of the message can reference"""
+        if self.legacy_key is None or self.legacy_key == self.acked_key:
+            return self.acked_key,
+        return self.acked_key, self.legacy_key
+
+    def matches(self, ack_msg: cm.CubeMessage) -> bool:
+        return self.ack_sender is None or ack_msg.sender == self.ack_sender
+
+    def complete(self, ack_msg: cm.CubeMsgAck):
+        self.ack_msg = ack_msg
+        self.completion_timestamp = time.time()
+        self._event.set()
+
+    def is_complete(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: Optional[Seconds]) -> Optional[cm.CubeMsgAck]:
+        """Waits for the ACK. Returns the ACK message if it arrived, None otherwise."""
+        self._event.wait(timeout)
+        return self.ack_msg
+
+
+class CubeMsgSubscription:
+    """A consumer of the incoming messages of some types.
+    While it is open, the messages of these types which it accepts are delivered to it instead of the incoming queue.
+    Use it as a context manager, so that it is closed when done."""
+
+    def __init__(self, net: 'CubeNetworking', msgtype_names: Tuple[str, ...],
+                 accept: Callable[[cm.CubeMessage], bool] = None):
+        self._net = net
+        self.msgtype_names = msgtype_names
+        # if set, only the messages for which it returns True are delivered (e.g. the replies to our own request)
+        self.accept = accept
+        self._messages: Deque[cm.CubeMessage] = deque()
+        self._condition = threading.Condition()
+        self.is_open = True
+
+    def accepts(self, message: cm.CubeMessage) -> bool:
+        if self.accept is None:
+            return True
+        try:
+            return bool(self.accept(message))
+        except Exception as e:
+            self._net.log.error(f"Subscription filter failed on ({message.shortinfo}): {e}")
+            return False
+
+    def put(self, message: cm.CubeMessage) -> bool:
+        """Returns False if the subscription was closed meanwhile"""
+        with self._condition:
+            if not self.is_open:
+                return False
+            self._messages.append(message)
+            self._condition.notify()
+            return True
+
+    def get(self, timeout: Optional[Seconds] = None) -> Optional[cm.CubeMessage]:
+        """Returns the oldest delivered message, waiting for one if needed.
+        Returns None if nothing arrived within the timeout, or if the subscription was closed."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._messages or not self.is_open, timeout):
+                return None
+            message = self._messages.popleft() if self._messages else None
+        if message is not None:
+            self._net.release_subscribed_msg(message, consumed=True)
+        return message
+
+    def close(self):
+        """Stops the delivery. A message which was delivered but not consumed goes back to the incoming queue,
+        unless another subscription consumed it or still holds it."""
+        self._net.unsubscribe(self)
+        with self._condition:
+            self.is_open = False
+            leftovers = tuple(self._messages)
+            self._messages.clear()
+            self._condition.notify_all()
+        for message in leftovers:
+            self._net.release_subscribed_msg(message, consumed=False)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._messages)
+
+    def __enter__(self) -> 'CubeMsgSubscription':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CubeRetryEntry:
+    """A message which could not be delivered, waiting to be sent again by the retry scheduler"""
+
+    def __init__(self, message: cm.CubeMessage, ip: Optional[str], port: Optional[int], ttl: Seconds):
+        self.message = message
+        self.ip = ip
+        self.port = port
+        self.queued_timestamp = time.time()
+        self.expiration_timestamp = self.queued_timestamp + ttl
+        self.next_retry_timestamp = self.queued_timestamp
+        self.nb_retries = 0
+        # set while a retry is being sent, so that the entry is neither retried twice nor coalesced
+        self.in_flight = False
+
+    @property
+    def destination(self) -> NodeName:
+        return self.message.destination or cubeid.EVERYONE_NODENAME
+
+    def is_expired(self, now: Timestamp) -> bool:
+        return now > self.expiration_timestamp
+
+    def age(self, now: Timestamp) -> Seconds:
+        return now - self.queued_timestamp
+
+
+class CubeRttEstimator:
+    """Estimates the round-trip time to a peer and derives the retransmission timeout (RTO)
+    the same way TCP does (RFC 6298): smoothed RTT, RTT variance, and exponential backoff on timeouts."""
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto: Seconds, min_rto: Seconds, max_rto: Seconds):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt: Optional[Seconds] = None
+        self.rttvar: Optional[Seconds] = None
+        self.rto: Seconds = min(max(initial_rto, min_rto), max_rto)
+        self.nb_samples = 0
+        self.nb_backoffs = 0
+        self._lock = threading.Lock()
+
+    def add_sample(self, rtt: Seconds):
+        """Updates the estimation with the RTT of a message which was not retransmitted (Karn's rule)"""
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+            self.nb_samples += 1
+            self.rto = min(max(self.srtt + self.K * self.rttvar, self.min_rto), self.max_rto)
+
+    def back_off(self) -> Seconds:
+        """Doubles the RTO after a timeout. Returns the new RTO."""
+        with self._lock:
+            self.rto = min(self.rto * 2, self.max_rto)
+            self.nb_backoffs += 1
+            return self.rto
+
+    def to_dict(self) -> Dict[str, Union[Seconds, int, None]]:
+        with self._lock:
+            return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto,
+                    "nb_samples": self.nb_samples, "nb_backoffs": self.nb_backoffs}
+
+    def __str__(self):
+        return f"CubeRttEstimator({self.to_dict()})"
+
+    def __repr__(self):
+        return str(self)
+
+
+class CubeNetStats:
+    """Thread-safe counters describing what happened in the networking receive path,
+    e.g. how many packets were received, truncated or dropped by the kernel."""
+
+    def __init__(self):
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_max(self, name: str, value: int):
+        """Keeps the highest value ever given for this counter"""
+        with self._lock:
+            if value > self._counters.get(name, 0):
+                self._counters[name] = value
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+    def to_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def __str__(self):
+        return f"CubeNetStats({self.to_dict()})"
+
+    def __repr__(self):
+        return str(self)
+
+
+class CubeNetFragments:
+    """Application-level fragmentation of the datagrams too large to be sent in one Ethernet frame.
+
+    A fragment datagram starts with FRAGMENT_MARKER, a NACK (request to resend some fragments) with NACK_MARKER.
+    Neither can be confused with a message datagram, which starts with 'C' (text) or the binary wire version.
+    Layout, in network byte order: marker (1 byte), destination node ID (1), length of the sender's node name (1),
+    transfer ID (4), fragment index (2), fragments count (2), the sender's node name, then:
+    - for a fragment: the chunk of the original datagram
+    - for a NACK: the indexes of the missing fragments (2 bytes each), `count` being their number.
+      The node name is the one of the node which sent the fragments, so that only it answers.
+    """
+    FRAGMENT_MARKER = 0xF0
+    NACK_MARKER = 0xF1
+    HEADER_STRUCT = struct.Struct("!BBBIHH")
+    # same offset as in binary messages
+    DESTINATION_OFFSET = 1
+    INDEX_STRUCT = struct.Struct("!H")
+
+    @classmethod
+    def is_fragment_or_nack(cls, data: bytes) -> bool:
+        return len(data) > 0 and data[0] in (cls.FRAGMENT_MARKER, cls.NACK_MARKER)
+
+    @classmethod
+    def split(cls, data: bytes, sender: NodeName, destination_id: int, transfer_id: int,
+              chunk_size: int) -> List[bytes]:
+        """Splits a datagram into fragment datagrams carrying at most chunk_size bytes of it"""
+        sender_bytes = sender.encode()
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        return [cls.HEADER_STRUCT.pack(cls.FRAGMENT_MARKER, destination_id, len(sender_bytes), transfer_id,
+                                       index, len(chunks))
+                + sender_bytes + chunk
+                for index, chunk in enumerate(chunks)]
+
+    @classmethod
+    def make_nack(cls, sender: NodeName, transfer_id: int, missing_indexes: List[int]) -> bytes:
+        sender_bytes = sender.encode()
+        destination_id = cm.CubeMsgBinaryCodec.destination_to_node_id(sender)
+        return cls.HEADER_STRUCT.pack(cls.NACK_MARKER, destination_id, len(sender_bytes), transfer_id,
+                                      0, len(missing_indexes)) \
+            + sender_bytes + b"".join(cls.INDEX_STRUCT.pack(index) for index in missing_indexes)
+
+    @classmethod
+    def parse(cls, data: bytes) -> Tuple[int, NodeName, int, int, int, bytes]:
+        """Returns (marker, sender, transfer_id, index, count, body). Raises ValueError if the data is invalid."""
+        if len(data) < cls.HEADER_STRUCT.size:
+            raise ValueError(f"Fragment too short: {len(data)} bytes")
+        marker, _, sender_length, transfer_id, index, count = cls.HEADER_STRUCT.unpack_from(data)
+        body_offset = cls.HEADER_STRUCT.size + sender_length
+        if len(data) < body_offset:
+            raise ValueError("Truncated fragment header")
+        sender = data[cls.HEADER_STRUCT.size:body_offset].decode()
+        body = data[body_offset:]
+        if marker == cls.FRAGMENT_MARKER:
+            if count == 0 or index >= count:
+                raise ValueError(f"Invalid fragment index: {index}/{count}")
+        elif marker == cls.NACK_MARKER:
+            if len(body) != count * cls.INDEX_STRUCT.size:
+                raise ValueError(f"Invalid NACK length: {len(body)} bytes for {count} indexes")
+        else:
+            raise ValueError(f"Not a fragment: {marker}")
+        return marker, sender, transfer_id, index, count, body
+
+    @classmethod
+    def parse_nack_indexes(cls, body: bytes) -> List[int]:
+        return [index for (index,) in cls.INDEX_STRUCT.iter_unpack(body)]
+
+
+class CubePartialMessage:
+    """The fragments received so far of a fragmented datagram"""
+
+    def __init__(self, count: int, addr: Tuple[str, int]):
+        self.count = count
+        self.addr = addr
+        self.chunks: Dict[int, bytes] = {}
+        self.nb_bytes = 0
+        self.first_timestamp = time.time()
+        # last time we received a fragment or sent a NACK for it
+        self.last_activity_timestamp = self.first_timestamp
+        self.nb_nacks = 0
+
+    def add_chunk(self, index: int, chunk: bytes) -> int:
+        """Returns the number of bytes added"""
+        if index in self.chunks:
+            return 0
+        self.chunks[index] = chunk
+        self.nb_bytes += len(chunk)
+        self.last_activity_timestamp = time.time()
+        return len(chunk)
+
+    def is_complete(self) -> bool:
+        return len(self.chunks) == self.count
+
+    def missing_indexes(self) -> List[int]:
+        return [index for index in range(self.count) if index not in self.chunks]
+
+    def assemble(self) -> bytes:
+        return b"".join(self.chunks[index] for index in range(self.count))
+
+
 class CubeNetworking:
     UDP_BROADCAST_IP = "192.168.1.255"
     UDP_LISTEN_IP = "0.0.0.0"
     UDP_PORT = 5005
     UDP_BUFSIZE = 9001 # let's set it over 9000 to be safe
     UDP_LISTEN_TIMEOUT = 0.1  # seconds
+    # size requested for the kernel receive buffer. A large buffer absorbs the bursts
+    # of status broadcasts and ACKs sent by all the cubeboxes at the same time.
+    # Set to None to keep the OS default.
+    UDP_RCVBUF_SIZE = 1024 * 1024
+    # maximum number of datagrams handled in one go once the socket becomes readable
+    UDP_MAX_BURST_SIZE = 256
+    # Linux only: ask the kernel for the number of datagrams it dropped because the receive buffer was full
+    SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
 
     DISCOVERY_PORT = UDP_PORT
     DISCOVERY_LOOP_TIMEOUT = 2  # seconds
@@ -78,9 +435,134 @@ class CubeNetworking:
     # if this is True, the networking will only use broadcasting. This is useful for testing on a single machine
     ONLY_USE_BROADCAST = True
 
+    # if this is True, messages are sent to the multicast group of their destination instead of being broadcast,
+    # and each node only joins the groups it has to listen to: its own, its role's (e.g. all the cubeboxes)
+    # and everyone's. The NIC and the kernel then filter out the other messages.
+    # If the groups cannot be joined or sent to, the networking falls back to broadcasting,
+    # and tries multicast again every MULTICAST_REJOIN_PERIOD.
+    USE_MULTICAST = True
+    MULTICAST_REJOIN_PERIOD = 30  # seconds
+    # retransmissions are broadcast, in case the peer could not join its group. A peer which only acknowledges
+    # the broadcast retransmissions is then sent its messages by broadcast for MULTICAST_PEER_FALLBACK_TTL.
+    MULTICAST_PEER_FALLBACK_TTL = 60  # seconds
+    # the group of a destination is MULTICAST_GROUP_PREFIX.<destination node ID> (see cube_identification)
+    MULTICAST_GROUP_PREFIX = "239.255.77"
+    MULTICAST_TTL = 1
+    # IP of the interface used for multicast. None lets the OS choose. Set it to 127.0.0.1 to simulate on one machine.
+    MULTICAST_INTERFACE_IP: Optional[str] = None
+    # Linux only: do not receive the datagrams of groups joined by other sockets of the same machine,
+    # so that several nodes simulated on one machine only get their own groups' messages
+    IP_MULTICAST_ALL = getattr(socket, "IP_MULTICAST_ALL", 49)
+
+    # preferred wire format of the sent messages. Incoming messages are accepted in both formats.
+    # The binary format is only sent to the peers known to read it (see _record_peer_wire_format),
+    # so that the nodes running an older version keep getting text during a rolling upgrade
+    WIRE_FORMAT_TEXT = "text"
+    WIRE_FORMAT_BINARY = "binary"
+    WIRE_FORMAT = WIRE_FORMAT_BINARY
+
     ACK_WAIT_TIMEOUT = 2  # seconds
+    # the time we wait for an ACK before retransmitting adapts to the measured round-trip time of each peer,
+    # within these bounds. Since the ACK is sent once the message has been handled, the RTT includes the
+    # handling time, hence the floor. ACK_WAIT_TIMEOUT is used until a peer's RTT has been measured.
+    # Only the retransmissions follow the RTT: a sender still waits ACK_WAIT_TIMEOUT * nb_tries in total
+    # before giving up, so that a handler which is sometimes slower (DB write, lock) is not reported as no ACK.
+    ADAPTIVE_ACK_TIMEOUT = True
+    MIN_ACK_TIMEOUT = 0.05  # seconds
+    MAX_ACK_TIMEOUT = ACK_WAIT_TIMEOUT
+    # message IDs are unsigned 32-bit sequence numbers
+    MSG_ID_MASK = 0xFFFFFFFF
+    # ACKs nobody was waiting for are kept this long, in case the waiter registers after the ACK arrived
+    UNCLAIMED_ACK_TTL = ACK_WAIT_TIMEOUT
+    UNCLAIMED_ACKS_MAXLEN = 128
     # TODO: set this to a ridiculously high number for production
     ACK_NB_TRIES = 3
+    # number of background threads performing the sends (and their retransmissions) issued with the *_async methods
+    ASYNC_SEND_WORKERS = 4
+
+    # messages which could not be delivered are retried in the background, with an exponential backoff
+    # (RETRY_BASE_DELAY * 2^n, up to RETRY_MAX_DELAY, with jitter) until they're RETRY_TTL old.
+    # The messages to a destination are retried in order, one at a time.
+    RETRY_BASE_DELAY = 0.5  # seconds
+    RETRY_MAX_DELAY = 30.0  # seconds
+    RETRY_TTL = 120.0  # seconds
+    RETRY_QUEUE_MAXLEN = 64  # per destination
+    RETRY_SEND_WORKERS = 2
+    # only the latest message of these types to a given destination is worth retrying:
+    # a newer one supersedes the older ones
+    COALESCABLE_MSGTYPES = (
+        cm.CubeMsgTypes.HEARTBEAT.name, cm.CubeMsgTypes.CONFIG.name, cm.CubeMsgTypes.REPLY_VERSION.name,
+        cm.CubeMsgTypes.REPLY_CUBEMASTER_STATUS.name, cm.CubeMsgTypes.REPLY_CUBEMASTER_STATUS_HASH.name,
+        cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS.name, cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUSES.name,
+        cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUS_HASHES.name, cm.CubeMsgTypes.REPLY_ALL_TEAMS_STATUSES.name,
+        cm.CubeMsgTypes.REPLY_ALL_TEAMS_STATUS_HASHES.name,
+        # until one is acknowledged, the deltas all start from the same version, each one including the previous
+        cm.CubeMsgTypes.CUBEMASTER_STATUS_DELTA.name,
+    )
+
+    # messages which are never retried later: their sender reports the failure to the players right away
+    # (error sound), so a late delivery would contradict it, e.g. register a team to a box that rejected it
+    NOT_RETRIED_MSGTYPES = (
+        cm.CubeMsgTypes.CUBEBOX_RFID_READ.name, cm.CubeMsgTypes.CUBEBOX_BUTTON_PRESS.name,
+    )
+
+    # the incoming messages are queued in lanes, and the consumers always get the messages of a lane
+    # before those of the next one, so that the players' actions never wait behind bulk synchronization traffic.
+    # Messages are only kept in order within a lane: those which depend on each other must share a lane.
+    LANE_REALTIME = "realtime"
+    LANE_CONTROL = "control"
+    LANE_BULK = "bulk"
+    INCOMING_LANES = (LANE_REALTIME, LANE_CONTROL, LANE_BULK)
+    # lane of each message type, by name. The types not listed here go to the control lane.
+    MSGTYPE_LANES: Dict[str, str] = {
+        cm.CubeMsgTypes.CUBEBOX_BUTTON_PRESS.name: LANE_REALTIME,
+        cm.CubeMsgTypes.CUBEBOX_RFID_READ.name: LANE_REALTIME,
+        # same lane as the RFID reads, so that a team is never badged in before it's created, or after it's removed
+        cm.CubeMsgTypes.FRONTDESK_NEW_TEAM.name: LANE_REALTIME,
+        cm.CubeMsgTypes.FRONTDESK_REMOVE_TEAM.name: LANE_REALTIME,
+        cm.CubeMsgTypes.ACK.name: LANE_REALTIME,
+        cm.CubeMsgTypes.HEARTBEAT.name: LANE_BULK,
+        cm.CubeMsgTypes.CONFIG.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_VERSION.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_CUBEMASTER_STATUS.name: LANE_BULK,
+        # same lane as the full statuses, so that a delta is never handled before the status it applies to
+        cm.CubeMsgTypes.CUBEMASTER_STATUS_DELTA.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_CUBEMASTER_STATUS_HASH.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUSES.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUS_HASHES.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_TEAM_STATUS.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_ALL_TEAMS_STATUSES.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_ALL_TEAMS_STATUS_HASHES.name: LANE_BULK,
+        cm.CubeMsgTypes.REPLY_DATABASE_TEAMS.name: LANE_BULK,
+    }
+
+    # the IDs of the messages received recently are remembered, so that a retransmitted message
+    # is acknowledged again without being handled twice. Must outlast the retries of the senders.
+    DEDUP_WINDOW_TTL = RETRY_TTL + 30.0  # seconds
+    DEDUP_WINDOW_MAXLEN = 256  # per sender
+    # a message which was received but not acknowledged (its handler failed, or ignored it) is only deduplicated
+    # this long, which covers the quick retransmissions of its sender. Later ones are handled again.
+    DEDUP_UNACKED_TTL = ACK_WAIT_TIMEOUT  # seconds
+
+    # datagrams larger than this are split into fragments, so that each one fits in a single Ethernet frame
+    # (1472 bytes of UDP payload) along with the fragment header
+    FRAGMENT_CHUNK_SIZE = 1400
+    # a fragmented datagram cannot be larger than FRAGMENT_MAX_COUNT * FRAGMENT_CHUNK_SIZE (~1.4MB)
+    FRAGMENT_MAX_COUNT = 1024
+    # if no fragment arrived for this long, ask the sender for the missing ones
+    FRAGMENT_NACK_DELAY = 0.1  # seconds
+    FRAGMENT_MAX_NACKS = 3
+    # partial messages are dropped after this long
+    FRAGMENT_REASSEMBLY_TIMEOUT = 1.0  # seconds
+    # memory bounds of the reassembly: the oldest partial messages are dropped first
+    FRAGMENT_MAX_PARTIALS = 32
+    FRAGMENT_MAX_PARTIALS_BYTES = 4 * 1024 * 1024
+    # the fragments we sent are kept this long, in order to answer NACKs
+    SENT_FRAGMENTS_TTL = 2.0  # seconds
+    SENT_FRAGMENTS_MAXLEN = 16
+    # transfers completed recently, so that late duplicate fragments do not start a new reassembly
+    COMPLETED_TRANSFERS_MAXLEN = 256
 
     def __init__(self, node_name: str, log_filename: str = None):
         self.log = cube_logger.CubeLogger(name=f"{node_name} Networking", log_filename=log_filename)
@@ -92,10 +574,22 @@ class CubeNetworking:
 
         # params declaration
         self.node_name = node_name
+        # destination IDs of the datagrams this node handles. The others are dropped as soon as they're received.
+        self._own_destination_ids = cubeid.node_ids_addressing(node_name)
         self._listenThread = None
         self._keep_running = False
 
         self._udp_socket = None
+        # set by init_socket if the multicast groups could be joined. Only the listen thread joins them again.
+        self._multicast_joined = False
+        # whether we send to the multicast groups. Cleared when a send to a group fails
+        self._multicast_enabled = False
+        self._last_multicast_join_attempt = 0.0
+        # the peers which only answer our broadcasts, with the time until which we keep broadcasting to them
+        self._broadcast_only_peers: Dict[NodeName, Timestamp] = {}
+        # last value of the kernel drop counter, used to compute the number of newly dropped packets
+        self._kernel_drops_count = 0
+        self._use_recvmsg = hasattr(socket.socket, "recvmsg") and hasattr(socket, "MSG_DONTWAIT")
         self.init_socket()
 
 
@@ -103,26 +597,72 @@ class CubeNetworking:
         # add own IP to the nodes list
         self.nodes_list.set_node_ip_for_node_name(self.node_name, self.get_self_ip())
 
-        # valid messages received are put into this queue
-        self._incoming_messages: Deque[cm.CubeMessage] = deque()
-        # in order to avoid waiting multiple times by mistake for the same ack, we put the sent messages to ack in a queue
-        self._ack_wait_queue = deque()
-        # sometimes, a sent message will not be acknowledged. Let's put these messages in a queue and retry sending them some time later
-        self._retry_queue = deque()
-        # flag set to indicate that we're waiting for a message
-        self._is_waiting_for_message = False
-        # queue to store the messages we're possibly waiting for
-        self._waiting_for_message_queue = deque()
+        # valid messages received are put into these queues, one per lane, along with their reception time.
+        # Indexed by message key, so that a handled message can be removed in O(1).
+        # The messages without an ID are indexed by their arrival rank instead (see _incoming_lane_key)
+        self._incoming_lanes: Dict[str, OrderedDict[Union[cm.CubeMsgKey, int], Tuple[cm.CubeMessage, Timestamp]]] = {
+            lane: OrderedDict() for lane in self.INCOMING_LANES}
+        self._nb_incoming_msgs_without_id = 0
+        # ID given to the next message we send. Starts from the current time in ms
+        # so that a rebooted node does not reuse the IDs of its previous run
+        self._next_msg_id_value = int(time.time() * 1000) & self.MSG_ID_MASK
+        self._msg_id_lock = threading.Lock()
+        # the ACKs we're waiting for, indexed by the key of the message they acknowledge.
+        # The listen thread completes them as soon as the ACK arrives.
+        self._pending_acks: Dict[cm.CubeMsgKey, List[CubePendingAck]] = {}
+        # ACKs that arrived while nobody was waiting for them, indexed the same way.
+        self._unclaimed_acks: OrderedDict[cm.CubeMsgKey, List[Tuple[Timestamp, cm.CubeMsgAck]]] = OrderedDict()
+        # sometimes, a sent message will not be acknowledged. Let's put these messages in a queue and retry sending them some time later.
+        # One FIFO per destination, drained by the retry thread
+        self._retry_queues: Dict[NodeName, Deque[CubeRetryEntry]] = {}
+        self._retry_thread: Optional[threading.Thread] = None
+        self._retry_send_executor: Optional[ThreadPoolExecutor] = None
+        # the open subscriptions, indexed by the name of the message type they consume
+        self._subscriptions: Dict[str, List[CubeMsgSubscription]] = {}
+        # the messages delivered to subscriptions: how many subscriptions still hold each one, and whether one consumed it
+        self._subscribed_msgs: Dict[cm.CubeMsgKey, List] = {}
+        self._subscriptions_lock = threading.Lock()
 
         # there's gonna be a lot of multithreading, so we'll set up these locks to avoid collisions
         self._incoming_queue_lock = threading.Lock()
+        # notified when a message is added to the incoming queue, to wake up the consumers
+        self._incoming_condition = threading.Condition(self._incoming_queue_lock)
         self._udp_send_lock = threading.Lock()
-        self._ack_wait_queue_lock = threading.Lock()
+        self._pending_acks_lock = threading.Lock()
         self._retry_queue_lock = threading.Lock()
-        self._waiting_for_message_queue_lock = threading.Lock()
+        # notified when the retry queues change, to wake up the retry thread
+        self._retry_condition = threading.Condition(self._retry_queue_lock)
 
         self.heartbeats: Dict[str, float] = {}
 
+        # background threads performing the non-blocking sends, created on the first async send
+        self._async_send_executor: Optional[ThreadPoolExecutor] = None
+        self._async_send_executor_lock = threading.Lock()
+
+        # counters of the receive path: packets received, truncated, invalid, dropped by the kernel...
+        self.stats = CubeNetStats()
+
+        # the messages received recently, per sender, indexed by message ID:
+        # (reception timestamp, whether it has been acknowledged, ack info)
+        self._seen_messages: Dict[NodeName, OrderedDict[int, Tuple[Timestamp, bool, Optional[Union[cm.CubeAckInfos, str]]]]] = {}
+        self._seen_messages_lock = threading.Lock()
+
+        # whether each peer can read the binary wire format, updated by every message it sends us
+        self._binary_peers: Dict[NodeName, bool] = {}
+
+        # round-trip time estimations, indexed by the destination of the acknowledged messages
+        self._rtt_estimators: Dict[NodeName, CubeRttEstimator] = {}
+        self._rtt_estimators_lock = threading.Lock()
+
+        # fragmented datagrams being reassembled, indexed by (sender, transfer ID). Only used by the listen thread.
+        self._partial_messages: OrderedDict[Tuple[NodeName, int], CubePartialMessage] = OrderedDict()
+        self._partial_messages_bytes = 0
+        self._completed_transfers: OrderedDict[Tuple[NodeName, int], None] = OrderedDict()
+        self._last_partial_messages_check = 0.0
+        # the fragments we sent recently, indexed by transfer ID: (timestamp, fragments, ip, port)
+        self._sent_fragments: OrderedDict[int, Tuple[Timestamp, List[bytes], str, int]] = OrderedDict()
+        self._sent_fragments_lock = threading.Lock()
+
         self.log.setLevel(cube_logger.CubeLogger.LEVEL_INFO)
 
     @cubetry
@@ -132,9 +672,166 @@ class CubeNetworking:
         if not is_windows():
             self._udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # Enable broadcasting
+        self.set_receive_buffer_size(self.UDP_RCVBUF_SIZE)
+        if not is_windows():
+            # noinspection PyBroadException
+            try:
+                self._udp_socket.setsockopt(socket.SOL_SOCKET, self.SO_RXQ_OVFL, 1)
+            except:
+                # not supported: kernel drops will not be counted
+                pass
+        self._kernel_drops_count = 0
         self._udp_socket.bind((self.UDP_LISTEN_IP, self.UDP_PORT))
+        self._multicast_joined = self.USE_MULTICAST and self._join_multicast_groups()
+        self._multicast_enabled = self._multicast_joined
+        self._last_multicast_join_attempt = time.time()
+        return True
+
+    def _join_multicast_groups(self) -> bool:
+        """Joins the multicast groups this node listens to. Returns False if any of them could not be joined."""
+        interface_ip = self.MULTICAST_INTERFACE_IP or "0.0.0.0"
+        try:
+            self._udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.MULTICAST_TTL)
+            # several nodes may run on the same machine
+            self._udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if self.MULTICAST_INTERFACE_IP:
+                self._udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                            socket.inet_aton(self.MULTICAST_INTERFACE_IP))
+            if sys.platform.startswith("linux"):
+                self._udp_socket.setsockopt(socket.IPPROTO_IP, self.IP_MULTICAST_ALL, 0)
+            for group in self.get_multicast_groups():
+                try:
+                    self._udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                                socket.inet_aton(group) + socket.inet_aton(interface_ip))
+                except OSError as e:
+                    # joined by a previous attempt
+                    if e.errno != errno.EADDRINUSE:
+                        raise
+            return True
+        except OSError as e:
+            self.log.warning(f"Could not join the multicast groups, falling back to broadcast: {e}")
+            return False
+
+    def _check_multicast(self):
+        """Called periodically by the listen thread. If multicast was given up, tries it again:
+        joins the groups if they could not be joined, and sends to them again after a send error"""
+        if not self.USE_MULTICAST or self._multicast_enabled:
+            return
+        now = time.time()
+        if now - self._last_multicast_join_attempt < self.MULTICAST_REJOIN_PERIOD:
+            return
+        self._last_multicast_join_attempt = now
+        if not self._multicast_joined:
+            self._multicast_joined = self._join_multicast_groups()
+        if self._multicast_joined:
+            self.log.info("Multicast enabled again")
+            self._multicast_enabled = True
+            self.stats.increment("multicast_rejoins")
+
+    def get_multicast_groups(self) -> List[str]:
+        """Returns the multicast groups this node listens to"""
+        return [self.multicast_group_of(cubeid.node_id_to_node_name(node_id))
+                for node_id in sorted(self._own_destination_ids)]
+
+    @classmethod
+    def multicast_group_of(cls, destination: Optional[NodeName]) -> str:
+        """Returns the multicast group of a node, of a group of nodes, or of everyone if destination is None"""
+        return f"{cls.MULTICAST_GROUP_PREFIX}.{cm.CubeMsgBinaryCodec.destination_to_node_id(destination)}"
+
+    @staticmethod
+    def is_multicast_ip(ip: str) -> bool:
+        # noinspection PyBroadException
+        try:
+            return 224 <= int(ip.split(".")[0]) <= 239
+        except:
+            return False
+
+    def is_multicast_enabled(self) -> bool:
+        return self._multicast_enabled
+
+    def _destination_ip(self, destination: Optional[NodeName], ip: Optional[str], use_multicast: bool = True) -> str:
+        """Returns the IP to send a datagram for this destination to: its multicast group if multicast is enabled
+        and the destination answers on it, else the broadcast IP, or the given IP if we're not only broadcasting"""
+        if use_multicast and self._multicast_enabled and not self._is_broadcast_only_peer(destination):
+            return self.multicast_group_of(destination)
+        if self.ONLY_USE_BROADCAST or not ip:
+            return self.UDP_BROADCAST_IP
+        return ip
+
+    def _is_broadcast_only_peer(self, destination: Optional[NodeName]) -> bool:
+        fallback_end = self._broadcast_only_peers.get(destination)
+        if fallback_end is None:
+            return False
+        if time.time() > fallback_end:
+            self._broadcast_only_peers.pop(destination, None)
+            return False
         return True
 
+    def _on_ack_of_broadcast_retransmission(self, destination: Optional[NodeName]):
+        """Called when a destination acknowledged a broadcast retransmission but not the multicast datagram:
+        it may not have joined its group, so broadcast to it for a while"""
+        if not self._is_broadcast_only_peer(destination):
+            self.log.warning(f"{destination} only answered by broadcast, broadcasting to it "
+                             f"for {self.MULTICAST_PEER_FALLBACK_TTL} s")
+            self.stats.increment("multicast_peer_fallbacks")
+        self._broadcast_only_peers[destination] = time.time() + self.MULTICAST_PEER_FALLBACK_TTL
+
+    # the class attributes changed by use_loopback_config
+    LOOPBACK_CONFIG_ATTRIBUTES = ("UDP_BROADCAST_IP", "MULTICAST_INTERFACE_IP")
+
+    @classmethod
+    def use_loopback_config(cls):
+        """Configures the networking to run several nodes on this machine only, e.g. for simulations and tests.
+        Multicast groups and broadcasts both stay on the loopback interface."""
+        cls.UDP_BROADCAST_IP = "127.255.255.255"
+        cls.MULTICAST_INTERFACE_IP = "127.0.0.1"
+
+    @cubetry
+    def set_receive_buffer_size(self, size: Optional[int]) -> bool:
+        """Sets the size of the kernel receive buffer of the socket.
+        Note that the OS may cap it (see /proc/sys/net/core/rmem_max on Linux)."""
+        if size is None:
+            return True
+        self._udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        return True
+
+    @cubetry
+    def get_receive_buffer_size(self) -> int:
+        """Returns the actual size of the kernel receive buffer of the socket"""
+        return self._udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def get_stats(self) -> Dict[str, int]:
+        """Returns a copy of the networking counters"""
+        return self.stats.to_dict()
+
+    def get_rtt_estimator(self, destination: Optional[NodeName]) -> CubeRttEstimator:
+        """Returns the RTT estimator of a destination node. Messages to everyone share one estimator."""
+        destination = destination or cubeid.EVERYONE_NODENAME
+        with self._rtt_estimators_lock:
+            estimator = self._rtt_estimators.get(destination)
+            if estimator is None:
+                estimator = CubeRttEstimator(self.ACK_WAIT_TIMEOUT, self.MIN_ACK_TIMEOUT, self.MAX_ACK_TIMEOUT)
+                self._rtt_estimators[destination] = estimator
+            return estimator
+
+    def get_ack_timeout(self, destination: Optional[NodeName]) -> Seconds:
+        """Returns the current retransmission timeout for a destination node"""
+        if not self.ADAPTIVE_ACK_TIMEOUT:
+            return self.ACK_WAIT_TIMEOUT
+        return self.get_rtt_estimator(destination).rto
+
+    def get_rtt_stats(self) -> Dict[NodeName, Dict[str, Union[Seconds, int, None]]]:
+        """Returns the live RTT estimations (srtt, rttvar, rto...) of every destination we sent a message to"""
+        with self._rtt_estimators_lock:
+            estimators = dict(self._rtt_estimators)
+        return {destination: estimator.to_dict() for destination, estimator in estimators.items()}
+
+    @staticmethod
+    def get_msg_size_stats() -> Dict[str, Dict[str, int]]:
+        """Returns the per-message-type sizes of the messages encoded by this process,
+        e.g. to check that most status replies fit in a single frame"""
+        return cm.CubeMsgBinaryCodec.size_stats.to_dict()
+
     def run(self):
         """launches the listening and sending threads.
         DO OVERRIDE THIS after calling super()"""
@@ -143,6 +840,8 @@ class CubeNetworking:
         self._listenThread.daemon = True
         self._keep_running = True
         self._listenThread.start()
+        self._retry_thread = threading.Thread(target=self._retry_loop, daemon=True)
+        self._retry_thread.start()
 
     def is_running(self):
         """Returns True if the networking is running, False otherwise"""
@@ -153,6 +852,18 @@ class CubeNetworking:
         try:
             self.log.info("Stopping networking...")
             self._keep_running = False
+            with self._async_send_executor_lock:
+                if self._async_send_executor is not None:
+                    self._async_send_executor.shutdown(wait=False, cancel_futures=True)
+                    self._async_send_executor = None
+            with self._retry_condition:
+                self._retry_condition.notify_all()
+                if self._retry_send_executor is not None:
+                    self._retry_send_executor.shutdown(wait=False, cancel_futures=True)
+                    self._retry_send_executor = None
+            # wake up the consumers blocked in get_incoming_msg()
+            with self._incoming_condition:
+                self._incoming_condition.notify_all()
             self._udp_socket.close()
             self._listenThread.join(timeout=0.1)
             self.log.info("Networking stopped")
@@ -162,100 +873,291 @@ class CubeNetworking:
     def get_incoming_msg_queue(self) -> Tuple[CubeMessage, ...]:
         """Returns the incoming_messages queue"""
         with self._incoming_queue_lock:
-            return tuple(self._incoming_messages)
+            return tuple(message for lane in self.INCOMING_LANES
+                         for message, _ in self._incoming_lanes[lane].values())
+
+    def get_incoming_msg(self, timeout: Optional[Seconds] = None) -> Optional[cm.CubeMessage]:
+        """Pops the next message to handle from the incoming queue, the realtime lane first.
+        Blocks until a message arrives. Returns None if nothing arrived within the timeout,
+        or if the networking was stopped."""
+        with self._incoming_condition:
+            if not self._incoming_condition.wait_for(
+                    lambda: not self._keep_running or any(self._incoming_lanes.values()), timeout):
+                return None
+            for lane in self.INCOMING_LANES:
+                if self._incoming_lanes[lane]:
+                    _, (message, timestamp) = self._incoming_lanes[lane].popitem(last=False)
+                    break
+            else:
+                return None
+        self._record_lane_delay(lane, timestamp)
+        return message
 
     def remove_msg_from_incoming_queue(self, message: cm.CubeMessage, force_remove=False) -> bool:
-        """Removes a message from the incoming_messages queue"""
-        if message.msgtype == cm.CubeMsgTypes.ACK and not force_remove:
-            self.log.error("ACK messages can only be removed with force_remove=True outside of wait_for_ack_of()")
-            return False
+        """Removes a message from the incoming_messages queue.
+        Returns False if it was not in the queue, for instance if a consumer already got it.
+        `force_remove` is kept for compatibility: ACKs never go through the incoming queue."""
         self.log.debug(f"Removing message from listen queue: ({message.shortinfo})")
+        lane = self.get_msg_lane(message)
         with self._incoming_queue_lock:
-            # noinspection PyBroadException
-            try:
-                self._incoming_messages.remove(message)
-                # self.log.debug(f"Message removed from listen queue: ({message.shortinfo}) : {message}")
-                return True
-            except:
-                # self.log.error(f"Cannot remove message from listen queue ({message.shortinfo}) :  {message}")
-                return False
+            lane_msgs = self._incoming_lanes[lane]
+            if message.msg_id is not None:
+                queued = lane_msgs.pop(message.key, None)
+            else:
+                # indexed by arrival rank: remove the oldest identical message
+                rank = next((rank for rank, (queued_msg, _) in lane_msgs.items() if queued_msg == message), None)
+                queued = lane_msgs.pop(rank) if rank is not None else None
+        if queued is None:
+            return False
+        self._record_lane_delay(lane, queued[1])
+        return True
 
-    def remove_msg_from_ack_wait_queue(self, message: cm.CubeMessage) -> bool:
-        """Removes a message from the ack_wait_queue"""
-        with self._ack_wait_queue_lock:
-            # noinspection PyBroadException
-            try:
-                self._ack_wait_queue.remove(message)
-                self.log.debug(f"Message removed from ack wait queue: ({message.shortinfo})")
-                return True
-            except:
-                self.log.error(f"Failed to remove message from ack wait queue ({message.shortinfo})")
-                return False
+    def _record_lane_delay(self, lane: str, queued_timestamp: Timestamp):
+        # time spent in the queue, until handled
+        delay_ms = int((time.time() - queued_timestamp) * 1000)
+        self.stats.increment(f"{lane}_handled")
+        self.stats.increment(f"{lane}_delay_total_ms", delay_ms)
+        self.stats.set_max(f"{lane}_delay_max_ms", delay_ms)
+
+    def subscribe(self, *msgtypes: cm.CubeMsgTypes,
+                  accept: Callable[[cm.CubeMessage], bool] = None) -> CubeMsgSubscription:
+        """Opens a subscription to the incoming messages of these types.
+        Until it is closed, these messages are delivered to it instead of the incoming queue.
+        If accept is given, only the messages for which it returns True are delivered,
+        so that concurrent requests of the same type each get their own reply.
+        Subscribe before sending a request, so that a quick reply cannot be missed."""
+        subscription = CubeMsgSubscription(self, tuple(msgtype.name for msgtype in msgtypes), accept)
+        with self._subscriptions_lock:
+            for name in subscription.msgtype_names:
+                self._subscriptions.setdefault(name, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: CubeMsgSubscription):
+        with self._subscriptions_lock:
+            for name in subscription.msgtype_names:
+                subscribers = self._subscriptions.get(name, [])
+                if subscription in subscribers:
+                    subscribers.remove(subscription)
+                if not subscribers:
+                    self._subscriptions.pop(name, None)
+
+    def _deliver_to_subscriptions(self, message: cm.CubeMessage) -> bool:
+        """Gives the message to every subscription of its type which accepts it. Returns False if there's none."""
+        with self._subscriptions_lock:
+            subscribers = tuple(self._subscriptions.get(message.msgtype.name, ()))
+        subscribers = [subscription for subscription in subscribers if subscription.accepts(message)]
+        if not subscribers:
+            return False
+        with self._subscriptions_lock:
+            self._subscribed_msgs.setdefault(message.key, [0, False])[0] += len(subscribers)
+        for subscription in subscribers:
+            if not subscription.put(message):
+                self.release_subscribed_msg(message, consumed=False)
+        return True
 
-    def add_msg_to_ack_wait_queue(self, message: cm.CubeMessage) -> bool:
-        """Adds a message to the ack_wait_queue.
-        Returns True if the message was added, False if it was already in the queue or could not be added"""
-        with self._ack_wait_queue_lock:
-            if message in self._ack_wait_queue:
-                self.log.warning(f"Already waiting for ack of message: ({message.shortinfo})")
-                return False
-            self._ack_wait_queue.append(message)
-            self.log.debug(f"Message added to ack wait queue: ({message.shortinfo}) : {message}")
-            return True
+    def release_subscribed_msg(self, message: cm.CubeMessage, consumed: bool):
+        """Called by a subscription when it consumes a delivered message, or drops it on close.
+        The message goes back to the incoming queue only once, when the last subscription holding it drops it,
+        and only if none of them consumed it: that way, it is never handled twice."""
+        with self._subscriptions_lock:
+            delivery = self._subscribed_msgs.get(message.key)
+            if delivery is None:
+                return
+            delivery[0] -= 1
+            delivery[1] = delivery[1] or consumed
+            if delivery[0] > 0:
+                return
+            del self._subscribed_msgs[message.key]
+            requeue = not delivery[1]
+        if requeue:
+            self.add_msg_to_incoming_queue(message)
 
-    def add_msg_to_retry_queue(self, message: cm.CubeMessage) -> bool:
-        """Adds a message to the retry_queue"""
-        with self._retry_queue_lock:
-            if message in self._retry_queue:
+    @classmethod
+    def get_msg_lane(cls, message: cm.CubeMessage) -> str:
+        """Returns the incoming lane of a message, according to its type"""
+        return cls.MSGTYPE_LANES.get(message.msgtype.name, cls.LANE_CONTROL)
+
+    def get_lane_stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """Returns, for each incoming lane: the number of queued messages, the number of handled messages,
+        and their average and maximum queueing delay"""
+        with self._incoming_queue_lock:
+            depths = {lane: len(queue) for lane, queue in self._incoming_lanes.items()}
+        lane_stats = {}
+        for lane in self.INCOMING_LANES:
+            nb_handled = self.stats.get(f"{lane}_handled")
+            lane_stats[lane] = {
+                "depth": depths[lane],
+                "handled": nb_handled,
+                "avg_delay_ms": self.stats.get(f"{lane}_delay_total_ms") / nb_handled if nb_handled else 0.0,
+                "max_delay_ms": self.stats.get(f"{lane}_delay_max_ms"),
+            }
+        return lane_stats
+
+    def add_msg_to_retry_queue(self, message: cm.CubeMessage, ip: str = None, port: int = None) -> bool:
+        """Adds a message to the retry queue of its destination. It will be sent again by the retry thread.
+        An older message of the same coalescable type to the same destination is dropped, as it's superseded.
+        The messages of the NOT_RETRIED_MSGTYPES are refused."""
+        if message.msgtype.name in self.NOT_RETRIED_MSGTYPES:
+            self.log.warning(f"Not retrying this type of message later: ({message.shortinfo})")
+            return False
+        entry = CubeRetryEntry(message, ip, port, self.RETRY_TTL)
+        with self._retry_condition:
+            queue = self._retry_queues.setdefault(entry.destination, deque())
+            if any(queued.message == message for queued in queue):
                 self.log.warning(f"Already waiting to retry message: ({message.shortinfo})")
                 return False
-            self._retry_queue.append(message)
-            self.log.debug(f"Message added to retry queue: ({message.shortinfo})")
-            return True
+            self._remove_superseded_retries(queue, message)
+            queue.append(entry)
+            while len(queue) > self.RETRY_QUEUE_MAXLEN:
+                dropped = queue.popleft()
+                self.stats.increment("retries_dropped_queue_full")
+                self.log.error(f"Retry queue of {entry.destination} full, dropping: ({dropped.message.shortinfo})")
+            self.stats.increment("retries_queued")
+            self._retry_condition.notify_all()
+        self.log.debug(f"Message added to retry queue: ({message.shortinfo})")
+        return True
 
     def remove_msg_from_retry_queue(self, message: cm.CubeMessage) -> bool:
-        """Removes a message from the retry_queue"""
+        """Removes a message from the retry queue"""
+        with self._retry_condition:
+            for queue in self._retry_queues.values():
+                for entry in queue:
+                    if entry.message == message:
+                        queue.remove(entry)
+                        self.log.debug(f"Message removed from retry queue: ({message.shortinfo})")
+                        return True
+        self.log.error(f"Failed to remove message from retry queue ({message.shortinfo})")
+        return False
+
+    def _remove_superseded_retries(self, queue: Deque[CubeRetryEntry], message: cm.CubeMessage):
+        """Removes the queued retries superseded by this newer message. Must be called with _retry_queue_lock held"""
+        if message.msgtype.name not in self.COALESCABLE_MSGTYPES:
+            return
+        for entry in [entry for entry in queue if not entry.in_flight and entry.message.msgtype == message.msgtype
+                      and entry.message != message]:
+            queue.remove(entry)
+            self.stats.increment("retries_coalesced")
+            self.log.debug(f"Retry superseded by a newer message: ({entry.message.shortinfo})")
+
+    def _on_msg_delivered(self, message: cm.CubeMessage):
+        """Drops the retries which this delivered message makes obsolete"""
+        if message.msgtype.name not in self.COALESCABLE_MSGTYPES:
+            return
+        with self._retry_condition:
+            queue = self._retry_queues.get(message.destination or cubeid.EVERYONE_NODENAME)
+            if queue:
+                self._remove_superseded_retries(queue, message)
+
+    def get_retry_queue(self) -> Tuple[cm.CubeMessage, ...]:
+        """Returns the messages waiting to be retried, all destinations included"""
         with self._retry_queue_lock:
-            # noinspection PyBroadException
-            try:
-                self._retry_queue.remove(message)
-                self.log.debug(f"Message removed from retry queue: ({message.shortinfo})")
-                return True
-            except:
-                self.log.error(f"Failed to remove message from retry queue ({message.shortinfo})")
-                return False
+            return tuple(entry.message for queue in self._retry_queues.values() for entry in queue)
+
+    def get_retry_queue_stats(self) -> Dict[NodeName, Dict[str, Union[int, Seconds]]]:
+        """Returns, for each destination, the number of messages waiting to be retried and the age of the oldest"""
+        now = time.time()
+        with self._retry_queue_lock:
+            return {destination: {"depth": len(queue), "oldest_age": queue[0].age(now),
+                                  "nb_retries": queue[0].nb_retries}
+                    for destination, queue in self._retry_queues.items() if queue}
+
+    def _retry_loop(self):
+        """Sends the due head of each destination's retry queue, and drops the expired entries.
+        Sleeps until the next retry is due or the queues change."""
+        while self._keep_running:
+            with self._retry_condition:
+                due_entries, next_due_timestamp = self._pop_due_retries()
+                if not due_entries:
+                    timeout = None if next_due_timestamp is None else max(0.0, next_due_timestamp - time.time())
+                    self._retry_condition.wait(timeout)
+                    continue
+            for entry in due_entries:
+                self._send_retry(entry)
+
+    def _pop_due_retries(self) -> Tuple[List[CubeRetryEntry], Optional[Timestamp]]:
+        """Returns the entries to retry now, marked as in flight, and the time the next one is due.
+        Must be called with _retry_queue_lock held"""
+        now = time.time()
+        due_entries = []
+        next_due_timestamp = None
+        for destination, queue in list(self._retry_queues.items()):
+            while queue and not queue[0].in_flight and queue[0].is_expired(now):
+                expired = queue.popleft()
+                self.stats.increment("retries_expired")
+                self.log.error(f"Giving up on message to {destination} after {expired.nb_retries} retries: "
+                               f"({expired.message.shortinfo})")
+            if not queue:
+                del self._retry_queues[destination]
+                continue
+            head = queue[0]
+            if head.in_flight:
+                continue
+            if head.next_retry_timestamp <= now:
+                head.in_flight = True
+                due_entries.append(head)
+            elif next_due_timestamp is None or head.next_retry_timestamp < next_due_timestamp:
+                next_due_timestamp = head.next_retry_timestamp
+        return due_entries, next_due_timestamp
+
+    def _send_retry(self, entry: CubeRetryEntry):
+        """Sends a retry in the background, so that an unreachable destination does not delay the others"""
+        with self._retry_condition:
+            if not self._keep_running:
+                return
+            if self._retry_send_executor is None:
+                self._retry_send_executor = ThreadPoolExecutor(
+                    max_workers=self.RETRY_SEND_WORKERS, thread_name_prefix=f"{self.node_name}-retry")
+            entry.nb_retries += 1
+            self.stats.increment("retries_sent")
+            future = self._retry_send_executor.submit(
+                self.send_msg_with_udp, entry.message, entry.ip, entry.port, True, None, 1, False, True)
+        future.add_done_callback(lambda done_future: self._on_retry_done(entry, done_future))
+
+    def _on_retry_done(self, entry: CubeRetryEntry, future: 'Future[SendReport]'):
+        # noinspection PyBroadException
+        try:
+            delivered = not future.cancelled() and future.result().ack_msg is not None
+        except:
+            delivered = False
+        with self._retry_condition:
+            entry.in_flight = False
+            queue = self._retry_queues.get(entry.destination)
+            if delivered:
+                self.stats.increment("retries_succeeded")
+                if queue and entry in queue:
+                    queue.remove(entry)
+                self.log.info(f"Message delivered after {entry.nb_retries} retries: ({entry.message.shortinfo})")
+            else:
+                self.stats.increment("retries_failed")
+                delay = min(self.RETRY_BASE_DELAY * 2 ** entry.nb_retries, self.RETRY_MAX_DELAY)
+                # jitter, so that the nodes do not all retry at the same time when a destination comes back
+                entry.next_retry_timestamp = time.time() + delay * random.uniform(0.5, 1.0)
+            self._retry_condition.notify_all()
 
     def add_msg_to_incoming_queue(self, message: cm.CubeMessage) -> bool:
         """Adds a message to the incoming_messages queue"""
-        with self._incoming_queue_lock:
-            self._incoming_messages.append(message)
+        lane = self.get_msg_lane(message)
+        with self._incoming_condition:
+            self._incoming_lanes[lane][self._incoming_lane_key(message)] = (message, time.time())
+            self._incoming_condition.notify()
             self.log.debug(f"Message added to incoming queue: ({message.shortinfo}) : {message}")
             return True
 
-    def add_msg_to_waiting_for_message_queue(self, message: cm.CubeMessage) -> bool:
-        """Adds a message to the waiting_for_message_queue"""
-        with self._waiting_for_message_queue_lock:
-            self._waiting_for_message_queue.append(message)
-            self.log.debug(f"Message added to waiting for message queue: ({message.shortinfo}) : {message}")
-            return True
-
-    def remove_msg_from_waiting_for_message_queue(self, message: cm.CubeMessage) -> bool:
-        """Removes a message from the waiting_for_message_queue"""
-        with self._waiting_for_message_queue_lock:
-            # noinspection PyBroadException
-            try:
-                self._waiting_for_message_queue.remove(message)
-                self.log.debug(f"Message removed from waiting for message queue: ({message.shortinfo})")
-                return True
-            except:
-                self.log.error(f"Failed to remove message from waiting for message queue ({message.shortinfo})")
-                return False
+    def _incoming_lane_key(self, message: cm.CubeMessage) -> Union[cm.CubeMsgKey, int]:
+        """Returns the key of a message in its incoming lane. Called with the incoming queue lock held.
+        The key of a message without an ID is its content hash, and two identical ones from an old peer
+        (e.g. the same RFID read twice) must both be handled: these are keyed by their arrival rank instead."""
+        if message.msg_id is not None:
+            return message.key
+        self._nb_incoming_msgs_without_id += 1
+        return self._nb_incoming_msgs_without_id
 
     def acknowledge_this_message(self, message: cm.CubeMessage, ack_info: Union[cm.CubeAckInfos,str] = None) -> SendReport:
         """Sends an acknowledgement message for the given message"""
         self.log.debug(f"Acknowledging message: ({message.shortinfo}) with AckInfo: {ack_info}")
         ack_msg = cm.CubeMsgAck(self.node_name, message, ack_info=ack_info)
         ack_msg.require_ack = False
+        self._remember_ack_info(message, ack_info)
         report = self.send_msg_to(ack_msg, message.sender)
         if report.sent_ok:
             self.log.infoplus(f"Acknowledgement sent with AckInfo='{ack_info}'. Removing acked message: ({ack_msg.hash})")
@@ -266,65 +1168,440 @@ class CubeNetworking:
 
     def _listen_loop(self):
         """Continuously listens for incoming messages and puts them in the incoming_messages queue if they're valid.
+        Blocks until the socket is readable, then handles every datagram waiting in the receive buffer.
         Do not override"""
         while self._keep_running:
-            time.sleep(LOOP_PERIOD_SEC)
-            # wait for a udp message
-            data, addr = self._wait_for_udp_packet()
-            if not data or not addr:
-                continue
-            # noinspection PyBroadException
-            try:
-                message = cm.CubeMessage()
-                message.build_from_bytes(data)
-            except:
-                continue
-            message.sender_ip = addr[0]
-            if message.sender == self.node_name:
-                # self.log.debug(f"Ignoring message from self : ({message.shortinfo}) {message}")
-                continue
+            if self._wait_for_readable_socket():
+                for data, addr in self._drain_udp_packets():
+                    self._handle_incoming_packet(data, addr)
+            self._check_partial_messages()
+            self._check_multicast()
+
+    def _wait_for_readable_socket(self, timeout: Seconds = None) -> bool:
+        """Blocks until a datagram is available or the timeout expires.
+        The timeout only matters to notice that we've been stopped."""
+        if timeout is None:
+            timeout = self.UDP_LISTEN_TIMEOUT
+        # noinspection PyBroadException
+        try:
+            readable, _, _ = select.select([self._udp_socket], [], [], timeout)
+            return bool(readable)
+        except:
+            # the socket was probably closed by stop()
+            if self._keep_running:
+                time.sleep(timeout)
+            return False
 
-            if not message.is_valid():
-                self.log.error(f"Invalid CubeMessage. Ignoring : {data.decode()}")
-                continue
+    def _drain_udp_packets(self) -> List[Tuple[bytes, Tuple[str, int]]]:
+        """Reads all the datagrams currently waiting in the receive buffer, up to UDP_MAX_BURST_SIZE."""
+        packets = []
+        while len(packets) < self.UDP_MAX_BURST_SIZE:
+            data, addr = self._receive_udp_packet_nowait()
+            if addr is None:
+                break
+            if data:
+                packets.append((data, addr))
+        if packets:
+            self.stats.increment("bursts")
+            self.stats.set_max("max_burst_size", len(packets))
+        return packets
+
+    def _receive_udp_packet_nowait(self) -> Tuple[bytes, Optional[Tuple[str, int]]]:
+        """Receives one datagram without blocking.
+        Returns (b"", None) if no datagram is available,
+        and (b"", addr) if a datagram was received but had to be discarded."""
+        try:
+            if self._use_recvmsg:
+                data, ancdata, msg_flags, addr = self._udp_socket.recvmsg(
+                    self.UDP_BUFSIZE, socket.CMSG_SPACE(4), socket.MSG_DONTWAIT)
+                self._update_kernel_drops(ancdata)
+                truncated = bool(msg_flags & socket.MSG_TRUNC)
+            else:
+                readable, _, _ = select.select([self._udp_socket], [], [], 0)
+                if not readable:
+                    return b"", None
+                data, addr = self._udp_socket.recvfrom(self.UDP_BUFSIZE)
+                truncated = False
+        except BlockingIOError:
+            return b"", None
+        except OSError as e:
+            # on Windows, a datagram larger than the buffer raises WSAEMSGSIZE
+            if getattr(e, "winerror", None) == 10040:
+                self.stats.increment("packets_truncated")
+                self.log.error(f"Received a datagram larger than UDP_BUFSIZE ({self.UDP_BUFSIZE} bytes). Ignoring it")
+                return b"", ("", 0)
+            return b"", None
+        self.stats.increment("packets_received")
+        self.stats.increment("bytes_received", len(data))
+        if truncated:
+            self.stats.increment("packets_truncated")
+            self.log.error(f"Received a datagram larger than UDP_BUFSIZE ({self.UDP_BUFSIZE} bytes) from {addr}. Ignoring it")
+            return b"", addr
+        return data, addr
+
+    def _update_kernel_drops(self, ancdata):
+        """Updates the kernel drops counter from the SO_RXQ_OVFL ancillary data, if any"""
+        for cmsg_level, cmsg_type, cmsg_data in ancdata:
+            if cmsg_level == socket.SOL_SOCKET and cmsg_type == self.SO_RXQ_OVFL and len(cmsg_data) >= 4:
+                total_drops = struct.unpack("I", cmsg_data[:4])[0]
+                if total_drops > self._kernel_drops_count:
+                    new_drops = total_drops - self._kernel_drops_count
+                    self.stats.increment("kernel_drops", new_drops)
+                    self.log.warning(f"The kernel dropped {new_drops} packets because the receive buffer was full")
+                self._kernel_drops_count = total_drops
+
+    def _handle_incoming_packet(self, data: bytes, addr: Tuple[str, int]) -> bool:
+        """Builds a message from a received datagram and puts it in the incoming queue if it's valid.
+        Returns True if the message was accepted, False otherwise."""
+        if not self._is_datagram_for_us(data):
+            self.stats.increment("dropped_not_for_us")
+            return False
+        if CubeNetFragments.is_fragment_or_nack(data):
+            return self._handle_fragment_packet(data, addr)
+        # noinspection PyBroadException
+        try:
+            message = cm.CubeMessage()
+            message.build_from_bytes(data)
+        except:
+            self.stats.increment("packets_invalid")
+            return False
+        message.sender_ip = addr[0]
+        if message.sender == self.node_name:
+            # self.log.debug(f"Ignoring message from self : ({message.shortinfo}) {message}")
+            self.stats.increment("packets_from_self")
+            return False
 
-            self.log.debug(f"Received valid message from {message.sender} : ({message.shortinfo}) {message}")
+        if not message.is_valid():
+            self.stats.increment("packets_invalid")
+            self.log.error(f"Invalid CubeMessage. Ignoring : {data.decode(errors='replace')}")
+            return False
 
-            self.add_msg_to_incoming_queue(message)
-            if self._is_waiting_for_message:
-                self.add_msg_to_waiting_for_message_queue(message)
-            self._remove_useless_ack_messages()
+        self.log.debug(f"Received valid message from {message.sender} : ({message.shortinfo})")
+        self.stats.increment("messages_accepted")
+        self._record_peer_wire_format(message, data)
+
+        # ACKs never go through the incoming queue: they directly wake up whoever is waiting for them
+        if message.msgtype == cm.CubeMsgTypes.ACK:
             self._handle_generic_message(message)
+            self._complete_pending_acks(cm.CubeMsgAck(copy_msg=message))
+            return True
+
+        if self._is_duplicate(message):
+            self.stats.increment("duplicates_dropped")
+            return False
+
+        # the generic messages (heartbeats, WHO_IS...) are handled right here, the others go to their consumers
+        if self._handle_generic_message(message):
+            return True
+        if not self._deliver_to_subscriptions(message):
+            self.add_msg_to_incoming_queue(message)
+        return True
+
+    def _record_peer_wire_format(self, message: cm.CubeMessage, data: bytes):
+        """Records whether the sender of a message can read the binary wire format.
+        It can if it sends binary, or text messages with an ID: the nodes giving IDs to their messages run
+        a version which reads binary.
+        A peer sending text without an ID runs an older version, e.g. after a rollback: it's sent text again."""
+        self._binary_peers[message.sender] = cm.CubeMsgBinaryCodec.is_binary(data) or message.msg_id is not None
+
+    def _sends_binary_to(self, destination: Optional[NodeName]) -> bool:
+        """Returns True if the messages for this destination are sent in the binary wire format:
+        if it's the preferred format, and every node of the destination is known to read it"""
+        if self.WIRE_FORMAT != self.WIRE_FORMAT_BINARY:
+            return False
+        if destination == cubeid.ALL_CUBEBOXES_NODENAME:
+            node_names = cubeid.CUBEBOXES_NODENAMES
+        elif destination is None or destination == cubeid.EVERYONE_NODENAME:
+            node_names = cubeid.ALL_NODENAMES
+        else:
+            node_names = (destination,)
+        return all(self._binary_peers.get(node_name, False)
+                   for node_name in node_names if node_name != self.node_name)
+
+    def _is_duplicate(self, message: cm.CubeMessage) -> bool:
+        """Returns True if this message was already received. If it was already acknowledged,
+        the ACK was probably lost: acknowledge it again, with the same ack info.
+        A message received more than DEDUP_UNACKED_TTL ago and never acknowledged is not a duplicate.
+        Otherwise, remembers the message."""
+        if message.msg_id is None:
+            # sent by a node running an older version: no way to tell
+            return False
+        now = time.time()
+        with self._seen_messages_lock:
+            seen = self._seen_messages.setdefault(message.sender, OrderedDict())
+            while seen:
+                oldest_timestamp = next(iter(seen.values()))[0]
+                if len(seen) < self.DEDUP_WINDOW_MAXLEN and now - oldest_timestamp <= self.DEDUP_WINDOW_TTL:
+                    break
+                seen.popitem(last=False)
+            seen_entry = seen.get(message.msg_id)
+            if seen_entry is None or (not seen_entry[1] and now - seen_entry[0] > self.DEDUP_UNACKED_TTL):
+                seen[message.msg_id] = (now, False, None)
+                # keep the entries sorted by reception time
+                seen.move_to_end(message.msg_id)
+                return False
+            _, acked, ack_info = seen_entry
+        self.log.info(f"Duplicate message, not handling it again: ({message.shortinfo})")
+        if acked:
+            ack_msg = cm.CubeMsgAck(self.node_name, message, ack_info=ack_info)
+            ack_msg.require_ack = False
+            self.send_msg_to(ack_msg, message.sender)
+            self.stats.increment("duplicates_reacked")
+        return True
+
+    def _remember_ack_info(self, message: cm.CubeMessage, ack_info: Optional[Union[cm.CubeAckInfos, str]]):
+        """Remembers how a received message was acknowledged, to acknowledge its duplicates the same way"""
+        if message.msg_id is None:
+            return
+        with self._seen_messages_lock:
+            seen = self._seen_messages.get(message.sender)
+            if seen is not None and message.msg_id in seen:
+                seen[message.msg_id] = (seen[message.msg_id][0], True, ack_info)
+
+    def _is_datagram_for_us(self, data: bytes) -> bool:
+        """Reads the destination of a datagram at its fixed offset, without decoding it.
+        Datagrams which do not tell (text or older binary messages) are for everyone."""
+        if CubeNetFragments.is_fragment_or_nack(data):
+            if len(data) <= CubeNetFragments.DESTINATION_OFFSET:
+                return True
+            destination_id = data[CubeNetFragments.DESTINATION_OFFSET]
+        else:
+            destination_id = cm.CubeMsgBinaryCodec.peek_destination_id(data)
+        return destination_id is None or destination_id in self._own_destination_ids
+
+    def _handle_fragment_packet(self, data: bytes, addr: Tuple[str, int]) -> bool:
+        """Handles a fragment or a NACK. When the last missing fragment of a datagram arrives,
+        the reassembled datagram is handled like any other one.
+        Returns True if a reassembled message was accepted, False otherwise."""
+        try:
+            marker, sender, transfer_id, index, count, body = CubeNetFragments.parse(data)
+        except (ValueError, UnicodeDecodeError) as e:
+            self.stats.increment("fragments_invalid")
+            self.log.error(f"Invalid fragment from {addr}: {e}")
+            return False
+
+        if marker == CubeNetFragments.NACK_MARKER:
+            if sender == self.node_name:
+                self._resend_fragments(transfer_id, CubeNetFragments.parse_nack_indexes(body))
+            return False
+
+        if sender == self.node_name:
+            self.stats.increment("packets_from_self")
+            return False
+        self.stats.increment("fragments_received")
+        transfer_key = (sender, transfer_id)
+        if transfer_key in self._completed_transfers:
+            self.stats.increment("fragments_duplicate")
+            return False
+        if count > self.FRAGMENT_MAX_COUNT:
+            self.stats.increment("fragments_invalid")
+            self.log.error(f"Fragmented datagram from {sender} too large: {count} fragments")
+            return False
+        partial = self._partial_messages.get(transfer_key)
+        if partial is None:
+            partial = CubePartialMessage(count, addr)
+            self._partial_messages[transfer_key] = partial
+        elif partial.count != count:
+            self.stats.increment("fragments_invalid")
+            return False
+        self._partial_messages_bytes += partial.add_chunk(index, body)
+        if not partial.is_complete():
+            self._enforce_partial_messages_bounds()
+            return False
+
+        del self._partial_messages[transfer_key]
+        self._partial_messages_bytes -= partial.nb_bytes
+        self._completed_transfers[transfer_key] = None
+        while len(self._completed_transfers) > self.COMPLETED_TRANSFERS_MAXLEN:
+            self._completed_transfers.popitem(last=False)
+        self.stats.increment("messages_reassembled")
+        return self._handle_incoming_packet(partial.assemble(), partial.addr)
+
+    def _enforce_partial_messages_bounds(self):
+        """Drops the oldest partial messages if there are too many of them or if they take too much memory"""
+        while len(self._partial_messages) > self.FRAGMENT_MAX_PARTIALS \
+                or self._partial_messages_bytes > self.FRAGMENT_MAX_PARTIALS_BYTES:
+            (sender, transfer_id), partial = self._partial_messages.popitem(last=False)
+            self._partial_messages_bytes -= partial.nb_bytes
+            self.stats.increment("partial_messages_evicted")
+            self.log.warning(f"Too many partial messages: dropped transfer {transfer_id} from {sender}")
+
+    def _check_partial_messages(self):
+        """Called by the listen thread: asks for the missing fragments of the stalled partial messages
+        and drops the partial messages which could not be completed in time"""
+        now = time.time()
+        if not self._partial_messages or now - self._last_partial_messages_check < self.FRAGMENT_NACK_DELAY / 2:
+            return
+        self._last_partial_messages_check = now
+        for transfer_key, partial in list(self._partial_messages.items()):
+            sender, transfer_id = transfer_key
+            if now - partial.first_timestamp > self.FRAGMENT_REASSEMBLY_TIMEOUT:
+                del self._partial_messages[transfer_key]
+                self._partial_messages_bytes -= partial.nb_bytes
+                self.stats.increment("fragment_reassembly_timeouts")
+                self.log.error(f"Could not reassemble transfer {transfer_id} from {sender}: "
+                               f"{len(partial.chunks)}/{partial.count} fragments received")
+            elif now - partial.last_activity_timestamp >= self.FRAGMENT_NACK_DELAY \
+                    and partial.nb_nacks < self.FRAGMENT_MAX_NACKS:
+                # a NACK must itself fit in a single frame
+                missing_indexes = partial.missing_indexes()[:self.FRAGMENT_CHUNK_SIZE // CubeNetFragments.INDEX_STRUCT.size]
+                partial.nb_nacks += 1
+                partial.last_activity_timestamp = now
+                self.stats.increment("fragment_nacks_sent")
+                self.log.warning(f"Asking {sender} for {len(missing_indexes)} missing fragments of transfer {transfer_id}")
+                self._send_bytes_with_udp(CubeNetFragments.make_nack(sender, transfer_id, missing_indexes),
+                                          self._destination_ip(sender, partial.addr[0]), self.UDP_PORT)
+
+    def _fragment_datagram(self, data: bytes, ip: str, port: int,
+                           destination_id: int = cubeid.EVERYONE_NODE_ID) -> List[bytes]:
+        """Returns the datagrams to send for this data: itself if it's small enough,
+        its fragments otherwise. The fragments are kept a short while to answer NACKs."""
+        if len(data) <= self.FRAGMENT_CHUNK_SIZE:
+            return [data]
+        transfer_id = self._next_msg_id()
+        fragments = CubeNetFragments.split(data, self.node_name, destination_id, transfer_id,
+                                           self.FRAGMENT_CHUNK_SIZE)
+        now = time.time()
+        with self._sent_fragments_lock:
+            self._sent_fragments[transfer_id] = (now, fragments, ip, port)
+            while self._sent_fragments:
+                oldest_timestamp = next(iter(self._sent_fragments.values()))[0]
+                if len(self._sent_fragments) <= self.SENT_FRAGMENTS_MAXLEN \
+                        and now - oldest_timestamp <= self.SENT_FRAGMENTS_TTL:
+                    break
+                self._sent_fragments.popitem(last=False)
+        self.stats.increment("fragmented_datagrams_sent")
+        return fragments
+
+    def _resend_fragments(self, transfer_id: int, indexes: List[int]) -> bool:
+        """Answers a NACK by resending only the requested fragments"""
+        self.stats.increment("fragment_nacks_received")
+        with self._sent_fragments_lock:
+            sent = self._sent_fragments.get(transfer_id)
+        if sent is None:
+            self.log.warning(f"Received a NACK for an unknown or expired transfer: {transfer_id}")
+            return False
+        _, fragments, ip, port = sent
+        ok = True
+        for index in indexes:
+            if index < len(fragments):
+                ok = self._send_bytes_with_udp(fragments[index], ip, port) and ok
+                self.stats.increment("fragments_resent")
+        return ok
+
+    def _send_datagram_with_udp(self, data: bytes, ip: str, port: int,
+                                destination_id: int = cubeid.EVERYONE_NODE_ID) -> bool:
+        """Sends the data in one datagram, or in fragments if it's too large.
+        Returns True if everything was sent, False otherwise."""
+        for datagram in self._fragment_datagram(data, ip, port, destination_id):
+            if not self._send_bytes_with_udp(datagram, ip, port):
+                return False
+        return True
+
+    def _next_msg_id(self) -> int:
+        """Returns a new message ID, unique for this node"""
+        with self._msg_id_lock:
+            msg_id = self._next_msg_id_value
+            self._next_msg_id_value = (msg_id + 1) & self.MSG_ID_MASK
+            return msg_id
+
+    def register_pending_ack(self, msg_to_ack: cm.CubeMessage, ack_sender: NodeName = None) -> CubePendingAck:
+        """Registers an ACK to wait for. Do it before sending the message so that a fast ACK cannot be missed.
+        If a matching ACK already arrived, the returned pending ACK is already complete.
+        A message with an ID is also registered under its legacy content hash, because nodes which
+        do not know about message IDs acknowledge it by hash."""
+        legacy_key = (msg_to_ack.sender, msg_to_ack.legacy_hash) if msg_to_ack.msg_id is not None else None
+        pending_ack = CubePendingAck(msg_to_ack.key, ack_sender, legacy_key)
+        with self._pending_acks_lock:
+            self._forget_expired_unclaimed_acks()
+            for acked_key in pending_ack.keys:
+                unclaimed = self._unclaimed_acks.get(acked_key, [])
+                for i, (_, ack_msg) in enumerate(unclaimed):
+                    if pending_ack.matches(ack_msg):
+                        del unclaimed[i]
+                        if not unclaimed:
+                            del self._unclaimed_acks[acked_key]
+                        pending_ack.complete(ack_msg)
+                        return pending_ack
+            for acked_key in pending_ack.keys:
+                self._pending_acks.setdefault(acked_key, []).append(pending_ack)
+        return pending_ack
+
+    def unregister_pending_ack(self, pending_ack: CubePendingAck):
+        """Stops waiting for an ACK"""
+        with self._pending_acks_lock:
+            for acked_key in pending_ack.keys:
+                pending_acks = self._pending_acks.get(acked_key)
+                if not pending_acks:
+                    continue
+                # noinspection PyBroadException
+                try:
+                    pending_acks.remove(pending_ack)
+                except:
+                    pass
+                if not pending_acks:
+                    del self._pending_acks[acked_key]
+
+    def get_pending_acks(self) -> Tuple[CubePendingAck, ...]:
+        """Returns the ACKs we're currently waiting for"""
+        with self._pending_acks_lock:
+            return tuple({pending_ack: None for pending_acks in self._pending_acks.values()
+                          for pending_ack in pending_acks})
+
+    def _complete_pending_acks(self, ack_msg: cm.CubeMsgAck) -> bool:
+        """Called by the listen thread when an ACK arrives. Completes the pending ACKs it matches.
+        If nobody is waiting for it, keeps it a short while in case a waiter registers late.
+        Returns True if at least one pending ACK was completed."""
+        acked_sender, acked_id = ack_msg.acked_key
+        if acked_sender is None:
+            # ACK referencing a content hash: it can only be matched against our own messages anyway,
+            # which are registered under their legacy hash too (see register_pending_ack)
+            acked_sender = self.node_name
+        elif acked_sender != self.node_name:
+            # this ACK is for a message sent by another node
+            self.stats.increment("acks_for_other_nodes")
+            return False
+        acked_key = (acked_sender, acked_id)
+        completed = False
+        with self._pending_acks_lock:
+            for pending_ack in self._pending_acks.get(acked_key, []):
+                if not pending_ack.is_complete() and pending_ack.matches(ack_msg):
+                    pending_ack.complete(ack_msg)
+                    completed = True
+            if not completed:
+                self._unclaimed_acks.setdefault(acked_key, []).append((time.time(), ack_msg))
+                self._unclaimed_acks.move_to_end(acked_key)
+                while len(self._unclaimed_acks) > self.UNCLAIMED_ACKS_MAXLEN:
+                    self._unclaimed_acks.popitem(last=False)
+        if not completed:
+            self.log.debug(f"Received an ACK nobody is waiting for: ({ack_msg.shortinfo})")
+        return completed
+
+    def _forget_expired_unclaimed_acks(self):
+        """Removes the old unclaimed ACKs. Must be called with _pending_acks_lock held"""
+        expiration_time = time.time() - self.UNCLAIMED_ACK_TTL
+        while self._unclaimed_acks:
+            acked_key, unclaimed = next(iter(self._unclaimed_acks.items()))
+            if unclaimed[-1][0] > expiration_time:
+                break
+            del self._unclaimed_acks[acked_key]
 
     def _wait_for_udp_packet(self, timeout=None) -> Tuple[bytes, Tuple[str, int]]:
         """Receives a UDP packet. Returns the data and the address of the sender.
-        If ip is None, uses the default listen IP.
-        If port is None, uses the default port.
         If timeout is None, uses the default timeout.
         If timeout is 0, waits forever."""
         if timeout is None:
             timeout = self.UDP_LISTEN_TIMEOUT
-        # noinspection PyBroadException
-        try:
-            if timeout != 0:
-                self._udp_socket.settimeout(timeout)
-            data, addr = self._udp_socket.recvfrom(self.UDP_BUFSIZE)
-            self.log.debug(f"Received UDP packet from {addr}: {len(data)} bytes")
-            return data, addr
-        except:
-            return b"", ("", 0)
-
-    def _remove_useless_ack_messages(self):
-        """Removes ack messages from the incoming queue which do not match any message in the ack_wait_queue"""
-        messages = self.get_incoming_msg_queue()
-        for msg in messages:
-            if msg.msgtype == cm.CubeMsgTypes.ACK:
-                for msg_to_be_acked in self.get_ack_wait_queue():
-                    if msg.is_ack_of(msg_to_be_acked):
-                        break
-                else:
-                    # self.log.warning(f"Removing useless ack message: ({msg.hash})")
-                    self.remove_msg_from_incoming_queue(msg, force_remove=True)
+        end_time = time.time() + timeout
+        while timeout == 0 or time.time() < end_time:
+            remaining = self.UDP_LISTEN_TIMEOUT if timeout == 0 else max(0.0, end_time - time.time())
+            if not self._wait_for_readable_socket(remaining):
+                continue
+            data, addr = self._receive_udp_packet_nowait()
+            if data and addr:
+                self.log.debug(f"Received UDP packet from {addr}: {len(data)} bytes")
+                return data, addr
+        return b"", ("", 0)
 
     def _handle_generic_message(self, message: cm.CubeMessage) -> bool:
         """Handles messages in a manner common to all nodes.
@@ -383,158 +1660,374 @@ class CubeNetworking:
             if self._udp_socket is None or self._udp_socket.fileno() == -1:
                 assert self.init_socket()
 
-            if self.ONLY_USE_BROADCAST:
+            if self.ONLY_USE_BROADCAST and not self.is_multicast_ip(ip):
                 ip = self.UDP_BROADCAST_IP
             with self._udp_send_lock:
                 result = self._udp_socket.sendto(data, (ip, port))
                 assert result
-                self.log.debug(f"Sent bytes to {ip}:{port}: {data.decode()}")
+                self.log.debug(f"Sent {len(data)} bytes to {ip}:{port}")
                 return True
         except Exception as e:
+            if self._multicast_enabled and self.is_multicast_ip(ip):
+                self.log.warning(f"Could not send to the multicast group {ip}, falling back to broadcast: {e}")
+                self._multicast_enabled = False
+                # the listen thread will try multicast again in MULTICAST_REJOIN_PERIOD
+                self._last_multicast_join_attempt = time.time()
+                self.stats.increment("multicast_fallbacks")
+                return self._send_bytes_with_udp(data, self.UDP_BROADCAST_IP, port)
             self.log.error(f"Error sending bytes to {ip}:{port}: {e}")
             return False
 
     def send_msg_with_udp(self, message: cm.CubeMessage, ip: str = None, port: int = None, require_ack:bool=None,
-                          ack_timeout: int = None, nb_tries: int = None) -> SendReport:
+                          ack_timeout: int = None, nb_tries: int = None, retry_later: bool = True,
+                          keep_msg_id: bool = False) -> SendReport:
         """Sends a message with UDP.
         If require_ack is None, uses the message's require_ack attribute.
+        If retry_later is True, a message which was not acknowledged is put in the retry queue.
+        Each call is a new send and gives the message a new ID, unless keep_msg_id is True:
+        the retries of a send keep its ID, so that the receiver can recognize them.
         Returns True if the message was acknowledged, False otherwise."""
-        message.sender = self.node_name
+        if not keep_msg_id or message.sender != self.node_name or message.msg_id is None:
+            message.sender = self.node_name
+            message.msg_id = self._next_msg_id()
 
         if not message.is_valid():
             self.log.error(f"Invalid message: {message}")
             return SendReport(False, None)
 
-        if not ip:
-            ip = self.UDP_BROADCAST_IP
         if port is None:
             port = self.UDP_PORT
-
-        if self.ONLY_USE_BROADCAST:
-            ip = self.UDP_BROADCAST_IP
+        given_ip = ip
+        ip = self._destination_ip(message.destination, given_ip)
 
         # if require_ack is not None, override the message's require_ack attribute
         if require_ack is not None:
             message.require_ack = require_ack
-        # if ack_timeout is None, use the default value
-        if ack_timeout is None:
+        # if ack_timeout is None, adapt it to the measured round-trip time to the destination
+        rtt_estimator = None
+        if ack_timeout is None and self.ADAPTIVE_ACK_TIMEOUT:
+            rtt_estimator = self.get_rtt_estimator(message.destination)
+        elif ack_timeout is None:
             ack_timeout = self.ACK_WAIT_TIMEOUT
         # if nb_tries is None, use the default value
         if nb_tries is None:
             nb_tries = self.ACK_NB_TRIES
 
         self.log.debug(f"Sending message to {ip}:{port} ({message.shortinfo}) : {message} ")
-        if not self._send_bytes_with_udp(message.to_bytes(), ip, port):
-            return SendReport(False, None)
-
+        data = message.to_bytes(binary=self._sends_binary_to(message.destination))
+        destination_id = cm.CubeMsgBinaryCodec.destination_to_node_id(message.destination)
         if not message.require_ack:
-            return SendReport(True, None)
-
-        # if we require an ack, wait for it and retry if necessary
-        for i in range(nb_tries):
-            ack_msg = self.wait_for_ack_of(message, timeout=ack_timeout)
-            if ack_msg is not None:
-                return SendReport(True, ack_msg)
-            self.log.warning(f"Re-sending (try {i + 1}/{nb_tries}) : ({message.shortinfo})")
-            if not self._send_bytes_with_udp(message.to_bytes(), ip, port):
+            return SendReport(self._send_datagram_with_udp(data, ip, port, destination_id), None)
+
+        # if we require an ack, register it before sending so that it cannot arrive before we wait for it
+        pending_ack = self.register_pending_ack(message)
+        first_ip = ip
+        try:
+            send_time = time.time()
+            if not self._send_datagram_with_udp(data, ip, port, destination_id):
                 return SendReport(False, None)
+            # wait for the ack and retry if necessary
+            wait_deadline = send_time + self.ACK_WAIT_TIMEOUT * nb_tries
+            for i in range(nb_tries):
+                timeout = rtt_estimator.rto if rtt_estimator is not None else ack_timeout
+                if rtt_estimator is not None and i == nb_tries - 1:
+                    # the last wait uses what's left of the total wait budget
+                    timeout = max(timeout, wait_deadline - time.time())
+                ack_msg = self._wait_for_pending_ack(pending_ack, timeout=timeout)
+                if ack_msg is not None:
+                    # Karn's rule: the RTT of a retransmitted message is ambiguous, don't measure it
+                    if rtt_estimator is not None and i == 0:
+                        rtt_estimator.add_sample(time.time() - send_time)
+                    if i > 0 and self.is_multicast_ip(first_ip):
+                        self._on_ack_of_broadcast_retransmission(message.destination)
+                    self._on_msg_delivered(message)
+                    return SendReport(True, ack_msg)
+                if rtt_estimator is not None:
+                    rtt_estimator.back_off()
+                self.log.warning(f"Re-sending (try {i + 1}/{nb_tries}) : ({message.shortinfo})")
+                # the destination may not have joined its multicast group: retransmit by broadcast
+                ip = self._destination_ip(message.destination, given_ip, use_multicast=False)
+                if not self._send_datagram_with_udp(data, ip, port, destination_id):
+                    return SendReport(False, None)
+        finally:
+            self.unregister_pending_ack(pending_ack)
         self.log.error(f"Failed to get an ack for this message after {nb_tries} tries : ({message.shortinfo})")
-        self.add_msg_to_retry_queue(message)
+        if retry_later:
+            # a copy, so that the caller can send the message again without changing the ID of the retries
+            self.add_msg_to_retry_queue(message.copy(), ip, port)
         return SendReport(True, None)
 
     def send_msg_to(self, message: cm.CubeMessage, node_name: str, require_ack=False, nb_tries=None) -> SendReport:
         """Sends a message to a node. Returns True if the message was acknowledged, False otherwise."""
         self.log.info(f"Sending message to {node_name}: ({message.shortinfo}), require_ack: {require_ack}\n{message}")
+        message.destination = node_name
         ip = self.nodes_list.get_node_ip_from_node_name(node_name)
         return self.send_msg_with_udp(message, ip, require_ack=require_ack, nb_tries=nb_tries)
 
+    def send_msg_to_many(self, message: cm.CubeMessage, node_names: Iterable[NodeName], require_ack=True,
+                         nb_tries: int = None, ack_timeout: Seconds = None,
+                         retry_later: bool = True) -> Dict[NodeName, SendReport]:
+        """Sends a message to several nodes and tracks all their ACKs at the same time.
+        The message is sent once to their group if they form one (all the cubeboxes, or all the other nodes),
+        else to each of them without waiting in between. Only the nodes which did not acknowledge it get it again.
+        Returns the delivery report of each node."""
+        node_names = [node_name for node_name in dict.fromkeys(node_names) if node_name != self.node_name]
+        if not node_names:
+            return {}
+        message.sender = self.node_name
+        message.msg_id = self._next_msg_id()
+        if not message.is_valid():
+            self.log.error(f"Invalid message: {message}")
+            return {node_name: SendReport(False, None) for node_name in node_names}
+        message.require_ack = require_ack
+        if nb_tries is None:
+            nb_tries = self.ACK_NB_TRIES
+        group = self._group_of(node_names)
+        self.log.info(f"Sending message to {group or node_names}: ({message.shortinfo}), require_ack: {require_ack}")
+
+        # register the ACKs before sending so that none of them can be missed
+        pending_acks = {node_name: self.register_pending_ack(message, ack_sender=node_name)
+                        for node_name in node_names} if require_ack else {}
+        reports: Dict[NodeName, SendReport] = {}
+        # the retransmissions are broadcast, see send_msg_with_udp
+        sent_by_multicast = {node_name for node_name in node_names
+                             if self.is_multicast_ip(self._destination_ip(group or node_name, None))}
+        try:
+            send_time = time.time()
+            if group is not None:
+                group_sent_ok = self._send_msg_copy_to(message, group)
+                sent_ok = {node_name: group_sent_ok for node_name in node_names}
+            else:
+                sent_ok = {node_name: self._send_msg_copy_to(message, node_name) for node_name in node_names}
+            for node_name in node_names:
+                if not sent_ok[node_name] or not require_ack:
+                    reports[node_name] = SendReport(sent_ok[node_name], None)
+            waiting_nodes = [node_name for node_name in node_names if node_name not in reports]
+            wait_deadline = send_time + self.ACK_WAIT_TIMEOUT * nb_tries
+            for i in range(nb_tries):
+                if not waiting_nodes:
+                    break
+                # wait for all the remaining ACKs at once, until the longest timeout of the remaining nodes
+                timeout = ack_timeout if ack_timeout is not None else max(
+                    self.get_ack_timeout(node_name) for node_name in waiting_nodes)
+                if ack_timeout is None and i == nb_tries - 1:
+                    # the last wait uses what's left of the total wait budget, see send_msg_with_udp
+                    timeout = max(timeout, wait_deadline - time.time())
+                deadline = time.time() + timeout
+                for node_name in waiting_nodes:
+                    pending_acks[node_name].wait(max(0.0, deadline - time.time()))
+                for node_name in list(waiting_nodes):
+                    pending_ack = pending_acks[node_name]
+                    if pending_ack.is_complete():
+                        waiting_nodes.remove(node_name)
+                        reports[node_name] = SendReport(True, pending_ack.ack_msg)
+                        # Karn's rule: the RTT of a retransmitted message is ambiguous, don't measure it
+                        if i == 0 and self.ADAPTIVE_ACK_TIMEOUT and ack_timeout is None:
+                            self.get_rtt_estimator(node_name).add_sample(pending_ack.completion_timestamp - send_time)
+                        if i > 0 and node_name in sent_by_multicast:
+                            self._on_ack_of_broadcast_retransmission(node_name)
+                        delivered_msg = message.copy()
+                        delivered_msg.destination = node_name
+                        self._on_msg_delivered(delivered_msg)
+                    else:
+                        if self.ADAPTIVE_ACK_TIMEOUT and ack_timeout is None:
+                            self.get_rtt_estimator(node_name).back_off()
+                        if i < nb_tries - 1:
+                            self.log.warning(f"Re-sending (try {i + 1}/{nb_tries}) to {node_name} : ({message.shortinfo})")
+                            self._send_msg_copy_to(message, node_name, use_multicast=False)
+        finally:
+            for pending_ack in pending_acks.values():
+                self.unregister_pending_ack(pending_ack)
+        for node_name in node_names:
+            if node_name not in reports:
+                self.log.error(f"No ack from {node_name} after {nb_tries} tries : ({message.shortinfo})")
+                reports[node_name] = SendReport(True, None)
+                if retry_later:
+                    retry_msg = message.copy()
+                    retry_msg.destination = node_name
+                    self.add_msg_to_retry_queue(retry_msg, self.nodes_list.get_node_ip_from_node_name(node_name))
+        return {node_name: reports[node_name] for node_name in node_names}
+
+    def _group_of(self, node_names: List[NodeName]) -> Optional[NodeName]:
+        """Returns the group destination made of exactly these nodes, if any"""
+        if len(node_names) < 2:
+            return None
+        if set(node_names) == set(cubeid.CUBEBOXES_NODENAMES):
+            return cubeid.ALL_CUBEBOXES_NODENAME
+        if set(node_names) == set(cubeid.ALL_NODENAMES) - {self.node_name}:
+            return cubeid.EVERYONE_NODENAME
+        return None
+
+    def _send_msg_copy_to(self, message: cm.CubeMessage, destination: NodeName, use_multicast: bool = True) -> bool:
+        """Sends the message, with its current ID, to a node or a group of nodes, without waiting for any ACK"""
+        msg_copy = message.copy()
+        msg_copy.destination = destination
+        ip = self._destination_ip(destination, self.nodes_list.get_node_ip_from_node_name(destination), use_multicast)
+        data = msg_copy.to_bytes(binary=self._sends_binary_to(destination))
+        destination_id = cm.CubeMsgBinaryCodec.destination_to_node_id(destination)
+        return self._send_datagram_with_udp(data, ip, self.UDP_PORT, destination_id)
+
     def send_msg_to_all(self, message: cm.CubeMessage, require_ack=False, nb_tries=None) -> SendReport:
         """Sends a message to all nodes. Returns True if the message was acknowledged by all nodes, False otherwise."""
         self.log.info(f"Sending message to all nodes: ({message.shortinfo}), require_ack: {require_ack}\n{message}")
+        message.destination = None
         return self.send_msg_with_udp(message, self.UDP_BROADCAST_IP, require_ack=require_ack, nb_tries=nb_tries)
 
     def send_msg_to_cubemaster(self, message: cm.CubeMessage, require_ack=False, nb_tries=None) -> SendReport:
         """Sends a message to the CubeMaster. Returns True if the message was acknowledged, False otherwise."""
         self.log.info(
             f"Sending message to CubeMaster ({self.nodes_list.cubemaster.ip}): ({message.shortinfo}), require_ack: {require_ack}\n{message}")
+        message.destination = cubeid.CUBEMASTER_NODENAME
         return self.send_msg_with_udp(message, self.nodes_list.cubemaster.ip, require_ack=require_ack, nb_tries=nb_tries)
 
     def send_msg_to_frontdesk(self, message: cm.CubeMessage, require_ack=False, nb_tries=None) -> SendReport:
         """Sends a message to the FrontDesk. Returns True if the message was acknowledged, False otherwise."""
         self.log.info(
             f"Sending message to FrontDesk ({self.nodes_list.frontdesk.ip}): ({message.shortinfo}), require_ack: {require_ack}\n{message}")
+        message.destination = cubeid.CUBEFRONTDESK_NODENAME
         return self.send_msg_with_udp(message, self.nodes_list.frontdesk.ip, require_ack=require_ack, nb_tries=nb_tries)
 
-    def get_ack_wait_queue(self) -> Tuple[CubeMessage, ...]:
-        """Returns the ack_wait_queue"""
-        with self._ack_wait_queue_lock:
-            return tuple(self._ack_wait_queue)
+    def send_msg_async(self, message: cm.CubeMessage, ip: str = None, port: int = None, require_ack: bool = None,
+                       ack_timeout: Seconds = None, nb_tries: int = None,
+                       callback: Callable[[SendReport], None] = None, retry_later: bool = False) -> 'Future[SendReport]':
+        """Same as send_msg_with_udp, but returns immediately.
+        The send and its retransmissions are performed by a background thread.
+        Returns a Future whose result is the SendReport. If a callback is given,
+        it is called with the SendReport, from the background thread, once the send is over.
+        Unlike send_msg_with_udp, a message which was not acknowledged is not retried later by default,
+        since the caller gets the report and handles the failure."""
+        with self._async_send_executor_lock:
+            if self._async_send_executor is None:
+                self._async_send_executor = ThreadPoolExecutor(
+                    max_workers=self.ASYNC_SEND_WORKERS, thread_name_prefix=f"{self.node_name}-send")
+            future = self._async_send_executor.submit(
+                self.send_msg_with_udp, message, ip, port, require_ack, ack_timeout, nb_tries, retry_later)
+        if callback is not None:
+            future.add_done_callback(lambda done_future: self._run_async_send_callback(callback, done_future))
+        return future
+
+    def _run_async_send_callback(self, callback: Callable[[SendReport], None], future: 'Future[SendReport]'):
+        # noinspection PyBroadException
+        try:
+            report = future.result() if not future.cancelled() else SendReport(False, raw_info="Send cancelled")
+        except Exception as e:
+            self.log.error(f"Error in async send: {e}")
+            report = SendReport(False, raw_info=f"Error in async send: {e}")
+        try:
+            callback(report)
+        except Exception as e:
+            self.log.error(f"Error in async send callback: {e}")
+
+    def send_msg_to_async(self, message: cm.CubeMessage, node_name: str, require_ack=False, nb_tries=None,
+                          callback: Callable[[SendReport], None] = None,
+                          retry_later: bool = False) -> 'Future[SendReport]':
+        """Non-blocking version of send_msg_to. See send_msg_async."""
+        self.log.info(f"Sending message to {node_name} asynchronously: ({message.shortinfo}), require_ack: {require_ack}")
+        message.destination = node_name
+        ip = self.nodes_list.get_node_ip_from_node_name(node_name)
+        return self.send_msg_async(message, ip, require_ack=require_ack, nb_tries=nb_tries, callback=callback,
+                                   retry_later=retry_later)
+
+    def send_msg_to_cubemaster_async(self, message: cm.CubeMessage, require_ack=False, nb_tries=None,
+                                     callback: Callable[[SendReport], None] = None,
+                                     retry_later: bool = False) -> 'Future[SendReport]':
+        """Non-blocking version of send_msg_to_cubemaster. See send_msg_async."""
+        return self.send_msg_to_async(message, cubeid.CUBEMASTER_NODENAME, require_ack=require_ack,
+                                      nb_tries=nb_tries, callback=callback, retry_later=retry_later)
+
+    def send_msg_to_frontdesk_async(self, message: cm.CubeMessage, require_ack=False, nb_tries=None,
+                                    callback: Callable[[SendReport], None] = None,
+                                    retry_later: bool = False) -> 'Future[SendReport]':
+        """Non-blocking version of send_msg_to_frontdesk. See send_msg_async."""
+        return self.send_msg_to_async(message, cubeid.CUBEFRONTDESK_NODENAME, require_ack=require_ack,
+                                      nb_tries=nb_tries, callback=callback, retry_later=retry_later)
+
+    def scatter_gather(self, message: cm.CubeMessage, destination: NodeName, expected_nodes: Iterable[NodeName],
+                       reply_msgtype: cm.CubeMsgTypes, timeout: Seconds = None) -> CubeScatterGatherReport:
+        """Sends one request to a group of nodes (e.g. cubeid.ALL_CUBEBOXES_NODENAME)
+        and collects their replies concurrently, until every expected node replied or the deadline is reached.
+        If timeout is None, uses the default ACK timeout."""
+        timeout = self.ACK_WAIT_TIMEOUT if timeout is None else timeout
+        missing_nodes = list(expected_nodes)
+        replies = {}
+        start = time.time()
+        deadline = start + timeout
+        with self.subscribe(reply_msgtype, accept=lambda msg: msg.sender in missing_nodes) as subscription:
+            report = self.send_msg_to(message, destination, require_ack=False)
+            if not report.sent_ok:
+                self.log.error(f"scatter_gather: failed to send ({message.shortinfo}) to {destination}")
+                return CubeScatterGatherReport(sent_ok=False, missing_nodes=missing_nodes)
+            while missing_nodes and self._keep_running:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                reply_msg = subscription.get(remaining)
+                if reply_msg is not None and reply_msg.sender in missing_nodes:
+                    replies[reply_msg.sender] = reply_msg
+                    missing_nodes.remove(reply_msg.sender)
+        gather_report = CubeScatterGatherReport(sent_ok=True, replies=replies, missing_nodes=missing_nodes,
+                                                elapsed=time.time() - start)
+        if missing_nodes:
+            self.log.warning(f"scatter_gather: no {reply_msgtype.name} from {missing_nodes}")
+        else:
+            self.log.info(f"scatter_gather: all {len(replies)} replies received in {gather_report.elapsed:.3f} sec")
+        return gather_report
 
-    # TESTME
-    # TODO: redo. this will be made redundant with the new ack handling system directly in listenloop
-    def wait_for_ack_of(self, msg_to_ack: cm.CubeMessage, timeout: int = None, ack_sender=None) -> Optional[cm.CubeMsgAck]:
+    def wait_for_ack_of(self, msg_to_ack: cm.CubeMessage, timeout: Seconds = None, ack_sender=None) -> Optional[cm.CubeMsgAck]:
         """Waits for an acknowledgement of a message. Returns the ack message if it was received, None otherwise.
         If timeout is None, uses the default timeout.
         If timeout is 0, wait forever."""
-        self.add_msg_to_ack_wait_queue(msg_to_ack)
+        pending_ack = self.register_pending_ack(msg_to_ack, ack_sender=ack_sender)
+        try:
+            return self._wait_for_pending_ack(pending_ack, timeout)
+        finally:
+            self.unregister_pending_ack(pending_ack)
 
+    def _wait_for_pending_ack(self, pending_ack: CubePendingAck, timeout: Seconds = None) -> Optional[cm.CubeMsgAck]:
+        """Waits until the listen thread completes the pending ACK.
+        If timeout is None, uses the default timeout.
+        If timeout is 0, wait forever."""
         if timeout is None:
             timeout = self.ACK_WAIT_TIMEOUT
-        end_time = time.time() + timeout
-
-        self.log.info(f"Waiting for ack of message: ({msg_to_ack.hash}), timeout: {timeout} s ...")
-        while self._keep_running:
-            # print(",", end="")
-            if timeout != 0 and time.time() > end_time:
-                self.log.error(f"wait_for_ack_of timeout for : ({msg_to_ack.hash})")
-                return None
-            incoming_messages = self.get_incoming_msg_queue()
-            for msg in incoming_messages:
-                # print("/", end="")
-                # if it's an ACK message acknowledging the message we're waiting for, success
-                if msg.is_ack_of(msg_to_ack):
-                    ack_msg = cm.CubeMsgAck(copy_msg=msg)
-                    self.log.info(f"Received ack of message: ({msg_to_ack.hash}) with ack_info='{ack_msg.ack_info}'")
-                    if ack_sender is not None and msg.sender != ack_sender:
-                        self.log.warning(f"Received ack from unexpected sender: {msg.sender} instead of {ack_sender}")
-                        continue
-                    self.log.info(f"It's the awaited message. Removing this ack msg and our msg waiting to be acked")
-                    self.remove_msg_from_incoming_queue(msg, force_remove=True)
-                    self.remove_msg_from_ack_wait_queue(msg_to_ack)
-                    ack_msg = cm.CubeMsgAck(copy_msg=msg)
-                    return ack_msg
-            time.sleep(LOOP_PERIOD_SEC)
-        return None
+        self.log.info(f"Waiting for ack of message: ({pending_ack.acked_key}), timeout: {timeout} s ...")
+        if timeout != 0:
+            ack_msg = pending_ack.wait(timeout)
+        else:
+            ack_msg = None
+            while self._keep_running and ack_msg is None:
+                ack_msg = pending_ack.wait(self.ACK_WAIT_TIMEOUT)
+        if ack_msg is None:
+            self.log.error(f"wait_for_ack_of timeout for : ({pending_ack.acked_key})")
+            return None
+        self.log.info(f"Received ack of message: ({pending_ack.acked_key}) from {ack_msg.sender} with ack_info='{ack_msg.ack_info}'")
+        return ack_msg
 
     def wait_for_message(self, msgtype: cm.CubeMsgTypes, timeout: int = None) -> Optional[CubeMessage]:
         """Waits for a message of a specific type. Returns the message if it was received, None otherwise.
         If timeout is None, uses the default timeout.
-        If timeout is 0, wait forever."""
-        self._is_waiting_for_message = True
-        try:
-            if timeout is None:
-                timeout = self.ACK_WAIT_TIMEOUT
-            end_time = time.time() + timeout
-
-            self.log.info(f"Waiting for message of type {msgtype} ...")
-            while self._keep_running:
-                if timeout != 0 and time.time() > end_time:
-                    self.log.error(f"wait_for_message timeout for message of type {msgtype}")
-                    return None
-                with self._waiting_for_message_queue_lock:
-                    possible_messages = tuple(self._waiting_for_message_queue)
-                for msg in possible_messages:
-                    if msg.msgtype == msgtype:
-                        self.log.success(f"Received awaited message of type {msgtype} : ({msg.hash})")
-                        self.remove_msg_from_incoming_queue(msg)
-                        self.remove_msg_from_waiting_for_message_queue(msg)
-                        self._is_waiting_for_message = False
-                        return msg
-                time.sleep(LOOP_PERIOD_SEC)
-        except Exception as e:
-            self.log.error(f"Error in wait_for_message: {e}")
-            self._is_waiting_for_message = False
+        If timeout is 0, wait forever.
+        Only the messages received after the call are considered:
+        to wait for the reply to a request, subscribe() before sending it."""
+        with self.subscribe(msgtype) as subscription:
+            return self.wait_for_subscribed_message(subscription, timeout)
+
+    def wait_for_subscribed_message(self, subscription: CubeMsgSubscription,
+                                    timeout: int = None) -> Optional[CubeMessage]:
+        """Waits for a message to be delivered to the subscription, with the same timeout rules as wait_for_message()"""
+        if timeout is None:
+            timeout = self.ACK_WAIT_TIMEOUT
+        self.log.info(f"Waiting for message of type {subscription.msgtype_names} ...")
+        if timeout != 0:
+            msg = subscription.get(timeout)
+        else:
+            msg = None
+            while self._keep_running and msg is None and subscription.is_open:
+                msg = subscription.get(self.ACK_WAIT_TIMEOUT)
+        if msg is None:
+            self.log.error(f"wait_for_message timeout for message of type {subscription.msgtype_names}")
             return None
+        self.log.success(f"Received awaited message of type {msg.msgtype} : ({msg.hash})")
+        return msg
 
 
 def test_ack_timeout():
@@ -562,6 +2055,502 @@ def test_ack_timeout():
     exit(0)
 
 
+@contextmanager
+def loopback_nodes(*node_names: NodeName) -> Iterator[Tuple[CubeNetworking, ...]]:
+    """Test fixture: runs networking nodes on the loopback interface (see use_loopback_config).
+    On exit, stops them and restores the class attributes changed by use_loopback_config."""
+    saved_config = {name: getattr(CubeNetworking, name) for name in CubeNetworking.LOOPBACK_CONFIG_ATTRIBUTES}
+    CubeNetworking.use_loopback_config()
+    nets = []
+    try:
+        for node_name in node_names:
+            nets.append(CubeNetworking(node_name))
+            nets[-1].run()
+        yield tuple(nets)
+    finally:
+        for net in nets:
+            net.stop()
+        for name, value in saved_config.items():
+            setattr(CubeNetworking, name, value)
+
+
+def lose_datagrams(net: CubeNetworking, is_lost: Callable[[bytes], bool]):
+    """Test helper: the datagrams `net` sends for which is_lost(data) returns True are silently dropped"""
+    send_bytes = net._send_bytes_with_udp
+
+    def lossy_send_bytes(data: bytes, ip: str, port: int) -> bool:
+        return True if is_lost(data) else send_bytes(data, ip, port)
+
+    net._send_bytes_with_udp = lossy_send_bytes
+
+
+def lose_first_datagrams(net: CubeNetworking, nb_lost: int):
+    """Test helper: the first `nb_lost` datagrams `net` sends are silently dropped"""
+    remaining = [nb_lost]
+
+    def is_lost(_: bytes) -> bool:
+        remaining[0] -= 1
+        return remaining[0] >= 0
+
+    lose_datagrams(net, is_lost)
+
+
+def test_fragmentation():
+    """Sends a message too large for one datagram, losing some of its fragments on the way,
+    and checks that it's reassembled after only the lost fragments were re-sent"""
+    import random
+    import string
+    with loopback_nodes(cubeid.CUBEFRONTDESK_NODENAME, cubeid.CUBEMASTER_NODENAME) as (net1, net2):
+        # drop fragments 3 and 7 the first time they're sent
+        lost_indexes = {3, 7}
+
+        def is_lost(data: bytes) -> bool:
+            if data[0] != CubeNetFragments.FRAGMENT_MARKER:
+                return False
+            index = CubeNetFragments.parse(data)[3]
+            if index not in lost_indexes:
+                return False
+            lost_indexes.remove(index)
+            return True
+
+        lose_datagrams(net1, is_lost)
+        alert = "".join(random.choice(string.ascii_letters) for _ in range(60000))
+        assert net1.send_msg_with_udp(cm.CubeMsgAlert(net1.node_name, alert=alert), require_ack=False)
+        end_time = time.time() + CubeNetworking.FRAGMENT_REASSEMBLY_TIMEOUT
+        while not net2.get_incoming_msg_queue() and time.time() < end_time:
+            time.sleep(0.01)
+        received = net2.get_incoming_msg_queue()
+    assert received and cm.CubeMsgAlert(copy_msg=received[0]).alert == alert
+    assert net1.stats.get("fragments_resent") == 2
+
+
+def test_multicast_routing():
+    """Simulates a CubeMaster and two cubeboxes on this machine, and checks that a message
+    sent to a cubebox does not even reach the other one"""
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME, cubeid.cubebox_index_to_node_name(1),
+                        cubeid.cubebox_index_to_node_name(2)) as (master, cubebox1, cubebox2):
+        assert all(net.is_multicast_enabled() for net in (master, cubebox1, cubebox2))
+        master.send_msg_to(cm.CubeMsgOrderCubeboxToReset(master.node_name, cube_id=1), cubebox1.node_name)
+        master.send_msg_to_all(cm.CubeMsgHeartbeat(master.node_name))
+        time.sleep(0.2)
+    assert cubebox1.stats.get("messages_accepted") == 2
+    assert cubebox2.stats.get("packets_received") == 1
+
+
+def test_multicast_fallback():
+    """Simulates a cubebox which could not join its multicast groups, and checks that the CubeMaster
+    reaches it by broadcast, then sticks to broadcast for it, and that the cubebox joins its groups later"""
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME, cubeid.cubebox_index_to_node_name(1)) as (master, cubebox):
+        for group in cubebox.get_multicast_groups():
+            cubebox._udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, socket.inet_aton(group)
+                                           + socket.inet_aton(CubeNetworking.MULTICAST_INTERFACE_IP))
+        cubebox._multicast_joined = cubebox._multicast_enabled = False
+
+        def ack_loop():
+            while cubebox.is_running():
+                msg = cubebox.get_incoming_msg(timeout=0.1)
+                if msg is not None:
+                    cubebox.acknowledge_this_message(msg, ack_info=cm.CubeAckInfos.OK)
+
+        threading.Thread(target=ack_loop, daemon=True).start()
+        for _ in range(2):
+            msg = cm.CubeMsgOrderCubeboxToReset(master.node_name, cube_id=1)
+            msg.destination = cubebox.node_name
+            assert master.send_msg_with_udp(msg, require_ack=True, ack_timeout=0.2, retry_later=False).ack_ok
+        # only the first multicast datagram was lost
+        assert master.stats.get("multicast_peer_fallbacks") == 1
+        assert cubebox.stats.get("messages_accepted") == 2
+        # the listen thread joins the groups at its next attempt
+        cubebox._last_multicast_join_attempt = 0
+        end_time = time.time() + 1
+        while not cubebox.is_multicast_enabled() and time.time() < end_time:
+            time.sleep(0.01)
+        assert cubebox.is_multicast_enabled() and cubebox.stats.get("multicast_rejoins") == 1
+
+
+def test_slow_handler():
+    """Once the RTT to the CubeMaster is measured on fast ACKs, checks that a message whose handling
+    takes much longer is retransmitted quickly but still reported as acknowledged"""
+    with loopback_nodes(cubeid.CUBEFRONTDESK_NODENAME, cubeid.CUBEMASTER_NODENAME) as (frontdesk, master):
+        handling_time = [0.0]
+
+        def handle_messages():
+            while master.is_running():
+                msg = master.get_incoming_msg(timeout=0.1)
+                if msg is not None:
+                    time.sleep(handling_time[0])
+                    master.acknowledge_this_message(msg, ack_info=cm.CubeAckInfos.OK)
+
+        threading.Thread(target=handle_messages, daemon=True).start()
+        for _ in range(10):
+            assert frontdesk.send_msg_to_cubemaster(cm.CubeMsgCommand(frontdesk.node_name, full_command="test"),
+                                                    require_ack=True).ack_ok
+        assert frontdesk.get_ack_timeout(master.node_name) < 0.5
+        handling_time[0] = 1.0
+        report = frontdesk.send_msg_to_cubemaster(cm.CubeMsgCommand(frontdesk.node_name, full_command="test"),
+                                                  require_ack=True)
+    assert report.ack_ok
+    assert master.stats.get("duplicates_dropped") + master.stats.get("duplicates_reacked") >= 1
+
+
+def test_retry_scheduler():
+    """Sends messages to a cubebox which is offline, then brings it online
+    and checks that the retry thread delivers them, superseded configs excepted"""
+    cubebox_name = cubeid.cubebox_index_to_node_name(1)
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME) as (master,):
+        master.ACK_NB_TRIES = 1
+        master.ACK_WAIT_TIMEOUT = 0.5
+        master.RETRY_BASE_DELAY = 0.05
+        for _ in range(2):
+            master.send_msg_to(cm.CubeMsgOrderCubeboxToReset(master.node_name, cube_id=1), cubebox_name,
+                               require_ack=True)
+            master.send_msg_to(cm.CubeMsgConfig(master.node_name, config=cm.CubeConfig.get_config()), cubebox_name,
+                               require_ack=True)
+        assert master.get_retry_queue_stats()[cubebox_name]["depth"] == 3
+        # these failures are handled by their sender: they're not retried
+        master.send_msg_to(cm.CubeMsgButtonPress(master.node_name, start_timestamp=1.0, press_timestamp=2.0),
+                           cubebox_name, require_ack=True)
+        assert not master.send_msg_to_async(cm.CubeMsgOrderCubeboxToWaitForReset(master.node_name, cube_id=1),
+                                            cubebox_name, require_ack=True).result().ack_msg
+        assert master.get_retry_queue_stats()[cubebox_name]["depth"] == 3
+
+        with loopback_nodes(cubebox_name) as (cubebox,):
+            received = []
+            end_time = time.time() + 3
+            while master.get_retry_queue() and time.time() < end_time:
+                for msg in cubebox.get_incoming_msg_queue():
+                    received.append(msg.msgtype.name)
+                    cubebox.acknowledge_this_message(msg, ack_info=cm.CubeAckInfos.OK)
+                time.sleep(0.005)
+    assert not master.get_retry_queue()
+    assert master.stats.get("retries_coalesced") == 1
+    assert received.count(cm.CubeMsgTypes.CONFIG.name) == 1
+
+
+def test_duplicate_suppression():
+    """Loses the first ACKs of the CubeMaster, so that a cubebox retransmits its button press,
+    and checks that the press is handled once but acknowledged every time, with the same ack info"""
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME, cubeid.cubebox_index_to_node_name(1)) as (master, cubebox):
+        handled_keys = []
+
+        def handle_messages():
+            while master.is_running():
+                for msg in master.get_incoming_msg_queue():
+                    handled_keys.append(msg.key)
+                    master.acknowledge_this_message(msg, ack_info=cm.CubeAckInfos.OCCUPIED)
+                time.sleep(0.005)
+
+        threading.Thread(target=handle_messages, daemon=True).start()
+        lose_first_datagrams(master, 2)
+        report = cubebox.send_msg_to_cubemaster(
+            cm.CubeMsgButtonPress(cubebox.node_name, start_timestamp=1.0, press_timestamp=2.0), require_ack=True)
+    assert report.ack_info == cm.CubeAckInfos.OCCUPIED
+    assert len(handled_keys) == 1
+    assert master.stats.get("duplicates_reacked") == 2
+
+
+def test_unacked_duplicates():
+    """Checks that a message which was never acknowledged is handled again when it's retransmitted later,
+    and that two sends of the same message object are two different messages"""
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME, cubeid.cubebox_index_to_node_name(1)) as (master, cubebox):
+        master.DEDUP_UNACKED_TTL = 0.2
+        press_msg = cm.CubeMsgButtonPress(cubebox.node_name, start_timestamp=1.0, press_timestamp=2.0)
+        press_msg.destination = master.node_name
+        cubebox.send_msg_with_udp(press_msg, require_ack=False)
+        first_key = master.get_incoming_msg(timeout=1).key
+        # a quick retransmission is dropped while the message is being handled...
+        cubebox.send_msg_with_udp(press_msg, require_ack=False, keep_msg_id=True)
+        assert master.get_incoming_msg(timeout=0.1) is None
+        # ...but the handler never acknowledged it, so a later one is handled again
+        time.sleep(0.2)
+        cubebox.send_msg_with_udp(press_msg, require_ack=False, keep_msg_id=True)
+        assert master.get_incoming_msg(timeout=1).key == first_key
+        # a new send of the same object is a new message
+        cubebox.send_msg_with_udp(press_msg, require_ack=False)
+        assert master.get_incoming_msg(timeout=1).key != first_key
+    assert master.stats.get("duplicates_dropped") == 1
+
+
+def test_ack_from_old_format_peer():
+    """Simulates a CubeMaster which does not know about message IDs: it parses msgid as an ordinary field
+    and acknowledges by content hash. Checks that the cubebox still gets its ACK at the first try"""
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME, cubeid.cubebox_index_to_node_name(1)) as (master, cubebox):
+
+        def handle_messages():
+            while master.is_running():
+                for msg in master.get_incoming_msg_queue():
+                    parts = [part.split("=") for part in msg.to_string().split(cm.CubeMessage.SEPARATOR)[3:] if part]
+                    old_view = cm.CubeMessage(msg.msgtype, msg.sender, **dict(parts))
+                    master.remove_msg_from_incoming_queue(msg)
+                    master.acknowledge_this_message(old_view, ack_info=cm.CubeAckInfos.OK)
+                time.sleep(0.005)
+
+        threading.Thread(target=handle_messages, daemon=True).start()
+        report = cubebox.send_msg_to_cubemaster(
+            cm.CubeMsgButtonPress(cubebox.node_name, start_timestamp=1.0, press_timestamp=2.0), require_ack=True)
+    assert report.ack_info == cm.CubeAckInfos.OK
+    # acked at the first try: the CubeMaster never saw a retransmission
+    assert master.stats.get("duplicates_dropped") == master.stats.get("duplicates_reacked") == 0
+    assert not cubebox.get_pending_acks()
+
+
+def test_wire_format_negotiation():
+    """Checks that a node sends binary only to the peers known to read it, so that an older node keeps getting text"""
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME) as (master,):
+        cubebox_name = cubeid.cubebox_index_to_node_name(1)
+        sent = []
+        lose_datagrams(master, lambda data: sent.append(data) and False)
+
+        def is_order_sent_in_binary() -> bool:
+            order_msg = cm.CubeMsgOrderCubeboxToReset(master.node_name, cube_id=1)
+            order_msg.destination = cubebox_name
+            assert master.send_msg_with_udp(order_msg, require_ack=False)
+            return cm.CubeMsgBinaryCodec.is_binary(sent[-1])
+
+        # never heard from the cubebox: text
+        assert not is_order_sent_in_binary()
+        # a cubebox running an older version sends text without message IDs
+        old_msg = cm.CubeMsgHeartbeat(cubebox_name)
+        master._handle_incoming_packet(old_msg.to_bytes(), ("127.0.0.1", CubeNetworking.UDP_PORT))
+        assert not is_order_sent_in_binary()
+        # once upgraded, it sends binary
+        new_msg = cm.CubeMsgHeartbeat(cubebox_name)
+        new_msg.msg_id = 1
+        master._handle_incoming_packet(new_msg.to_bytes(binary=True), ("127.0.0.1", CubeNetworking.UDP_PORT))
+        assert is_order_sent_in_binary()
+        # the other cubeboxes were never heard from: the messages for all of them stay in text
+        assert not master._sends_binary_to(cubeid.ALL_CUBEBOXES_NODENAME)
+        # rolled back to the older version
+        master._handle_incoming_packet(old_msg.to_bytes(), ("127.0.0.1", CubeNetworking.UDP_PORT))
+        assert not is_order_sent_in_binary()
+
+
+def test_incoming_lanes():
+    """Checks that the consumers get the realtime messages before the bulk ones, whatever their arrival order"""
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME) as (net,):
+        cubebox_name = cubeid.cubebox_index_to_node_name(1)
+        bulk_msgs = [cm.CubeMsgReplyCubeboxStatus(cubebox_name, cube_game.CubeboxStatus(cube_id=1))
+                     for _ in range(10)]
+        press_msg = cm.CubeMsgButtonPress(cubebox_name, start_timestamp=1.0, press_timestamp=2.0)
+        order_msg = cm.CubeMsgOrderCubeboxToReset(cubeid.CUBEFRONTDESK_NODENAME, cube_id=1)
+        for msg_id, msg in enumerate(bulk_msgs + [order_msg, press_msg]):
+            msg.msg_id = msg_id
+            net.add_msg_to_incoming_queue(msg)
+        queue = net.get_incoming_msg_queue()
+        assert queue[0] == press_msg and queue[1] == order_msg
+        assert net.remove_msg_from_incoming_queue(press_msg)
+        # a team's creation is never overtaken by its badge-in
+        team = cube_game.CubeTeamStatus(name="Tokyo", rfid_uid="1234567890", max_time_sec=60)
+        new_team_msg = cm.CubeMsgFrontdeskNewTeam(cubeid.CUBEFRONTDESK_NODENAME, team)
+        rfid_msg = cm.CubeMsgRfidRead(cubebox_name, uid=team.rfid_uid, timestamp=1.0)
+        for msg_id, msg in enumerate((new_team_msg, rfid_msg), start=100):
+            msg.msg_id = msg_id
+            net.add_msg_to_incoming_queue(msg)
+        assert net.get_incoming_msg_queue()[:2] == (new_team_msg, rfid_msg)
+        # an old peer sends the same RFID read twice, without an ID: both are queued
+        old_rfid_msgs = [cm.CubeMsgRfidRead(cubebox_name, uid=team.rfid_uid, timestamp=2.0) for _ in range(2)]
+        for msg in old_rfid_msgs:
+            net.add_msg_to_incoming_queue(msg)
+        assert net.get_incoming_msg_queue()[2:4] == tuple(old_rfid_msgs)
+        assert net.remove_msg_from_incoming_queue(old_rfid_msgs[0])
+        assert net.remove_msg_from_incoming_queue(old_rfid_msgs[1])
+        assert not net.remove_msg_from_incoming_queue(old_rfid_msgs[1])
+        lane_stats = net.get_lane_stats()
+    assert lane_stats[CubeNetworking.LANE_REALTIME]["handled"] == 3
+    assert lane_stats[CubeNetworking.LANE_BULK]["depth"] == 10
+
+
+def test_blocking_consumer():
+    """Checks that a blocked consumer wakes up as soon as a message arrives,
+    and that the subscribed message types bypass the incoming queue"""
+    with loopback_nodes(cubeid.CUBEMASTER_NODENAME) as (net,):
+        cubebox_name = cubeid.cubebox_index_to_node_name(1)
+        press_msg = cm.CubeMsgButtonPress(cubebox_name, start_timestamp=1.0, press_timestamp=2.0)
+        press_msg.msg_id = 1
+        threading.Timer(0.2, net.add_msg_to_incoming_queue, args=(press_msg,)).start()
+        start = time.time()
+        assert net.get_incoming_msg(timeout=5) == press_msg
+        assert time.time() - start < 1
+        assert not net.get_incoming_msg_queue()
+        assert net.get_incoming_msg(timeout=0.1) is None
+
+        reply_msg = cm.CubeMsgReplyCubeboxStatus(cubebox_name, cube_game.CubeboxStatus(cube_id=1))
+        reply_msg.msg_id = 2
+        with net.subscribe(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS) as subscription:
+            net._handle_incoming_packet(reply_msg.to_bytes(), ("127.0.0.1", CubeNetworking.UDP_PORT))
+            assert subscription.get(timeout=1) == reply_msg
+            # not consumed: goes back to the incoming queue on close
+            reply_msg.msg_id = 3
+            net._handle_incoming_packet(reply_msg.to_bytes(), ("127.0.0.1", CubeNetworking.UDP_PORT))
+            assert not net.get_incoming_msg_queue()
+        assert net.get_incoming_msg_queue() == (reply_msg,)
+        assert net.get_incoming_msg(timeout=0.1) == reply_msg
+
+        # concurrent waiters: each one only gets the replies it accepts
+        def is_about(cube_id: int) -> Callable[[CubeMessage], bool]:
+            return lambda m: cm.CubeMsgReplyCubeboxStatus(copy_msg=m).cubebox.cube_id == cube_id
+
+        other_reply_msg = cm.CubeMsgReplyCubeboxStatus(cubebox_name, cube_game.CubeboxStatus(cube_id=2))
+        other_reply_msg.msg_id = 4
+        with net.subscribe(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS, accept=is_about(1)) as subscription1, \
+                net.subscribe(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS, accept=is_about(2)) as subscription2:
+            net._handle_incoming_packet(other_reply_msg.to_bytes(), ("127.0.0.1", CubeNetworking.UDP_PORT))
+            assert subscription2.get(timeout=1) == other_reply_msg
+            assert subscription1.get(timeout=0.1) is None
+
+        # a message consumed by one of the waiters is not requeued when the others close,
+        # and one consumed by none of them is requeued only once
+        with net.subscribe(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS) as subscription1, \
+                net.subscribe(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS) as subscription2:
+            reply_msg.msg_id = 5
+            net._handle_incoming_packet(reply_msg.to_bytes(), ("127.0.0.1", CubeNetworking.UDP_PORT))
+            assert subscription1.get(timeout=1) == reply_msg
+            assert len(subscription2) == 1
+        assert not net.get_incoming_msg_queue()
+        with net.subscribe(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS) as subscription1, \
+                net.subscribe(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS) as subscription2:
+            reply_msg.msg_id = 6
+            net._handle_incoming_packet(reply_msg.to_bytes(), ("127.0.0.1", CubeNetworking.UDP_PORT))
+            assert len(subscription1) == len(subscription2) == 1
+        assert net.get_incoming_msg_queue() == (reply_msg,)
+
+
+def test_scatter_gather():
+    """Checks that the replies of several cubeboxes are collected in about one round-trip,
+    and that an offline cubebox is reported as missing once the deadline is reached"""
+    cubebox_names = [cubeid.cubebox_index_to_node_name(i) for i in (1, 2, 3)]
+    with loopback_nodes(cubeid.CUBEFRONTDESK_NODENAME, *cubebox_names) as (frontdesk, *cubeboxes):
+
+        def reply_loop(net: CubeNetworking):
+            while net.is_running():
+                request_msg = net.get_incoming_msg(timeout=0.1)
+                if request_msg is not None and request_msg.msgtype == cm.CubeMsgTypes.REQUEST_CUBEBOX_STATUS:
+                    cube_id = cubeid.node_name_to_cubebox_index(net.node_name)
+                    net.send_msg_to(cm.CubeMsgReplyCubeboxStatus(net.node_name, cube_game.CubeboxStatus(cube_id=cube_id)),
+                                    request_msg.sender)
+
+        for net in cubeboxes:
+            threading.Thread(target=reply_loop, args=(net,), daemon=True).start()
+        request_msg = cm.CubeMsgRequestCubeboxStatus(frontdesk.node_name, cubeid.ALL_CUBEBOXES_CUBE_ID)
+        report = frontdesk.scatter_gather(request_msg, cubeid.ALL_CUBEBOXES_NODENAME, cubebox_names,
+                                          cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS, timeout=2)
+        assert report and sorted(report.replies) == sorted(cubebox_names)
+        assert report.elapsed < 0.5, report
+        offline_node = cubeid.cubebox_index_to_node_name(4)
+        request_msg = cm.CubeMsgRequestCubeboxStatus(frontdesk.node_name, cubeid.ALL_CUBEBOXES_CUBE_ID)
+        report = frontdesk.scatter_gather(request_msg, cubeid.ALL_CUBEBOXES_NODENAME, cubebox_names + [offline_node],
+                                          cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS, timeout=0.5)
+        assert not report and report.missing_nodes == [offline_node] and len(report.replies) == 3
+        assert report.elapsed < 1, report
+
+
+def test_send_to_many():
+    """Checks that the ACKs of several nodes are tracked at the same time,
+    and that only the nodes which did not acknowledge a message get it again"""
+    cubebox_names = [cubeid.cubebox_index_to_node_name(i) for i in (1, 2, 3)]
+    with loopback_nodes(cubeid.CUBEFRONTDESK_NODENAME, *cubebox_names) as (frontdesk, *cubeboxes):
+
+        def ack_loop(net: CubeNetworking):
+            while net.is_running():
+                msg = net.get_incoming_msg(timeout=0.1)
+                if msg is not None:
+                    net.acknowledge_this_message(msg, ack_info=cm.CubeAckInfos.OK)
+
+        for net in cubeboxes:
+            threading.Thread(target=ack_loop, args=(net,), daemon=True).start()
+        # the first ACK of the second cubebox is lost
+        lossy_cubebox = cubeboxes[1]
+        lose_first_datagrams(lossy_cubebox, 1)
+        offline_node = cubeid.cubebox_index_to_node_name(4)
+        # all the cubeboxes run this version: the retransmissions, which are broadcast, are filtered by destination
+        frontdesk._binary_peers.update(dict.fromkeys(cubebox_names + [offline_node], True))
+        start = time.time()
+        reports = frontdesk.send_msg_to_many(cm.CubeMsgCommand(frontdesk.node_name, full_command="CubeEveryone reset"),
+                                             cubebox_names + [offline_node], nb_tries=3, ack_timeout=0.2,
+                                             retry_later=False)
+        elapsed = time.time() - start
+    assert all(reports[net.node_name].ack_ok for net in cubeboxes), reports
+    assert reports[offline_node].ack_msg is None
+    # three rounds of 0.2 sec, whatever the number of nodes
+    assert elapsed < 1, elapsed
+    assert [net.stats.get("messages_accepted") for net in cubeboxes] == [1, 2, 1]
+    assert lossy_cubebox.stats.get("duplicates_reacked") == 1
+
+
+def run_tests():
+    """Runs the tests which check their own results. They simulate the nodes on the loopback interface."""
+    log = cube_logger.CubeLogger(name="Networking tests")
+    for test_func in (test_fragmentation, test_multicast_routing, test_multicast_fallback, test_slow_handler,
+                      test_retry_scheduler, test_duplicate_suppression, test_unacked_duplicates,
+                      test_ack_from_old_format_peer, test_wire_format_negotiation, test_incoming_lanes,
+                      test_blocking_consumer, test_scatter_gather, test_send_to_many):
+        test_func()
+        log.success(f"{test_func.__name__} PASSED")
+
+
+def benchmark_intake(duration_sec: Seconds = 3.0):
+    """Measures how many messages per second the receive path sustains when flooded on the loopback interface.
+    The 'before' figure reproduces the old listen loop, which slept LOOP_PERIOD_SEC before every receive."""
+    log = cube_logger.CubeLogger(name="Networking benchmark")
+    payload = cm.CubeMsgHeartbeat(cubeid.CUBEMASTER_NODENAME).to_bytes()
+
+    def flood(keep_flooding: threading.Event):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        while keep_flooding.is_set():
+            for _ in range(100):
+                sender.sendto(payload, ("127.0.0.1", CubeNetworking.UDP_PORT))
+            time.sleep(0.001)
+        sender.close()
+
+    def run_flood(count_received) -> float:
+        keep_flooding = threading.Event()
+        keep_flooding.set()
+        flood_thread = threading.Thread(target=flood, args=(keep_flooding,), daemon=True)
+        flood_thread.start()
+        time.sleep(duration_sec)
+        nb_received = count_received()
+        keep_flooding.clear()
+        flood_thread.join()
+        return nb_received / duration_sec
+
+    # before: sleep, then receive a single packet
+    legacy_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    legacy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    legacy_socket.bind((CubeNetworking.UDP_LISTEN_IP, CubeNetworking.UDP_PORT))
+    legacy_socket.settimeout(CubeNetworking.UDP_LISTEN_TIMEOUT)
+    legacy_received = [0]
+    legacy_running = [True]
+
+    def legacy_loop():
+        while legacy_running[0]:
+            time.sleep(LOOP_PERIOD_SEC)
+            # noinspection PyBroadException
+            try:
+                legacy_socket.recvfrom(CubeNetworking.UDP_BUFSIZE)
+                legacy_received[0] += 1
+            except:
+                pass
+
+    legacy_thread = threading.Thread(target=legacy_loop, daemon=True)
+    legacy_thread.start()
+    before = run_flood(lambda: legacy_received[0])
+    legacy_running[0] = False
+    legacy_thread.join()
+    legacy_socket.close()
+
+    # after: the current event-driven listen loop
+    net = CubeNetworking(cubeid.CUBEFRONTDESK_NODENAME)
+    net.log.setLevel(cube_logger.CubeLogger.LEVEL_WARNING)
+    net.run()
+    after = run_flood(lambda: net.stats.get("messages_accepted"))
+    net.stop()
+
+    log.info(f"Intake before: {before:.1f} msgs/sec")
+    log.info(f"Intake after: {after:.1f} msgs/sec")
+    log.info(f"Stats after: {net.get_stats()}")
+    return before, after
+
+
 def test():
     # use the first argument as a node name. if blank, use CubeMaster
     import sys
@@ -585,6 +2574,6 @@ def test():
 
 if __name__ == "__main__":
     # test()
-    test_ack_timeout()
-
-
+    # benchmark_intake()
+    # test_ack_timeout()
+    run_tests()
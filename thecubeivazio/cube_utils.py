@@ -5,8 +5,9 @@ import datetime
 import json
 import re
 import subprocess
+import threading
 import time
-from typing import List
+from typing import Any, Callable, Dict, Hashable, List, Tuple
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
@@ -168,6 +169,114 @@ class CubeSimpleTimer:
         return time.time() - self.start_time
 
 
+class CubeJson:
+    """The JSON serializer of the big payloads, like the game status snapshots.
+    Uses orjson when it is installed. The fallback produces the same compact text,
+    so that the hashes of a serialized status do not depend on the backend of the node which computed them."""
+    backend_name: str = "json"
+
+    @staticmethod
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+    _backend_dumps: Callable[[Any], str] = _json_dumps
+
+    @classmethod
+    def dumps(cls, obj) -> str:
+        try:
+            return cls._backend_dumps(obj)
+        except TypeError:
+            # e.g. integers too big for orjson
+            return cls._json_dumps(obj)
+
+    @classmethod
+    def set_backend(cls, name: str, dumps: Callable[[Any], str]):
+        cls.backend_name = name
+        cls._backend_dumps = staticmethod(dumps)
+
+    @classmethod
+    def use_default_backend(cls):
+        cls.set_backend("json", cls._json_dumps)
+
+    @classmethod
+    def use_fastest_backend(cls) -> str:
+        """Uses orjson if it is installed, else the json module. Returns the name of the backend in use"""
+        try:
+            # noinspection PyUnresolvedReferences
+            import orjson
+            cls.set_backend("orjson", lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode())
+        except ModuleNotFoundError:
+            cls.use_default_backend()
+        return cls.backend_name
+
+
+CubeJson.use_fastest_backend()
+
+
+class CubeSingleFlight:
+    """Coalesces concurrent identical calls: while the call for a key is in flight,
+    the other callers of that key wait for it and share its result.
+    A result which evaluates to True is also reused by the calls made less than max_age seconds after it completed."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exception: Optional[BaseException] = None
+
+    def __init__(self, max_age: Seconds = 0.0):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, CubeSingleFlight._Call] = {}
+        # the last result of each key : (completion timestamp, result)
+        self._results: Dict[Hashable, Tuple[Timestamp, Any]] = {}
+        self.nb_calls = 0
+        self.nb_shared = 0
+        self.nb_cached = 0
+
+    def do(self, key: Hashable, func: Callable[[], Any], max_age: Seconds = None) -> Any:
+        """Returns func()'s result, calling it only if no call for this key is in flight or recent enough.
+        If max_age is None, uses the default one. With max_age=0, only in-flight calls are shared."""
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and time.time() - cached[0] <= max_age:
+                self.nb_cached += 1
+                return cached[1]
+            call = self._in_flight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._in_flight[key] = self._Call()
+                self.nb_calls += 1
+            else:
+                self.nb_shared += 1
+        if not is_leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if call.exception is None and call.result:
+                    self._results[key] = (time.time(), call.result)
+            call.done.set()
+
+    def forget(self, key: Hashable = None):
+        """Forgets the cached result of a key, or of every key if key is None"""
+        with self._lock:
+            if key is None:
+                self._results.clear()
+            else:
+                self._results.pop(key, None)
+
+
 def date_to_french_date_string(date: datetime.datetime,
                                weekday=True, day_number=True, month=True, year=True) -> Optional[str]:
     """Convert a datetime object to a string in a format like 'lundi 1 janvier 2021'"""
@@ -483,7 +592,10 @@ def validate_json(json_str):
 
 
 def str_to_bool(s: str) -> bool:
-    return s.lower() in ['true', '1']
+    # values decoded from binary messages are already booleans
+    if isinstance(s, bool):
+        return s
+    return str(s).lower() in ['true', '1']
 
 
 @cubetry
@@ -554,7 +666,32 @@ def test_utils():
           decrypt_string(encrypt_string_to_str('test', 'password'), 'password'))
 
 
+def test_single_flight():
+    flights = CubeSingleFlight(max_age=0.5)
+    nb_calls = [0]
+
+    def slow_request():
+        nb_calls[0] += 1
+        time.sleep(0.2)
+        return nb_calls[0]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("status", slow_request))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 5 and nb_calls[0] == 1
+    # recent enough: reused
+    assert flights.do("status", slow_request) == 1
+    # too old for this caller: requested again
+    assert flights.do("status", slow_request, max_age=0) == 2
+    assert flights.nb_calls == 2 and flights.nb_shared == 4 and flights.nb_cached == 1
+    print("test_single_flight PASSED")
+
+
 if __name__ == "__main__":
+    # test_single_flight()
     test_time_conversions()
     exit(0)
     test_utils()
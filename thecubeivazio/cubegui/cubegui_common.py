@@ -36,8 +36,9 @@ class CubeGuiThreadWorker(QObject):
 
 class ServersInfoHasher:
     def __init__(self, fd: cfd.CubeServerFrontdesk):
-        self.teams_hash = fd.teams.hash
-        self.cubeboxes_hash = fd.cubeboxes.hash
+        # the versions change with the content, and are much cheaper to get than hashes
+        self.teams_version = fd.teams.version
+        self.cubeboxes_version = fd.cubeboxes.version
         self.nodes_list = fd.net.nodes_list.hash
 
     @property
@@ -45,7 +46,7 @@ class ServersInfoHasher:
         try:
             import hashlib
             return hashlib.sha256(
-                f"{self.teams_hash}{self.cubeboxes_hash}{self.nodes_list}".encode()
+                f"{self.teams_version}-{self.cubeboxes_version}-{self.nodes_list}".encode()
             ).hexdigest()
         except Exception as e:
             CubeLogger.static_error(f"Error in ServersInfoHash.hash: {e}")
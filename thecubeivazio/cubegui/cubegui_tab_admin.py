@@ -126,9 +126,8 @@ class CubeGuiTabAdminMixin:
 
             if success or not give_up_if_cubemaster_unresponsive:
                 self.set_servers_info_status_label("hourglass", "En attente de réponse des Cubeboxes...")
-                report = self.fd.request_all_cubeboxes_statuses_one_by_one(
-                    reply_timeout=reply_timeout,
-                    stop_at_first_failure=True)
+                report = self.fd.request_all_cubeboxes_statuses_at_once_from_cubeboxes(
+                    reply_timeout=reply_timeout)
                 if not report.ack_ok:
                     success = False
                     task_success_info += f"❌ CubeBoxes sans réponse: {str(report.ack_info)}"
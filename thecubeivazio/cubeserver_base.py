@@ -1,3 +1,5 @@
+from typing import Optional, Tuple
+
 import thecubeivazio.cube_game as cube_game
 import thecubeivazio.cube_identification as cubeid
 import thecubeivazio.cube_logger as cube_logger
@@ -15,7 +17,8 @@ class CubeServerBase:
     game_status: cube_game.CubeGameStatus
 
     def __init__(self):
-        pass
+        # concurrent identical status requests share one network exchange and its result
+        self._request_flights = cube_utils.CubeSingleFlight(max_age=STATUS_REPLY_MAX_AGE)
 
     @property
     def teams(self) -> cube_game.CubeTeamsStatusList:
@@ -40,6 +43,8 @@ class CubeServerBase:
         msg = cm.CubeMsgCommand(self.net.node_name, full_command=full_command)
         self.log.critical(f"words={msg.words}")
         destination_node = msg.target
+        if destination_node in (cubeid.EVERYONE_NODENAME, cubeid.ALL_CUBEBOXES_NODENAME):
+            return self._send_full_command_to_group(msg, destination_node)
         if destination_node not in cubeid.ALL_NODENAMES:
             self.log.error(f"Invalid destination node: {destination_node}")
             return cubenet.SendReport(sent_ok=False, raw_info=f"Invalid destination node: {destination_node}")
@@ -61,6 +66,21 @@ class CubeServerBase:
         self.log.success(f"Node {destination_node} acknowledged the full command : {full_command}")
         return report
 
+    @cubetry
+    def _send_full_command_to_group(self, msg: cm.CubeMsgCommand, group: NodeName) -> cubenet.SendReport:
+        """Send a command to every node of a group at once. The report is OK only if every node acked OK,
+        else its info lists the nodes which did not"""
+        # the frontdesk does not handle commands
+        node_names = cubeid.CUBEBOXES_NODENAMES if group == cubeid.ALL_CUBEBOXES_NODENAME \
+            else (cubeid.CUBEMASTER_NODENAME,) + cubeid.CUBEBOXES_NODENAMES
+        reports = self.net.send_msg_to_many(msg, node_names, require_ack=True)
+        failed_nodes = [node_name for node_name, report in reports.items() if not report.ack_ok]
+        if failed_nodes:
+            self.log.error(f"These nodes did not acknowledge the full command '{msg.full_command}' : {failed_nodes}")
+            return cubenet.SendReport(sent_ok=True, raw_info=f"No ACK OK from {failed_nodes}")
+        self.log.success(f"Every node of {group} acknowledged the full command : {msg.full_command}")
+        return cubenet.SendReport(sent_ok=True, ack_ok=True)
+
     @cubetry
     def request_all_cubeboxes_statuses_one_by_one(self,
                                                   reply_timeout: Seconds = None,
@@ -93,59 +113,121 @@ class CubeServerBase:
         return ret
 
     @cubetry
-    def request_cubebox_status_from_cubemaster(self, cubebox_id: int, reply_timeout: Seconds = None) -> bool:
+    def request_all_cubeboxes_statuses_at_once_from_cubeboxes(self, reply_timeout: Seconds = None,
+                                                              max_age: Seconds = None) -> cubenet.SendReport:
+        """Send a single request to all the cubeboxes and collect their statuses concurrently,
+        waiting at most reply_timeout for the whole sweep.
+        Like request_all_cubeboxes_statuses_one_by_one, the unresponsive cubeboxes are listed in the report's info.
+        Concurrent calls with the same reply_timeout share the same sweep,
+        and a successful one younger than max_age is reused."""
+        return self._request_flights.do(
+            ("all_cubeboxes_statuses", reply_timeout),
+            lambda: self._request_all_cubeboxes_statuses_at_once_from_cubeboxes(reply_timeout), max_age)
+
+    @cubetry
+    def _request_all_cubeboxes_statuses_at_once_from_cubeboxes(self, reply_timeout: Seconds = None) -> cubenet.SendReport:
+        msg = cm.CubeMsgRequestCubeboxStatus(self.net.node_name, cubeid.ALL_CUBEBOXES_CUBE_ID)
+        gather_report = self.net.scatter_gather(
+            msg, destination=cubeid.ALL_CUBEBOXES_NODENAME, expected_nodes=cubeid.CUBEBOXES_NODENAMES,
+            reply_msgtype=cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS, timeout=reply_timeout)
+        if not gather_report.sent_ok:
+            return cubenet.SendReport(sent_ok=False, raw_info="Failed to send the request cubebox status message")
+        for reply_msg in gather_report.replies.values():
+            self._handle_reply_cubebox_status(reply_msg)
+        ret = cubenet.SendReport(sent_ok=True)
+        if gather_report.missing_nodes:
+            unresponsive_cubeids = [cubeid.node_name_to_cubebox_index(node_name)
+                                    for node_name in gather_report.missing_nodes]
+            self.log.warning(f"No response from cubeboxes {unresponsive_cubeids}")
+            ret.sent_ok = False
+            ret._raw_info = f"{unresponsive_cubeids}"
+        else:
+            ret.set_ack_ok()
+            self.log.success("All cubeboxes statuses obtained successfully")
+        return ret
+
+    @cubetry
+    def request_cubebox_status_from_cubemaster(self, cubebox_id: int, reply_timeout: Seconds = None,
+                                               max_age: Seconds = None) -> bool:
         """Send a message to the CubeMaster to request the status of a CubeBox.
         if a reply_timout is specified, wait for the reply for that amount of time.
-        If the request send or the reply receive fails, return False."""
+        If the request send or the reply receive fails, return False.
+        Concurrent calls with the same reply_timeout share the same request,
+        and a reply younger than max_age is reused."""
+        return self._request_flights.do(
+            ("cubebox_status_from_cubemaster", cubebox_id, reply_timeout),
+            lambda: self._request_cubebox_status_from_cubemaster(cubebox_id, reply_timeout), max_age)
+
+    @cubetry
+    def _request_cubebox_status_from_cubemaster(self, cubebox_id: int, reply_timeout: Seconds = None) -> bool:
         msg = cm.CubeMsgRequestCubeboxStatus(self.net.node_name, cubebox_id)
-        report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
-        if not report:
-            self.log.error(f"Failed to send the request cubebox status message for cubebox {cubebox_id}")
-            return True
-        if reply_timeout is not None:
-            reply_msg = self.net.wait_for_message(msgtype=cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS, timeout=reply_timeout)
-            if not reply_msg:
-                self.log.error(f"Failed to receive the cubebox status reply for cubebox {cubebox_id}")
-                return False
-            assert self._handle_reply_cubebox_status(reply_msg)
-            rcs_msg = cm.CubeMsgReplyCubeboxStatus(copy_msg=reply_msg)
-            reply_cubebox_id = rcs_msg.cubebox.cube_id
-            if reply_cubebox_id != cubebox_id:
-                self.log.error(f"Received cubebox status reply for cubebox {reply_cubebox_id} instead of {cubebox_id}")
-                return False
-            self.log.success(f"Received cubebox status reply for cubebox {cubebox_id}")
+        # subscribe before sending the request, so that a quick reply cannot be missed,
+        # and only to the replies about this cubebox, so that concurrent requests each get their own
+        with self.net.subscribe(
+                cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS,
+                accept=lambda m: cm.CubeMsgReplyCubeboxStatus(copy_msg=m).cubebox.cube_id == cubebox_id
+        ) as subscription:
+            report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
+            if not report:
+                self.log.error(f"Failed to send the request cubebox status message for cubebox {cubebox_id}")
+                return True
+            if reply_timeout is not None:
+                reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
+                if not reply_msg:
+                    self.log.error(f"Failed to receive the cubebox status reply for cubebox {cubebox_id}")
+                    return False
+                assert self._handle_reply_cubebox_status(reply_msg)
+                rcs_msg = cm.CubeMsgReplyCubeboxStatus(copy_msg=reply_msg)
+                reply_cubebox_id = rcs_msg.cubebox.cube_id
+                if reply_cubebox_id != cubebox_id:
+                    self.log.error(f"Received cubebox status reply for cubebox {reply_cubebox_id} instead of {cubebox_id}")
+                    return False
+                self.log.success(f"Received cubebox status reply for cubebox {cubebox_id}")
+                return True
+            # no timeout? just return True
             return True
-        # no timeout? just return True
-        return True
 
     @cubetry
-    def request_cubebox_status_from_cubebox(self, cubebox_id: int, reply_timeout: Seconds = None) -> bool:
+    def request_cubebox_status_from_cubebox(self, cubebox_id: int, reply_timeout: Seconds = None,
+                                            max_age: Seconds = None) -> bool:
         """Send a message to a CubeBox to request its status.
         if a reply_timout is specified, wait for the reply for that amount of time.
-        If the request send or the reply receive fails, return False."""
+        If the request send or the reply receive fails, return False.
+        Concurrent calls with the same reply_timeout share the same request,
+        and a reply younger than max_age is reused."""
+        return self._request_flights.do(
+            ("cubebox_status_from_cubebox", cubebox_id, reply_timeout),
+            lambda: self._request_cubebox_status_from_cubebox(cubebox_id, reply_timeout), max_age)
+
+    @cubetry
+    def _request_cubebox_status_from_cubebox(self, cubebox_id: int, reply_timeout: Seconds = None) -> bool:
         msg = cm.CubeMsgRequestCubeboxStatus(self.net.node_name, cubebox_id)
         dest_nodename = cubeid.cubebox_index_to_node_name(cubebox_id)
-        report = self.net.send_msg_to(message=msg,
-                                      node_name=dest_nodename,
-                                      require_ack=False)
-        if not report:
-            self.log.error(f"Failed to send the request cubebox status message for cubebox {cubebox_id}")
-            return True
-        if reply_timeout is not None:
-            reply_msg = self.net.wait_for_message(msgtype=cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS, timeout=reply_timeout)
-            if not reply_msg:
-                self.log.error(f"Failed to receive the cubebox status reply for cubebox {cubebox_id}")
-                return False
-            assert self._handle_reply_cubebox_status(reply_msg)
-            rcs_msg = cm.CubeMsgReplyCubeboxStatus(copy_msg=reply_msg)
-            reply_cubebox_id = rcs_msg.cubebox.cube_id
-            if reply_cubebox_id != cubebox_id:
-                self.log.error(f"Received cubebox status reply for cubebox {reply_cubebox_id} instead of {cubebox_id}")
-                return False
-            self.log.success(f"Received cubebox status reply for cubebox {cubebox_id}")
+        # subscribe before sending the request, so that a quick reply cannot be missed,
+        # and only to the replies of this cubebox, so that concurrent requests each get their own
+        with self.net.subscribe(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS,
+                                accept=lambda m: m.sender == dest_nodename) as subscription:
+            report = self.net.send_msg_to(message=msg,
+                                          node_name=dest_nodename,
+                                          require_ack=False)
+            if not report:
+                self.log.error(f"Failed to send the request cubebox status message for cubebox {cubebox_id}")
+                return True
+            if reply_timeout is not None:
+                reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
+                if not reply_msg:
+                    self.log.error(f"Failed to receive the cubebox status reply for cubebox {cubebox_id}")
+                    return False
+                assert self._handle_reply_cubebox_status(reply_msg)
+                rcs_msg = cm.CubeMsgReplyCubeboxStatus(copy_msg=reply_msg)
+                reply_cubebox_id = rcs_msg.cubebox.cube_id
+                if reply_cubebox_id != cubebox_id:
+                    self.log.error(f"Received cubebox status reply for cubebox {reply_cubebox_id} instead of {cubebox_id}")
+                    return False
+                self.log.success(f"Received cubebox status reply for cubebox {cubebox_id}")
+                return True
+            # no timeout? just return True
             return True
-        # no timeout? just return True
-        return True
 
     @cubetry
     def _handle_reply_cubebox_status(self, message: cm.CubeMessage) -> bool:
@@ -173,13 +255,32 @@ class CubeServerBase:
             self.net.acknowledge_this_message(message, ack_info=cm.CubeAckInfos.ERROR)
             return False
 
-    def _handle_reply_all_cubeboxes_status_hashes(self, message: cm.CubeMessage):
+    @cubetry
+    def _handle_reply_all_cubeboxes_status_hashes(self, message: cm.CubeMessage) -> Optional[Tuple[NodeName, ...]]:
+        """Returns the names of the cubeboxes whose status differs from the sender's"""
         self.log.info(f"Received reply all cubeboxes status hashes message from {message.sender}")
-        self.log.error("_handle_reply_all_cubeboxes_status_hashes: not implemented")
+        hash_dict = cm.CubeMsgReplyAllCubeboxesStatusHashes(copy_msg=message).hash_dict
+        differing_node_names = self.cubeboxes.compare_with_hashlist(hash_dict)
+        self.log.info(f"Cubeboxes differing from {message.sender}'s: {differing_node_names}")
+        return differing_node_names
 
-    def _handle_reply_all_teams_status_hashes(self, message: cm.CubeMessage):
+    @cubetry
+    def _handle_reply_all_teams_status_hashes(self, message: cm.CubeMessage) -> Optional[Tuple[TeamName, ...]]:
+        """Returns the names of the teams whose status differs from the sender's, or which we don't have.
+        If the sender is the cubemaster, which is authoritative, the teams it does not have are removed."""
         self.log.info(f"Received reply all teams status hashes message from {message.sender}")
-        self.log.error("_handle_reply_all_teams_status_hashes: not implemented")
+        hash_dict = cm.CubeMsgReplyAllTeamsStatusHashes(copy_msg=message).hash_dict
+        differing_team_names = self.teams.compare_with_hashlist(hash_dict)
+        self.log.info(f"Teams differing from {message.sender}'s: {differing_team_names}")
+        unknown_team_names = [team.name for team in self.teams if team.name not in hash_dict]
+        if unknown_team_names:
+            if message.sender == cubeid.CUBEMASTER_NODENAME:
+                self.log.warning(f"Removing the teams unknown to {message.sender}: {unknown_team_names}")
+                for team_name in unknown_team_names:
+                    self.teams.remove_team(team_name)
+            else:
+                self.log.warning(f"Teams unknown to {message.sender}: {unknown_team_names}")
+        return differing_team_names
 
     def _handle_cubemaster_cubebox_status_message(self, message: cm.CubeMessage):
         self.log.info(f"Received cubemaster cubebox status message from {message.sender}")
@@ -50,6 +50,11 @@ class CubeServerCubebox:
         # keeps tracks of the game's status for this cubebox.
         # meant to be set only with the set_status_state method
         self._status = cube_game.CubeboxStatus(cube_id=self.cubebox_index)
+        # the RFID line whose badge-in is waiting for the CubeMaster's acknowledgement, if any
+        self._pending_badge_in_rfid_line: Optional[cube_rfid.CubeRfidLine] = None
+        # serializes the changes to the box's state made by the RFID, button and networking threads,
+        # and by the badge-in callback which runs in a thread of the networking module
+        self._state_lock = threading.RLock()
 
         # handles the wireless button presses
         self.button = cube_button.CubeButton()
@@ -144,7 +149,7 @@ class CubeServerCubebox:
         self.log.info(f"Command message: {command_msg.to_string()}")
         command = command_msg.command_without_target
         target = command_msg.target
-        if target not in (self.net.node_name, cubeid.EVERYONE_NODENAME):
+        if target not in (self.net.node_name, cubeid.EVERYONE_NODENAME, cubeid.ALL_CUBEBOXES_NODENAME):
             self.log.info(f"Command target not for me: {target}")
             return False
         if not self.handle_command(command):
@@ -242,32 +247,31 @@ class CubeServerCubebox:
         """check the incoming messages and handle them"""
         self.net.run()
         while self._keep_running:
-            time.sleep(LOOP_PERIOD_SEC)
             if self.enable_heartbeat and self.heartbeat_timer.is_timeout():
                 self.net.send_msg_with_udp(cm.CubeMsgHeartbeat(self.net.node_name))
                 self.heartbeat_timer.reset()
 
-            for message in self.net.get_incoming_msg_queue():
-                # ignore ack messages, they're handled in the networking module
-                if message.msgtype == cm.CubeMsgTypes.ACK:
-                    continue
-                elif message.msgtype == cm.CubeMsgTypes.COMMAND:
-                    self._handle_command_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.CONFIG:
-                    self._handle_config_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.ORDER_CUBEBOX_TEAM_BADGE_OUT:
-                    self._handle_order_team_badge_out_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.ORDER_CUBEBOX_TO_WAIT_FOR_RESET:
-                    self._handle_order_cubebox_to_wait_for_reset_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.ORDER_CUBEBOX_TO_RESET:
-                    self._handle_order_cubebox_to_reset_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REQUEST_ALL_CUBEBOXES_STATUSES:
-                    self._handle_request_all_cubeboxes_statuses_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REQUEST_CUBEBOX_STATUS:
-                    self._handle_request_cubebox_status_message(message)
-                else:
-                    self.log.debug(f"Unhandled message: {message}")
-                self.net.remove_msg_from_incoming_queue(message)
+            # wakes up as soon as a message arrives, or every LOOP_PERIOD_SEC for the heartbeat
+            message = self.net.get_incoming_msg(timeout=LOOP_PERIOD_SEC)
+            if message is not None:
+                with self._state_lock:
+                    # ack messages never get here, they're handled in the networking module
+                    if message.msgtype == cm.CubeMsgTypes.COMMAND:
+                        self._handle_command_message(message)
+                    elif message.msgtype == cm.CubeMsgTypes.CONFIG:
+                        self._handle_config_message(message)
+                    elif message.msgtype == cm.CubeMsgTypes.ORDER_CUBEBOX_TEAM_BADGE_OUT:
+                        self._handle_order_team_badge_out_message(message)
+                    elif message.msgtype == cm.CubeMsgTypes.ORDER_CUBEBOX_TO_WAIT_FOR_RESET:
+                        self._handle_order_cubebox_to_wait_for_reset_message(message)
+                    elif message.msgtype == cm.CubeMsgTypes.ORDER_CUBEBOX_TO_RESET:
+                        self._handle_order_cubebox_to_reset_message(message)
+                    elif message.msgtype == cm.CubeMsgTypes.REQUEST_ALL_CUBEBOXES_STATUSES:
+                        self._handle_request_all_cubeboxes_statuses_message(message)
+                    elif message.msgtype == cm.CubeMsgTypes.REQUEST_CUBEBOX_STATUS:
+                        self._handle_request_cubebox_status_message(message)
+                    else:
+                        self.log.debug(f"Unhandled message: {message}")
 
     def _handle_order_team_badge_out_message(self, message: cm.CubeMessage) -> bool:
         self.log.info("Received order to badge out a team")
@@ -330,22 +334,23 @@ class CubeServerCubebox:
                 self.log.info(
                     f"Line entered at {rfid_line.timestamp}: {rfid_line.uid} : {'valid' if rfid_line.is_valid() else 'invalid'}")
                 self.log.critical(f"Resetters: {cube_rfid.CubeRfidLine.get_resetter_uids_list()}")
-                if not rfid_line.is_valid():
-                    self.rfid.remove_line(rfid_line)
-                    self.sound_player.play_rfid_error_sound()
-                # if this rfid uid is in the resetter list, set the box status to ready to play
-                elif cube_rfid.CubeRfidLine.is_uid_in_resetter_list(rfid_line.uid):
-                    self.log.info(
-                        f"RFID {rfid_line.uid} is in the resetter list. Setting the box status to ready to play.")
-                    self.perform_reset()
-                # ok, so the line is valid and it's not a resetter rfid, which means it's a team rfid.
-                # if the box is not ready to play, ignore the read
-                elif not self.status.is_ready_to_play():
-                    self.log.warning("Trying to badge in a team but the box is not ready to play")
-                    self.sound_player.play_rfid_error_sound()
-                # if we're here. that means the box is ready to play. badge in the new team
-                else:
-                    self.badge_in_new_team(rfid_line)
+                with self._state_lock:
+                    if not rfid_line.is_valid():
+                        self.rfid.remove_line(rfid_line)
+                        self.sound_player.play_rfid_error_sound()
+                    # if this rfid uid is in the resetter list, set the box status to ready to play
+                    elif cube_rfid.CubeRfidLine.is_uid_in_resetter_list(rfid_line.uid):
+                        self.log.info(
+                            f"RFID {rfid_line.uid} is in the resetter list. Setting the box status to ready to play.")
+                        self.perform_reset()
+                    # ok, so the line is valid and it's not a resetter rfid, which means it's a team rfid.
+                    # if the box is not ready to play, ignore the read
+                    elif not self.status.is_ready_to_play():
+                        self.log.warning("Trying to badge in a team but the box is not ready to play")
+                        self.sound_player.play_rfid_error_sound()
+                    # if we're here. that means the box is ready to play. badge in the new team
+                    else:
+                        self.badge_in_new_team(rfid_line)
                 # finally, in any case, remove the line from the rfid listener
                 self.rfid.remove_line(rfid_line)
 
@@ -373,6 +378,8 @@ class CubeServerCubebox:
 
     @cubetry
     def badge_in_new_team(self, rfid_line: cube_rfid.CubeRfidLine) -> bool:
+        """Sends the RFID read to the CubeMaster without waiting for its ACK.
+        Returns True if the badge-in request was sent. The outcome is handled by _handle_badge_in_report"""
         if cube_rfid.CubeRfidLine.is_uid_in_resetter_list(rfid_line.uid):
             self.log.warning(f"Trying to badge in a team with a resetter RFID {rfid_line.uid}")
             self.perform_reset()
@@ -387,32 +394,48 @@ class CubeServerCubebox:
             self.log.warning("Trying to badge in a team but the box is not ready to play")
             self.sound_player.play_rfid_error_sound()
             return False
-        # alright so it's a valid line. let's add it to our status
-        self.status.last_valid_rfid_line = rfid_line
-        # send the RFID read message to the CubeMaster
-        msg_rr = cm.CubeMsgRfidRead(self.net.node_name, uid=rfid_line.uid, timestamp=rfid_line.timestamp)
-        report = self.net.send_msg_to_cubemaster(msg_rr, require_ack=True, nb_tries=3)
-        if not report.sent_ok:
-            self.log.error("Failed to send RFID read message to CubeMaster")
-            self.sound_player.play_rfid_error_sound()
-            return False
-        if not report.ack_msg:
-            self.log.error("Sent RFID messages but the CubeMaster did not acknowledge it")
+        if self._pending_badge_in_rfid_line is not None:
+            self.log.warning(f"Trying to badge in a team but the badge-in of RFID {self._pending_badge_in_rfid_line.uid} "
+                             f"is still waiting for the CubeMaster")
             self.sound_player.play_rfid_error_sound()
             return False
-        if report.ack_info != cm.CubeAckInfos.OK:
-            self.log.error(f"CubeMaster acked the RFID read message with error: {report.ack_info}")
-            self.sound_player.play_rfid_error_sound()
-            return False
-        else:
-            self.log.success("RFID read message sent to and okayed by the CubeMaster")
-            self.status.last_valid_rfid_line = rfid_line
-            self.set_status_state(cube_game.CubeboxState.STATE_PLAYING)
-            self.log.info(
-                f"is_box_being_played()={self.is_box_being_played()}, last_rfid_line={self.status.last_valid_rfid_line}")
-            # self.log.critical(f"{self.status}")
-            self.sound_player.play_rfid_ok_sound()
-            return True
+        # alright so it's a valid line. It becomes our status' last valid line only once the CubeMaster okays it.
+        # send the RFID read message to the CubeMaster.
+        # Don't wait for the ACK here: it would freeze the RFID loop. The reply is handled by _handle_badge_in_report
+        msg_rr = cm.CubeMsgRfidRead(self.net.node_name, uid=rfid_line.uid, timestamp=rfid_line.timestamp)
+        self._pending_badge_in_rfid_line = rfid_line
+        self.net.send_msg_to_cubemaster_async(
+            msg_rr, require_ack=True, nb_tries=3,
+            callback=lambda report: self._handle_badge_in_report(rfid_line, report))
+        return True
+
+    @cubetry
+    def _handle_badge_in_report(self, rfid_line: cube_rfid.CubeRfidLine, report: cubenet.SendReport) -> bool:
+        """Called once the CubeMaster has acknowledged (or not) the RFID read message sent by badge_in_new_team.
+        Runs in a thread of the networking module, so it holds the state lock like the RFID and button loops"""
+        with self._state_lock:
+            self._pending_badge_in_rfid_line = None
+            if not report.sent_ok:
+                self.log.error("Failed to send RFID read message to CubeMaster")
+                self.sound_player.play_rfid_error_sound()
+                return False
+            if not report.ack_msg:
+                self.log.error("Sent RFID messages but the CubeMaster did not acknowledge it")
+                self.sound_player.play_rfid_error_sound()
+                return False
+            if report.ack_info != cm.CubeAckInfos.OK:
+                self.log.error(f"CubeMaster acked the RFID read message with error: {report.ack_info}")
+                self.sound_player.play_rfid_error_sound()
+                return False
+            else:
+                self.log.success("RFID read message sent to and okayed by the CubeMaster")
+                self.status.last_valid_rfid_line = rfid_line
+                self.set_status_state(cube_game.CubeboxState.STATE_PLAYING)
+                self.log.info(
+                    f"is_box_being_played()={self.is_box_being_played()}, last_rfid_line={self.status.last_valid_rfid_line}")
+                # self.log.critical(f"{self.status}")
+                self.sound_player.play_rfid_ok_sound()
+                return True
 
     @cubetry
     def badge_out_current_team(self, play_game_over_sound=False) -> bool:
@@ -440,22 +463,25 @@ class CubeServerCubebox:
             if not self.button.has_been_pressed_long_enough():
                 continue
             # if we're here. it means we've got a long press
-            if not self.is_box_being_played():
-                self.log.warning("The button was pressed long enough but the box is not being played. Ignoring.")
-                self.button.reset()
-                continue
-            press_timestamp = time.time()
+            with self._state_lock:
+                if not self.is_box_being_played():
+                    self.log.warning("The button was pressed long enough but the box is not being played. Ignoring.")
+                    self.button.reset()
+                    continue
+                press_timestamp = time.time()
 
-            cbp_msg = cm.CubeMsgButtonPress(sender=self.net.node_name,
-                                            start_timestamp=self.play_start_timestamp,
-                                            press_timestamp=press_timestamp)
+                cbp_msg = cm.CubeMsgButtonPress(sender=self.net.node_name,
+                                                start_timestamp=self.play_start_timestamp,
+                                                press_timestamp=press_timestamp)
             self.log.info(f"Button pressed long enough. Sending msg to CubeMaster : {cbp_msg.to_string()}")
 
+            # don't hold the state lock while waiting for the ACK, the other threads would freeze
             if self.net.send_msg_to_cubemaster(cbp_msg, require_ack=True):
                 self.log.info("Button press message sent to and acked by CubeMaster")
-                self.badge_out_current_team()
-                self.set_status_state(cube_game.CubeboxState.STATE_WAITING_FOR_RESET)
-                self.sound_player.play_victory_sound()
+                with self._state_lock:
+                    self.badge_out_current_team()
+                    self.set_status_state(cube_game.CubeboxState.STATE_WAITING_FOR_RESET)
+                    self.sound_player.play_victory_sound()
             else:
                 self.log.error("Failed to send or get ack for button press message to CubeMaster")
             self.button.reset()
@@ -477,7 +503,7 @@ class CubeServerCubebox:
     @cubetry
     def _handle_request_cubebox_status_message(self, message: cm.CubeMessage) -> bool:
         rcs_msg = cm.CubeMsgRequestCubeboxStatus(copy_msg=message)
-        if rcs_msg.cube_id != self.cubebox_index:
+        if rcs_msg.cube_id not in (self.cubebox_index, cubeid.ALL_CUBEBOXES_CUBE_ID):
             return True
         self.log.info("Received request for cubebox status and it's for us")
         report = self.net.send_msg_to(
@@ -4,6 +4,9 @@ handling the CubeBoxes, the LED matrix displays, and the web page displayed on a
 """
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Tuple
 
 import thecubeivazio.cube_game as cube_game
 import thecubeivazio.cube_identification as cubeid
@@ -24,6 +27,12 @@ from thecubeivazio.cube_common_defines import *
 
 DB_REQUEST_PERIOD_SEC = 3
 HIGHSCORES_UPDATE_PERIOD_SEC = 2
+# the frontdesk gets only the changes of the game status, and the full status this often, as a checkpoint
+STATUS_SNAPSHOT_PERIOD_SEC = 30
+# number of threads running the message handlers
+NB_HANDLER_WORKERS = 4
+# number of recently created teams whose RFID UID is remembered when dispatching their messages
+NB_DISPATCHED_NEW_TEAMS_KEPT = 256
 
 # only import cube_rgbmatrix_daemon if we're running this script as the main script,
 # not if we're importing it as a module
@@ -95,6 +104,8 @@ class CubeServerMaster(CubeServerBase):
         # flag set to true in _message_handling_loop when the local database is up to date
         self.flag_database_up_to_date = False
 
+        self._init_msg_dispatch()
+
         # params for threading
         self._thread_rfid = threading.Thread(target=self._rfid_loop, daemon=True)
         self._thread_message_handling = threading.Thread(target=self._message_handling_loop, daemon=True)
@@ -106,9 +117,18 @@ class CubeServerMaster(CubeServerBase):
 
 
         self._keep_running = False
-        self._last_game_status_sent_to_frontdesk_hash: Optional[Hash] = None
-        self._last_teams_status_sent_to_rgb_daemon_hash: Optional[Hash] = None
+        # versions of the teams and cubeboxes, to send only the changes to the frontdesk
+        self.status_tracker = cube_game.CubeGameStatusVersionTracker(self.game_status)
+        # the status version acknowledged by the frontdesk. None if it needs the full status
+        self._frontdesk_status_version: Optional[int] = None
+        self._status_snapshot_timer = cube_utils.CubeSimpleTimer(STATUS_SNAPSHOT_PERIOD_SEC)
+        # versions of the teams last displayed on the RGB matrices and on the highscores screen
+        self._last_teams_version_sent_to_rgb_daemon: Optional[int] = None
+        self._last_teams_version_on_highscores_screen: Optional[int] = None
         self._is_running_alarm = False
+        # names of the teams whose time is up and whose removal is waiting for the frontdesk or cubebox ACKs.
+        # Modified by the send callbacks: only accessed while holding the game status lock
+        self._teams_time_up_in_progress: set[TeamName] = set()
 
         # heartbeat setup
         self.heartbeat_timer = cube_utils.CubeSimpleTimer(10)
@@ -139,6 +159,8 @@ class CubeServerMaster(CubeServerBase):
             self.rfid.stop()
             self.stop_alarm()
             self._thread_message_handling.join(timeout=0.1)
+            for worker in self._handler_workers:
+                worker.shutdown(wait=False, cancel_futures=True)
             self._thread_rfid.join(timeout=0.1)
             self._thread_rgb.join(timeout=0.1)
             self._thread_status_update.join(timeout=0.1)
@@ -184,9 +206,11 @@ class CubeServerMaster(CubeServerBase):
         while self._keep_running:
             time.sleep(LOOP_PERIOD_SEC)
             # check if the highscores playing teams need to be refreshed
-            if self.highscores_screen.playing_teams.hash != self.teams.hash:
+            teams_version = self.teams.version
+            if self._last_teams_version_on_highscores_screen != teams_version:
                 self.log.info("Updating playing teams on highscores screen")
                 self.highscores_screen.playing_teams = self.teams.copy()
+                self._last_teams_version_on_highscores_screen = teams_version
                 self.highscores_screen.update_playing_teams_html_file()
             # check if the local teams database matches the frontdesk's
             # to avoid having to dump the whole database every time,
@@ -215,26 +239,34 @@ class CubeServerMaster(CubeServerBase):
 
     def _status_update_loop(self):
         """Periodically performs these actions every time the game status changes:
-        - sends the game status to the frontdesk
-        - updates the RGBMatrix"""
+        - sends the changes of the game status to the frontdesk, or the full status every STATUS_SNAPSHOT_PERIOD_SEC
+        - handles the teams whose time is up"""
         while self._keep_running:
             time.sleep(LOOP_PERIOD_SEC)
-            if self._last_game_status_sent_to_frontdesk_hash != self.game_status.hash:
-                self.log.info("Game status changed. Updating RGBMatrix and sending game status to frontdesk")
+            with self.game_status_lock:
+                self.status_tracker.update()
+            if self._frontdesk_status_version is None or self._status_snapshot_timer.is_timeout():
                 self.send_status_to_frontdesk()
+            elif self._frontdesk_status_version != self.status_tracker.version:
+                self.log.info("Game status changed. Sending the changes to the frontdesk")
+                self.send_status_delta_to_frontdesk()
             # handle teams being out of time
-            for team in self.teams:
-                if team.is_time_up():
-                    self._handle_team_time_up(team)
+            with self.game_status_lock:
+                timed_up_teams = [team for team in self.teams
+                                  if team.is_time_up() and team.name not in self._teams_time_up_in_progress]
+            for team in timed_up_teams:
+                self._handle_team_time_up(team)
 
 
     @cubetry
     def send_status_to_frontdesk(self) -> bool:
         """Send the cubemaster status to the frontdesk"""
         self.log.info("Sending game status to frontdesk")
-        report = self.net.send_msg_to_frontdesk(
-            cm.CubeMsgReplyCubemasterStatus(self.net.node_name, self.game_status),
-            require_ack=True, nb_tries=1)
+        with self.game_status_lock:
+            self.status_tracker.update()
+            version = self.status_tracker.version
+            msg = cm.CubeMsgReplyCubemasterStatus(self.net.node_name, self.game_status, status_version=version)
+        report = self.net.send_msg_to_frontdesk(msg, require_ack=True, nb_tries=1)
         if not report:
             self.log.error("Failed to send game status to frontdesk")
             return False
@@ -244,9 +276,33 @@ class CubeServerMaster(CubeServerBase):
                 return False
             else:
                 self.log.success("Sent game status to frontdesk and received ACK")
-                self._last_game_status_sent_to_frontdesk_hash = self.game_status.hash
+                self._frontdesk_status_version = version
+                self._status_snapshot_timer.reset()
                 return True
 
+    @cubetry
+    def send_status_delta_to_frontdesk(self) -> bool:
+        """Send to the frontdesk the teams and cubeboxes that changed since the last status version it acknowledged"""
+        with self.game_status_lock:
+            self.status_tracker.update()
+            delta = self.status_tracker.make_delta(self._frontdesk_status_version)
+        self.log.info(f"Sending game status changes to frontdesk: {delta}")
+        report = self.net.send_msg_to_frontdesk(
+            cm.CubeMsgCubemasterStatusDelta(self.net.node_name, delta), require_ack=True, nb_tries=1)
+        if not report:
+            self.log.error("Failed to send game status changes to frontdesk")
+            return False
+        if not report.ack_ok:
+            if report.ack_info == cm.CubeAckInfos.INVALID:
+                self.log.warning("The frontdesk does not have the base version of the changes. Sending the full status")
+                self._frontdesk_status_version = None
+            else:
+                self.log.warning("Sent game status changes to frontdesk but no ACK received")
+            return False
+        self.log.success(f"Frontdesk game status updated from version {delta.base_version} to {delta.version}")
+        self._frontdesk_status_version = delta.version
+        return True
+
     def run_alarm(self):
         try:
             # force the thread to stop if it's running
@@ -292,7 +348,7 @@ class CubeServerMaster(CubeServerBase):
             return
         while self._keep_running:
             time.sleep(LOOP_PERIOD_SEC)
-            if self._last_teams_status_sent_to_rgb_daemon_hash != self.teams.hash:
+            if self._last_teams_version_sent_to_rgb_daemon != self.teams.version:
                 self.update_rgb()
         if self.rgb_sender:
             self.rgb_sender.stop_listening()
@@ -318,6 +374,8 @@ class CubeServerMaster(CubeServerBase):
             self.log.success("Started RGBMatrix Daemon")
 
         self.log.info("Updating RGBMatrix Daemon")
+        # read before the teams, so that a change made while we're sending is not missed
+        teams_version = self.teams.version
         # create a CubeRgbMatrixContentDict from the game status
         all_team_names = CubeConfig.get_config().defined_team_names
         assert all_team_names, "No team names defined in the config file"
@@ -348,7 +406,7 @@ class CubeServerMaster(CubeServerBase):
         # self.log.info(f"Reconstructed RGBMatrixContentDict : {rmcd_reconstructed.to_string()}")
         if self.rgb_sender.send_rgb_matrix_contents_dict(rmcd):
             self.log.success("Sent RGBMatrixContentDict to RGBMatrix Daemon")
-            self._last_teams_status_sent_to_rgb_daemon_hash = self.teams.hash
+            self._last_teams_version_sent_to_rgb_daemon = teams_version
         else:
             self.log.error("Failed to send RGBMatrixContentDict to RGBMatrix Daemon")
 
@@ -358,50 +416,130 @@ class CubeServerMaster(CubeServerBase):
         Checks the incoming messages and handle them as they come"""
         self.net.run()
         while self._keep_running:
-            time.sleep(LOOP_PERIOD_SEC)
             if self.enable_heartbeat and self.heartbeat_timer.is_timeout():
                 self.net.send_msg_with_udp(cm.CubeMsgHeartbeat(self.net.node_name))
                 self.heartbeat_timer.reset()
 
-            messages = self.net.get_incoming_msg_queue()
-            for message in messages:
-                # ignore ACK messages. They are to be handled in wait_for_ack_of()
-                if message.msgtype == cm.CubeMsgTypes.ACK:
-                    continue
-                elif message.msgtype == cm.CubeMsgTypes.COMMAND:
-                    self._handle_command_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.CONFIG:
-                    self._handle_config_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REPLY_DATABASE_TEAMS:
-                    self._handle_reply_database_teams_message(message)
-                # handle RFID read messages from the cubeboxes
-                elif message.msgtype == cm.CubeMsgTypes.CUBEBOX_RFID_READ:
-                    self._handle_cubebox_rfid_read_message(message)
-                # handle button press messages from the cubeboxes
-                elif message.msgtype == cm.CubeMsgTypes.CUBEBOX_BUTTON_PRESS:
-                    self._handle_cubebox_button_press_message(message)
-                # handle new team messages from the frontdesk
-                elif message.msgtype == cm.CubeMsgTypes.FRONTDESK_NEW_TEAM:
-                    self._handle_frontdesk_new_team_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.FRONTDESK_REMOVE_TEAM:
-                    self._handle_frontdesk_remove_team_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REQUEST_CUBEMASTER_STATUS:
-                    self._handle_request_cubemaster_status_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REQUEST_ALL_TEAMS_STATUSES:
-                    self._handle_request_all_teams_statuses_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REQUEST_TEAM_STATUS:
-                    self._handle_request_team_status_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REQUEST_ALL_TEAMS_STATUS_HASHES:
-                    self._handle_request_all_teams_status_hashes_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REQUEST_ALL_CUBEBOXES_STATUS_HASHES:
-                    self._handle_request_all_cubeboxes_status_hashes_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUSES:
-                    self._handle_reply_all_cubeboxes_status_message(message)
-                elif message.msgtype == cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS:
-                    self._handle_reply_cubebox_status(message)
-                else:
-                    self.log.debug(f"Unhandled message : ({message.hash}) : {message}. Removing")
-                self.net.remove_msg_from_incoming_queue(message)
+            # wakes up as soon as a message arrives, or every LOOP_PERIOD_SEC for the heartbeat
+            message = self.net.get_incoming_msg(timeout=LOOP_PERIOD_SEC)
+            if message is not None:
+                # ACK messages never get here. They are handled in wait_for_ack_of()
+                self._dispatch_message(message)
+
+    def _register_msg_handlers(self):
+        """Fills the dispatch registry used by _message_handling_loop"""
+        self.register_msg_handler(cm.CubeMsgTypes.COMMAND, self._handle_command_message)
+        self.register_msg_handler(cm.CubeMsgTypes.CONFIG, self._handle_config_message)
+        self.register_msg_handler(cm.CubeMsgTypes.REPLY_DATABASE_TEAMS, self._handle_reply_database_teams_message)
+        # handle RFID read messages from the cubeboxes
+        self.register_msg_handler(cm.CubeMsgTypes.CUBEBOX_RFID_READ, self._handle_cubebox_rfid_read_message,
+                                  locks_game_status=True)
+        # handle button press messages from the cubeboxes
+        self.register_msg_handler(cm.CubeMsgTypes.CUBEBOX_BUTTON_PRESS, self._handle_cubebox_button_press_message,
+                                  locks_game_status=True)
+        # handle new team messages from the frontdesk
+        self.register_msg_handler(cm.CubeMsgTypes.FRONTDESK_NEW_TEAM, self._handle_frontdesk_new_team_message,
+                                  locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.FRONTDESK_REMOVE_TEAM, self._handle_frontdesk_remove_team_message,
+                                  locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.REQUEST_CUBEMASTER_STATUS,
+                                  self._handle_request_cubemaster_status_message)
+        self.register_msg_handler(cm.CubeMsgTypes.REQUEST_CUBEBOX_STATUS,
+                                  self._handle_request_cubebox_status_message, locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.REQUEST_CUBEMASTER_STATUS_HASH,
+                                  self._handle_request_cubemaster_status_hash_message, locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.REQUEST_ALL_TEAMS_STATUSES,
+                                  self._handle_request_all_teams_statuses_message, locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.REQUEST_TEAM_STATUS,
+                                  self._handle_request_team_status_message, locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.REQUEST_ALL_TEAMS_STATUS_HASHES,
+                                  self._handle_request_all_teams_status_hashes_message, locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.REQUEST_ALL_CUBEBOXES_STATUS_HASHES,
+                                  self._handle_request_all_cubeboxes_status_hashes_message, locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUSES,
+                                  self._handle_reply_all_cubeboxes_status_message, locks_game_status=True)
+        self.register_msg_handler(cm.CubeMsgTypes.REPLY_CUBEBOX_STATUS,
+                                  self._handle_reply_cubebox_status, locks_game_status=True)
+
+    def _init_msg_dispatch(self):
+        """Sets up the message handlers and the workers running them. Only needs self.log and self.game_status"""
+        # the handlers now run concurrently: those reading or modifying the teams and cubeboxes hold this lock
+        self.game_status_lock = threading.RLock()
+        # the message handlers, indexed by message type name : (handler, whether it holds the game status lock)
+        self._msg_handlers: Dict[str, Tuple[Callable[[cm.CubeMessage], Any], bool]] = {}
+        self._register_msg_handlers()
+        # single-thread workers running the message handlers. The messages concerning the same team always go
+        # to the same worker, so that they're handled in order, while a slow handler does not hold back the others
+        self._handler_workers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"CubeMasterHandler{i}")
+                                 for i in range(NB_HANDLER_WORKERS)]
+        # the messages of a team are ordered by its RFID UID. These are recorded when dispatching, not when handling,
+        # so that a message follows the still queued one that creates its team or badges it in.
+        # Only used by the message handling thread.
+        # RFID UIDs of the recently created teams, by team name
+        self._dispatched_new_teams_rfid_uids: OrderedDict[TeamName, str] = OrderedDict()
+        # RFID UID of the last badge-in on each cubebox
+        self._dispatched_cubeboxes_rfid_uids: Dict[CubeId, str] = {}
+
+    def register_msg_handler(self, msgtype: cm.CubeMsgTypes, handler: Callable[[cm.CubeMessage], Any],
+                             locks_game_status=False):
+        """Registers the handler of a message type, replacing the previous one if any.
+        If `locks_game_status` is set, the handler runs while holding the game status lock"""
+        self._msg_handlers[msgtype.name] = (handler, locks_game_status)
+
+    def _dispatch_message(self, message: cm.CubeMessage) -> bool:
+        """Hands the message over to the worker in charge of its team. Returns False if it has no handler"""
+        if message.msgtype.name not in self._msg_handlers:
+            self.log.debug(f"Unhandled message : ({message.hash}) : {message}. Ignoring")
+            return False
+        ordering_key = self._get_msg_ordering_key(message)
+        worker = self._handler_workers[hash(ordering_key) % len(self._handler_workers)]
+        worker.submit(self._run_msg_handler, message)
+        return True
+
+    def _run_msg_handler(self, message: cm.CubeMessage):
+        handler, locks_game_status = self._msg_handlers[message.msgtype.name]
+        try:
+            if locks_game_status:
+                with self.game_status_lock:
+                    handler(message)
+            else:
+                handler(message)
+        except Exception as e:
+            self.log.error(f"Error while handling message ({message.hash}) : {e}")
+
+    def _get_msg_ordering_key(self, message: cm.CubeMessage) -> str:
+        """Returns the RFID UID of the team the message is about if it can be found, the sender's name otherwise.
+        The team creations, removals, badge-ins and button presses of a team thus share the same key.
+        The messages with the same key are handled in their order of arrival"""
+        key = None
+        try:
+            if message.msgtype == cm.CubeMsgTypes.FRONTDESK_NEW_TEAM:
+                team = cm.CubeMsgFrontdeskNewTeam(copy_msg=message).team
+                self._dispatched_new_teams_rfid_uids[team.name] = team.rfid_uid
+                self._dispatched_new_teams_rfid_uids.move_to_end(team.name)
+                while len(self._dispatched_new_teams_rfid_uids) > NB_DISPATCHED_NEW_TEAMS_KEPT:
+                    self._dispatched_new_teams_rfid_uids.popitem(last=False)
+                key = team.rfid_uid
+            elif message.msgtype == cm.CubeMsgTypes.FRONTDESK_REMOVE_TEAM:
+                team_name = cm.CubeMsgFrontdeskDeleteTeam(copy_msg=message).team_name
+                key = self._dispatched_new_teams_rfid_uids.get(team_name)
+                if key is None:
+                    with self.game_status_lock:
+                        team = self.teams.get_team_by_name(team_name)
+                    key = team.rfid_uid if team else team_name
+            elif message.msgtype == cm.CubeMsgTypes.CUBEBOX_RFID_READ:
+                key = cm.CubeMsgRfidRead(copy_msg=message).uid
+                self._dispatched_cubeboxes_rfid_uids[cubeid.node_name_to_cubebox_index(message.sender)] = key
+            elif message.msgtype == cm.CubeMsgTypes.CUBEBOX_BUTTON_PRESS:
+                cube_id = cubeid.node_name_to_cubebox_index(message.sender)
+                key = self._dispatched_cubeboxes_rfid_uids.get(cube_id)
+                if key is None:
+                    with self.game_status_lock:
+                        team = self.teams.get_team_by_current_cube_id(cube_id)
+                    key = team.rfid_uid if team else None
+        except Exception as e:
+            self.log.warning(f"Could not find the team of message ({message.hash}) : {e}")
+        return key or message.sender
 
     def register_team_to_cubebox(self, team: cube_game.CubeTeamStatus, new_cubebox_id: CubeId):
         """Register a team to a cubebox. This means updating the team's current cubebox id
@@ -613,8 +751,9 @@ class CubeServerMaster(CubeServerBase):
             return False
         cmd, *args = parts
         if command == "reset":
-            self.teams = cube_game.CubeTeamsStatusList()
-            self.cubeboxes = cube_game.CubeboxesStatusList()
+            with self.game_status_lock:
+                self.teams = cube_game.CubeTeamsStatusList()
+                self.cubeboxes = cube_game.CubeboxesStatusList()
             return True
         elif command == "update_rgb":
             self.update_rgb()
@@ -665,6 +804,12 @@ class CubeServerMaster(CubeServerBase):
         self.log.info(f"Received request cubemaster status message from {message.sender}")
         self.send_status_to_frontdesk()
 
+    def _handle_request_cubemaster_status_hash_message(self, message: cm.CubeMessage):
+        self.log.info(f"Received request cubemaster status hash message from {message.sender}")
+        self.net.send_msg_to(cm.CubeMsgReplyCubeMasterStatusHash(
+            self.net.node_name, self.game_status.tree_hash, bucket_hashes=self.game_status.bucket_hashes),
+            message.sender)
+
     def _handle_request_all_teams_statuses_message(self, message: cm.CubeMessage):
         self.log.info(f"Received request all teams status message from {message.sender}")
         self.net.send_msg_to_frontdesk(cm.CubeMsgReplyAllTeamsStatuses(self.net.node_name, self.teams))
@@ -700,7 +845,9 @@ class CubeServerMaster(CubeServerBase):
 
     @cubetry
     def _handle_team_time_up(self, team: cube_game.CubeTeamStatus):
-        """Handle the fact that a team is out of time"""
+        """Handle the fact that a team is out of time.
+        The ACKs are not waited for here: the removal of the team carries on in the send callbacks,
+        so that the status update loop keeps running in the meantime."""
         self.log.info(f"Team {team.name} is out of time.")
         try:
             team_name = team.name
@@ -710,8 +857,20 @@ class CubeServerMaster(CubeServerBase):
                 self.run_alarm()
 
             # notify the frontdesk
+            with self.game_status_lock:
+                self._teams_time_up_in_progress.add(team_name)
             nttu_msg = cm.CubeMsgNotifyTeamTimeUp(self.net.node_name, team_name=team.name)
-            report = self.net.send_msg_to_frontdesk(nttu_msg, require_ack=True, nb_tries=3)
+            self.net.send_msg_to_frontdesk_async(
+                nttu_msg, require_ack=True, nb_tries=3,
+                callback=lambda report: self._handle_team_time_up_frontdesk_report(team_name, report))
+            return True
+        except Exception as e:
+            self.log.error(f"Error in _handle_team_time_up: {e}")
+            return False
+
+    def _handle_team_time_up_frontdesk_report(self, team_name: TeamName, report: cubenet.SendReport) -> bool:
+        """Called once the frontdesk has acknowledged (or not) the team time up message"""
+        try:
             assert report, "Failed to send the team time up message to the frontdesk"
             assert report.ack_msg, "Sent the team time up message to the frontdesk but no ACK received"
             if not report.ack_ok:
@@ -720,25 +879,55 @@ class CubeServerMaster(CubeServerBase):
             else:
                 self.log.success("Sent the team time up message to the frontdesk and received ACK OK")
 
+            team = self.teams.get_team_by_name(team_name)
+            assert team, f"Team {team_name} not found in the local teams list"
             # if the team still has a cubebox, instruct the cubebox to badge out this team
             cubebox = self.cubeboxes.get_cubebox_by_cube_id(team.current_cubebox_id)
             if cubebox:
                 self.log.info("Team still has a cubebox. Instructing the cubebox to badge out the team")
                 otbo_msg = cm.CubeMsgOrderCubeboxTeamBadgeOut(
                     self.net.node_name, team_name=team.name, cube_id=cubebox.cube_id)
-                report = self.net.send_msg_to(
-                    message=otbo_msg, node_name=cubebox.node_name, require_ack=True, nb_tries=3)
-                assert report, "Failed to send the order team badge out message to the cubebox"
-                assert report.ack_msg, "Sent the order team badge out message to the cubebox but no ACK received"
-                assert report.ack_ok, "Sent the order team badge out message to the cubebox but the ACK was not OK"
-                self.log.success("Sent the order team badge out message to the cubebox and received ACK")
-
-            assert self.teams.remove_team(team.name), "Failed to remove the team from the local teams list"
-            self.log.success(f"Removed team {team.name} from the local teams list")
+                self.net.send_msg_to_async(
+                    message=otbo_msg, node_name=cubebox.node_name, require_ack=True, nb_tries=3,
+                    callback=lambda badge_out_report: self._handle_team_time_up_badge_out_report(
+                        team_name, badge_out_report))
+                return True
+            return self._remove_timed_up_team(team_name)
+        except Exception as e:
+            self.log.error(f"Error in _handle_team_time_up: {e}")
+            # the status update loop will try again
+            with self.game_status_lock:
+                self._teams_time_up_in_progress.discard(team_name)
+            return False
+
+    def _handle_team_time_up_badge_out_report(self, team_name: TeamName, report: cubenet.SendReport) -> bool:
+        """Called once the cubebox has acknowledged (or not) the order to badge out a team whose time is up"""
+        try:
+            assert report, "Failed to send the order team badge out message to the cubebox"
+            assert report.ack_msg, "Sent the order team badge out message to the cubebox but no ACK received"
+            assert report.ack_ok, "Sent the order team badge out message to the cubebox but the ACK was not OK"
+            self.log.success("Sent the order team badge out message to the cubebox and received ACK")
+            return self._remove_timed_up_team(team_name)
+        except Exception as e:
+            self.log.error(f"Error in _handle_team_time_up: {e}")
+            # the status update loop will try again
+            with self.game_status_lock:
+                self._teams_time_up_in_progress.discard(team_name)
+            return False
+
+    def _remove_timed_up_team(self, team_name: TeamName) -> bool:
+        """Last step of _handle_team_time_up: remove the team from the local teams list"""
+        try:
+            with self.game_status_lock:
+                assert self.teams.remove_team(team_name), "Failed to remove the team from the local teams list"
+            self.log.success(f"Removed team {team_name} from the local teams list")
             return True
         except Exception as e:
             self.log.error(f"Error in _handle_team_time_up: {e}")
             return False
+        finally:
+            with self.game_status_lock:
+                self._teams_time_up_in_progress.discard(team_name)
 
     def _rfid_loop(self):
         """check the RFID lines and handle them"""
@@ -758,17 +947,18 @@ class CubeServerMaster(CubeServerBase):
 
     def request_all_cubeboxes_statuses_at_once(self, reply_timeout: Seconds = None) -> bool:
         msg = cm.CubeMsgRequestAllCubeboxesStatuses(self.net.node_name)
-        report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
-        if not report:
-            self.log.error("Failed to send the request all cubeboxes status message")
-            return True
-        if reply_timeout is not None:
-            reply_msg = self.net.wait_for_message(msgtype=cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUSES,
-                                                  timeout=reply_timeout)
-            if not reply_msg:
-                self.log.error("Failed to receive the all cubeboxes status reply")
-                return False
-            return self._handle_reply_all_cubeboxes_status_message(reply_msg)
+        # subscribe before sending the request, so that a quick reply cannot be missed
+        with self.net.subscribe(cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUSES) as subscription:
+            report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
+            if not report:
+                self.log.error("Failed to send the request all cubeboxes status message")
+                return True
+            if reply_timeout is not None:
+                reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
+                if not reply_msg:
+                    self.log.error("Failed to receive the all cubeboxes status reply")
+                    return False
+                return self._handle_reply_all_cubeboxes_status_message(reply_msg)
 
 
 
@@ -846,11 +1036,64 @@ def test_highscores():
         master.stop()
 
 
+def test_handler_dispatch():
+    """Checks that a slow handler does not hold back the messages of another team,
+    and that the messages of a team are handled in order"""
+    # a master without networking, database, sound nor web app: only what the dispatch needs
+    master = CubeServerMaster.__new__(CubeServerMaster)
+    CubeServerBase.__init__(master)
+    master.log = cube_logger.CubeLogger(name=cubeid.CUBEMASTER_NODENAME)
+    master.game_status = cube_game.CubeGameStatus()
+    master._init_msg_dispatch()
+    try:
+        handled = []
+        slow_done = threading.Event()
+
+        def slow_handler(message: cm.CubeMessage):
+            time.sleep(1)
+            slow_done.set()
+
+        def remove_team_handler(message: cm.CubeMessage):
+            handled.append(cm.CubeMsgFrontdeskDeleteTeam(copy_msg=message).kwargs["index"])
+
+        master.register_msg_handler(cm.CubeMsgTypes.COMMAND, slow_handler)
+        master.register_msg_handler(cm.CubeMsgTypes.FRONTDESK_REMOVE_TEAM, remove_team_handler)
+        command_msg = cm.CubeMsgCommand(cubeid.CUBEFRONTDESK_NODENAME, full_command=f"{cubeid.CUBEMASTER_NODENAME} alarm")
+        command_key = master._get_msg_ordering_key(command_msg)
+        # a team which is not handled by the same worker as the command
+        team_name = next(name for name in (f"Team{i}" for i in range(100))
+                         if hash(name) % NB_HANDLER_WORKERS != hash(command_key) % NB_HANDLER_WORKERS)
+        master._dispatch_message(command_msg)
+        for index in range(10):
+            remove_msg = cm.CubeMsgFrontdeskDeleteTeam(cubeid.CUBEFRONTDESK_NODENAME, team_name=team_name)
+            remove_msg.kwargs["index"] = index
+            master._dispatch_message(remove_msg)
+        time.sleep(0.5)
+        assert not slow_done.is_set()
+        assert handled == list(range(10)), handled
+        assert slow_done.wait(2)
+        # the creation, badge-in, button press and removal of a team are ordered together,
+        # even though the team does not exist yet when they are dispatched
+        cubebox_name = cubeid.cubebox_index_to_node_name(1)
+        new_team = cube_game.CubeTeamStatus(name="Paris", rfid_uid="1234567890", max_time_sec=60)
+        keys = {master._get_msg_ordering_key(cm.CubeMsgFrontdeskNewTeam(cubeid.CUBEFRONTDESK_NODENAME, new_team)),
+                master._get_msg_ordering_key(cm.CubeMsgRfidRead(cubebox_name, uid=new_team.rfid_uid, timestamp=1.0)),
+                master._get_msg_ordering_key(cm.CubeMsgButtonPress(cubebox_name, start_timestamp=1.0, press_timestamp=2.0)),
+                master._get_msg_ordering_key(cm.CubeMsgFrontdeskDeleteTeam(cubeid.CUBEFRONTDESK_NODENAME,
+                                                                            team_name=new_team.name))}
+        assert keys == {new_team.rfid_uid}, keys
+    finally:
+        for worker in master._handler_workers:
+            worker.shutdown()
+    print("test_handler_dispatch PASSED")
+
+
 if __name__ == "__main__":
     import sys
 
     # sys.argv.append("--test_rgb")
     # sys.argv.append("--test-highscores")
+    # sys.argv.append("--test-dispatch")
     if "--test_rgb" in sys.argv:
         master = CubeServerMaster()
         master.test_rgb()
@@ -858,5 +1101,8 @@ if __name__ == "__main__":
     elif "--test-highscores" in sys.argv:
         chs.test_run(launch_browser=True)
         exit(0)
+    elif "--test-dispatch" in sys.argv:
+        test_handler_dispatch()
+        exit(0)
     else:
         main()
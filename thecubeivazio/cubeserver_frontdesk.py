@@ -2,7 +2,7 @@
 import logging
 import threading
 import time
-from typing import Iterable, Sized
+from typing import Dict, Iterable, Sized, Tuple
 
 import thecubeivazio.cube_game as cube_game
 import thecubeivazio.cube_identification as cubeid
@@ -16,6 +16,9 @@ from thecubeivazio import cube_database as cubedb
 from thecubeivazio.cube_common_defines import *
 from thecubeivazio. cubeserver_base import CubeServerBase
 
+# how often the frontdesk checks that its game status matches the cubemaster's
+RECONCILIATION_PERIOD_SEC = 10
+
 
 class CubeServerFrontdesk(CubeServerBase):
     def __init__(self):
@@ -43,6 +46,7 @@ class CubeServerFrontdesk(CubeServerBase):
 
         # params for threading
         self._msg_handling_thread = threading.Thread(target=self._message_handling_loop, daemon=True)
+        self._reconciliation_thread = threading.Thread(target=self._reconciliation_loop, daemon=True)
 
         self._keep_running = False
 
@@ -53,6 +57,8 @@ class CubeServerFrontdesk(CubeServerBase):
         # holds the information about the teams
         # TODO: do something with them. update them, request updates, etc
         self.game_status = cube_game.CubeGameStatus()
+        # version of the cubemaster status we're up to date with, to which its status deltas apply
+        self.status_version: Optional[int] = None
 
 
         # on startup, send the config to everyone
@@ -62,6 +68,7 @@ class CubeServerFrontdesk(CubeServerBase):
         self.rfid.run()
         self._keep_running = True
         self._msg_handling_thread.start()
+        self._reconciliation_thread.start()
         # self.net.send_msg_with_udp(cm.CubeMsgHeartbeat(self.net.node_name))
 
     def stop(self):
@@ -69,23 +76,22 @@ class CubeServerFrontdesk(CubeServerBase):
         self.net.stop()
         self.rfid.stop()
         self._msg_handling_thread.join(timeout=0.1)
+        self._reconciliation_thread.join(timeout=0.1)
 
     def _message_handling_loop(self):
         """check the incoming messages and handle them"""
         self.net.run()
         while self._keep_running:
-            time.sleep(LOOP_PERIOD_SEC)
             # print(":", end="")
             if self.enable_heartbeat and self.heartbeat_timer.is_timeout():
                 self.net.send_msg_with_udp(cm.CubeMsgHeartbeat(self.net.node_name))
                 self.heartbeat_timer.reset()
 
-            messages = self.net.get_incoming_msg_queue()
-            for message in messages:
-                # ignore ack messages, they're handled in the networking module
-                if message.msgtype == cm.CubeMsgTypes.ACK:
-                    continue
-                elif message.msgtype == cm.CubeMsgTypes.NOTIFY_TEAM_TIME_UP:
+            # wakes up as soon as a message arrives, or every LOOP_PERIOD_SEC for the heartbeat
+            message = self.net.get_incoming_msg(timeout=LOOP_PERIOD_SEC)
+            if message is not None:
+                # ack messages never get here, they're handled in the networking module
+                if message.msgtype == cm.CubeMsgTypes.NOTIFY_TEAM_TIME_UP:
                     self._handle_notify_team_time_up_message(message)
                 elif message.msgtype == cm.CubeMsgTypes.REQUEST_DATABASE_TEAMS:
                     self._handle_request_database_teams(message)
@@ -99,13 +105,25 @@ class CubeServerFrontdesk(CubeServerBase):
                     self._handle_reply_all_teams_status(message)
                 elif message.msgtype == cm.CubeMsgTypes.REPLY_CUBEMASTER_STATUS:
                     self._handle_reply_cubemaster_status_message(message)
+                elif message.msgtype == cm.CubeMsgTypes.CUBEMASTER_STATUS_DELTA:
+                    self._handle_cubemaster_status_delta_message(message)
                 elif message.msgtype == cm.CubeMsgTypes.REPLY_ALL_TEAMS_STATUS_HASHES:
                     self._handle_reply_all_teams_status_hashes(message)
                 elif message.msgtype == cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUS_HASHES:
                     self._handle_reply_all_cubeboxes_status_hashes(message)
                 else:
-                    self.log.debug(f"Unhandled message type: {message.msgtype}. Removing")
-                self.net.remove_msg_from_incoming_queue(message)
+                    self.log.debug(f"Unhandled message type: {message.msgtype}. Ignoring")
+
+    def _reconciliation_loop(self):
+        """Periodically repairs the differences between our game status and the cubemaster's,
+        left by lost messages or by a reboot"""
+        next_reconciliation_time = time.time() + RECONCILIATION_PERIOD_SEC
+        while self._keep_running:
+            time.sleep(LOOP_PERIOD_SEC)
+            if time.time() < next_reconciliation_time:
+                continue
+            self.reconcile_with_cubemaster()
+            next_reconciliation_time = time.time() + RECONCILIATION_PERIOD_SEC
 
     def _handle_notify_team_time_up_message(self, message: cm.CubeMessage):
         self.log.info(f"Received team time up message from {message.sender}")
@@ -199,13 +217,18 @@ class CubeServerFrontdesk(CubeServerBase):
             self.net.acknowledge_this_message(message, ack_info=cm.CubeAckInfos.ERROR)
             return False
 
-    def _handle_reply_team_status_message(self, message: cm.CubeMessage) -> bool:
+    def _handle_reply_team_status_message(self, message: cm.CubeMessage, replace=False) -> bool:
+        """Updates our status of the team with the one in the message.
+        If `replace` is set, our status is replaced by the received one instead of being merged with it."""
         try:
             self.log.info(f"Received team status reply message from {message.sender}")
             rts_msg = cm.CubeMsgReplyTeamStatus(copy_msg=message)
             new_team_status = rts_msg.team_status
             assert new_team_status.is_valid(), "_handle_team_status_reply: new_team_status is invalid"
-            assert self.teams.update_team(new_team_status), "_handle_team_status_reply: update_team failed"
+            if replace:
+                assert self.teams.replace_team(new_team_status), "_handle_team_status_reply: replace_team failed"
+            else:
+                assert self.teams.update_team(new_team_status), "_handle_team_status_reply: update_team failed"
             self.log.info(f"Updated team status: {new_team_status}")
             self.net.acknowledge_this_message(message, ack_info=cm.CubeAckInfos.OK)
             return True
@@ -226,11 +249,13 @@ class CubeServerFrontdesk(CubeServerBase):
             assert new_cubemaster_status.cubeboxes, "_handle_reply_cubemaster_status: new_cubemaster.cubeboxes is None"
             assert new_cubemaster_status.cubeboxes is not None, "_handle_reply_cubemaster_status: new_cubemaster.cubeboxes is None"
             assert new_cubemaster_status.cubeboxes.is_valid(), "_handle_reply_cubemaster_status: new_cubemaster.cubeboxes is invalid"
-            assert self.teams.update_from_teams_list(
-                new_cubemaster_status.teams), "_handle_reply_cubemaster_status: update_from_teams_list failed"
+            # the full status is a checkpoint: the cubemaster's teams replace ours instead of being merged with them
+            assert self.teams.replace_from_teams_list(
+                new_cubemaster_status.teams), "_handle_reply_cubemaster_status: replace_from_teams_list failed"
             assert self.cubeboxes.update_from_cubeboxes(
                 new_cubemaster_status.cubeboxes), "_handle_reply_cubemaster_status: update_from_cubeboxes failed"
-            self.log.success(f"Updated teams and cubeboxes from cubemaster status")
+            self.status_version = acsr_msg.status_version
+            self.log.success(f"Updated teams and cubeboxes from cubemaster status (version {self.status_version})")
             self.net.acknowledge_this_message(message, ack_info=cm.CubeAckInfos.OK)
             # self.log.info(f"new cubemaster status: {new_cubemaster_status.to_json()}")
             # self.log.info(f"new frontdesk teams statuses: {self.teams.to_json()}")
@@ -242,6 +267,30 @@ class CubeServerFrontdesk(CubeServerBase):
             self.net.acknowledge_this_message(message, ack_info=cm.CubeAckInfos.ERROR)
             return False
 
+    def _handle_cubemaster_status_delta_message(self, message: cm.CubeMessage) -> bool:
+        """Patches the teams and cubeboxes with the changes sent by the cubemaster.
+        If we don't have the status version they apply to, ack with INVALID so that it sends the full status."""
+        try:
+            csd_msg = cm.CubeMsgCubemasterStatusDelta(copy_msg=message)
+            delta = csd_msg.delta
+            assert delta, "_handle_cubemaster_status_delta_message: delta is None"
+            if self.status_version is None or delta.base_version != self.status_version:
+                self.log.warning(f"Received cubemaster status changes from version {delta.base_version}, "
+                                 f"but our version is {self.status_version}. Asking for the full status.")
+                self.net.acknowledge_this_message(message, ack_info=cm.CubeAckInfos.INVALID)
+                return False
+            assert delta.teams.is_valid(), "_handle_cubemaster_status_delta_message: delta.teams is invalid"
+            assert delta.cubeboxes.is_valid(), "_handle_cubemaster_status_delta_message: delta.cubeboxes is invalid"
+            assert delta.apply_to(self.game_status), "_handle_cubemaster_status_delta_message: apply_to failed"
+            self.status_version = delta.version
+            self.log.success(f"Updated teams and cubeboxes from cubemaster status changes: {delta}")
+            self.net.acknowledge_this_message(message, ack_info=cm.CubeAckInfos.OK)
+            return True
+        except Exception as e:
+            self.log.error(f"Error handling cubemaster status delta message: {e}")
+            self.net.acknowledge_this_message(message, ack_info=cm.CubeAckInfos.ERROR)
+            return False
+
     @cubetry
     def add_new_team(self, team: cube_game.CubeTeamStatus) -> cubenet.SendReport:
         """Send a message to the CubeMaster to add a new team.
@@ -336,32 +385,40 @@ class CubeServerFrontdesk(CubeServerBase):
         return self.send_config_message_to_all()
 
     @cubetry
-    def request_cubemaster_status(self, reply_timeout: Seconds=None) -> cubenet.SendReport:
+    def request_cubemaster_status(self, reply_timeout: Seconds=None, max_age: Seconds=None) -> cubenet.SendReport:
         """Send a message to the CubeMaster to request its status.
         if a reply_timout is specified, wait for the reply for that amount of time.
-        If the request send or the reply receive fails, return False."""
+        If the request send or the reply receive fails, return False.
+        Concurrent calls with the same reply_timeout share the same request, and a reply younger than max_age
+        (STATUS_REPLY_MAX_AGE by default) is reused."""
+        return self._request_flights.do(
+            ("cubemaster_status", reply_timeout), lambda: self._request_cubemaster_status(reply_timeout), max_age)
+
+    @cubetry
+    def _request_cubemaster_status(self, reply_timeout: Seconds=None) -> cubenet.SendReport:
         self.log.info("Sending request cubemaster status message...")
         reply_timeout = reply_timeout or STATUS_REPLY_TIMEOUT
         msg = cm.CubeMsgRequestCubemasterStatus(self.net.node_name)
-        report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
-        if not report:
-            info = "Failed to send the request cubemaster status message"
-            self.log.error(info)
-            return cubenet.SendReport(sent_ok=False, raw_info=info)
-
-        if reply_timeout is not None:
-            reply_msg = self.net.wait_for_message(msgtype=cm.CubeMsgTypes.REPLY_CUBEMASTER_STATUS,
-                                                  timeout=reply_timeout)
-            if not reply_msg:
-                info = "Failed to receive the cubemaster status reply"
-                self.log.error(info)
-                return cubenet.SendReport(sent_ok=False, raw_info=info)
-            handle_success = self._handle_reply_cubemaster_status_message(reply_msg)
-            if not handle_success:
-                info = "Failed to handle the cubemaster status reply"
+        # subscribe before sending the request, so that a quick reply cannot be missed
+        with self.net.subscribe(cm.CubeMsgTypes.REPLY_CUBEMASTER_STATUS) as subscription:
+            report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
+            if not report:
+                info = "Failed to send the request cubemaster status message"
                 self.log.error(info)
                 return cubenet.SendReport(sent_ok=False, raw_info=info)
-        return cubenet.SendReport(sent_ok=True, ack_ok=True)
+
+            if reply_timeout is not None:
+                reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
+                if not reply_msg:
+                    info = "Failed to receive the cubemaster status reply"
+                    self.log.error(info)
+                    return cubenet.SendReport(sent_ok=False, raw_info=info)
+                handle_success = self._handle_reply_cubemaster_status_message(reply_msg)
+                if not handle_success:
+                    info = "Failed to handle the cubemaster status reply"
+                    self.log.error(info)
+                    return cubenet.SendReport(sent_ok=False, raw_info=info)
+            return cubenet.SendReport(sent_ok=True, ack_ok=True)
 
     @cubetry
     def send_config_message_to_all(self, config: cube_config.CubeConfig=None, nodenames:list[NodeName]=cubeid.ALL_NODENAMES) -> cubenet.SendReport:
@@ -373,111 +430,188 @@ class CubeServerFrontdesk(CubeServerBase):
         self.log.info(f"Sending config message to all nodes : {nodenames}...")
 
         msg = cm.CubeMsgConfig(self.net.node_name, config)
-        # we have to do this node by node, checking that everyone acks
-        for node_name in nodenames:
-            # don't send to self
-            if node_name == self.net.node_name:
-                continue
-            self.log.info(f"Sending config message to {node_name}...")
-            report = self.net.send_msg_to(msg, node_name, require_ack=False)
+        # sent to every node at once, checking that everyone acks
+        reports = self.net.send_msg_to_many(msg, nodenames, require_ack=True)
+        for node_name, report in reports.items():
             if not report.sent_ok:
                 self.log.error(f"Failed to send the config message to {node_name}")
                 return cubenet.SendReport(sent_ok=False, raw_info=f"Failed to send the config message to {node_name}")
-            ack_msg = self.net.wait_for_ack_of(msg, ack_sender=node_name)
-            if not ack_msg:
+            if not report.ack_msg:
                 self.log.error(f"Timed out waiting for ack from {node_name}.")
                 return cubenet.SendReport(sent_ok=False, raw_info=f"Timed out waiting for ack from {node_name}")
-            if ack_msg.ack_info != cm.CubeAckInfos.OK:
-                self.log.error(f"{node_name} acked but with info {ack_msg.ack_info}")
-                return cubenet.SendReport(sent_ok=False, raw_info=f"{node_name} acked but with info {ack_msg.ack_info}")
-            self.log.success(f"Sent config message to {node_name}")
+            if not report.ack_ok:
+                self.log.error(f"{node_name} acked but with info {report.ack_info}")
+                return cubenet.SendReport(sent_ok=False, raw_info=f"{node_name} acked but with info {report.ack_info}")
         self.log.success(f"Sent config message to all nodes")
         return cubenet.SendReport(sent_ok=True)
 
     @cubetry
-    def request_team_status(self, team_name: str, reply_timeout: Optional[Seconds]) -> bool:
+    def request_team_status(self, team_name: str, reply_timeout: Optional[Seconds], max_age: Seconds = None) -> bool:
         """Send a message to the CubeMaster to request the status of a team.
         if a reply_timout is specified, wait for the reply for that amount of time.
-        If the request send or the reply receive fails, return False."""
+        If the request send or the reply receive fails, return False.
+        Concurrent calls with the same reply_timeout share the same request,
+        and a reply younger than max_age is reused."""
+        return self._request_flights.do(
+            ("team_status", team_name, reply_timeout),
+            lambda: self._request_team_status(team_name, reply_timeout), max_age)
+
+    @cubetry
+    def _request_team_status(self, team_name: str, reply_timeout: Optional[Seconds], replace=False) -> bool:
         msg = cm.CubeMsgRequestTeamStatus(self.net.node_name, team_name)
-        report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
-        if not report:
-            self.log.error(f"Failed to send the request team status message for team {team_name}")
-            return True
-        if reply_timeout is not None:
-            reply_msg = self.net.wait_for_message(msgtype=cm.CubeMsgTypes.REPLY_TEAM_STATUS, timeout=reply_timeout)
-            if not reply_msg:
-                self.log.error(f"Failed to receive the team status reply for team {team_name}")
-                return False
-            return self._handle_reply_team_status_message(reply_msg)
+        # subscribe before sending the request, so that a quick reply cannot be missed,
+        # and only to the replies about this team, so that concurrent requests each get their own
+        with self.net.subscribe(
+                cm.CubeMsgTypes.REPLY_TEAM_STATUS,
+                accept=lambda m: cm.CubeMsgReplyTeamStatus(copy_msg=m).team_status.name == team_name
+        ) as subscription:
+            report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
+            if not report:
+                self.log.error(f"Failed to send the request team status message for team {team_name}")
+                return True
+            if reply_timeout is not None:
+                reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
+                if not reply_msg:
+                    self.log.error(f"Failed to receive the team status reply for team {team_name}")
+                    return False
+                return self._handle_reply_team_status_message(reply_msg, replace=replace)
 
     @cubetry
-    def request_all_teams_status(self, reply_timeout: Optional[Seconds]) -> bool:
+    def request_all_teams_status(self, reply_timeout: Optional[Seconds], max_age: Seconds = None) -> bool:
         """Send a message to the CubeMaster to request the status of all teams.
         if a reply_timout is specified, wait for the reply for that amount of time.
-        If the request send or the reply receive fails, return False."""
+        If the request send or the reply receive fails, return False.
+        Concurrent calls with the same reply_timeout share the same request,
+        and a reply younger than max_age is reused."""
+        return self._request_flights.do(
+            ("all_teams_status", reply_timeout),
+            lambda: self._request_all_teams_status(reply_timeout), max_age)
+
+    @cubetry
+    def _request_all_teams_status(self, reply_timeout: Optional[Seconds]) -> bool:
         msg = cm.CubeMsgRequestAllTeamsStatuses(self.net.node_name)
-        report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
-        if not report:
-            self.log.error("Failed to send the request all teams status message")
-            return True
-        if reply_timeout is not None:
-            reply_msg = self.net.wait_for_message(msgtype=cm.CubeMsgTypes.REPLY_TEAM_STATUS, timeout=reply_timeout)
+        # subscribe before sending the request, so that a quick reply cannot be missed
+        with self.net.subscribe(cm.CubeMsgTypes.REPLY_ALL_TEAMS_STATUSES) as subscription:
+            report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
+            if not report:
+                self.log.error("Failed to send the request all teams status message")
+                return True
+            if reply_timeout is not None:
+                reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
+                if not reply_msg:
+                    self.log.error("Failed to receive the all teams status reply")
+                    return False
+                return self._handle_reply_all_teams_status(reply_msg)
+
+    @cubetry
+    def request_cubemaster_status_hash(self, reply_timeout: Seconds = None) -> Optional[Dict[str, Hash]]:
+        """Send a message to the CubeMaster to request the top of its status hash tree.
+        Returns the hashes of its cubeboxes and teams (see CubeGameStatus.bucket_hashes),
+        or None if the request send or the reply receive fails."""
+        reply_timeout = reply_timeout or STATUS_REPLY_TIMEOUT
+        msg = cm.CubeMsgRequestCubeMasterStatusHash(self.net.node_name)
+        # subscribe before sending the request, so that a quick reply cannot be missed
+        with self.net.subscribe(cm.CubeMsgTypes.REPLY_CUBEMASTER_STATUS_HASH) as subscription:
+            report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
+            if not report:
+                self.log.error("Failed to send the request cubemaster status hash message")
+                return None
+            reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
             if not reply_msg:
-                self.log.error("Failed to receive the all teams status reply")
-                return False
-            return self._handle_reply_all_teams_status(reply_msg)
+                self.log.error("Failed to receive the cubemaster status hash reply")
+                return None
+            return cm.CubeMsgReplyCubeMasterStatusHash(copy_msg=reply_msg).bucket_hashes
 
     @cubetry
-    def request_all_teams_status_hashes(self, reply_timeout: Optional[Seconds]) -> bool:
+    def request_all_teams_status_hashes(self, reply_timeout: Optional[Seconds]) -> Optional[Tuple[TeamName, ...]]:
         """Send a message to the CubeMaster to request the status hashes of all teams.
-        if a reply_timout is specified, wait for the reply for that amount of time.
-        If the request send or the reply receive fails, return False."""
+        if a reply_timout is specified, wait for the reply for that amount of time,
+        and return the names of the teams whose status differs from the cubemaster's.
+        If the request send or the reply receive fails, return None."""
         msg = cm.CubeMsgRequestAllTeamsStatusHashes(self.net.node_name)
-        report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
-        if not report:
-            self.log.error("Failed to send the request all teams status hashes message")
-            return True
-        if reply_timeout is not None:
-            reply_msg = self.net.wait_for_message(msgtype=cm.CubeMsgTypes.REPLY_ALL_TEAMS_STATUS_HASHES,
-                                                  timeout=reply_timeout)
-            if not reply_msg:
-                self.log.error("Failed to receive the all teams status hashes reply")
-                return False
-            return self._handle_reply_all_teams_status_hashes(reply_msg)
-
-
+        # subscribe before sending the request, so that a quick reply cannot be missed
+        with self.net.subscribe(cm.CubeMsgTypes.REPLY_ALL_TEAMS_STATUS_HASHES) as subscription:
+            report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
+            if not report:
+                self.log.error("Failed to send the request all teams status hashes message")
+                return None
+            if reply_timeout is not None:
+                reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
+                if not reply_msg:
+                    self.log.error("Failed to receive the all teams status hashes reply")
+                    return None
+                return self._handle_reply_all_teams_status_hashes(reply_msg)
+            return ()
 
     @cubetry
-    def request_all_cubeboxes_status_hashes(self, reply_timeout: Seconds = None) -> bool:
+    def request_all_cubeboxes_status_hashes(self, reply_timeout: Seconds = None) -> Optional[Tuple[NodeName, ...]]:
         """Send a message to the CubeMaster to request the status hashes of all cubeboxes.
-        if a reply_timout is specified, wait for the reply for that amount of time.
-        If the request send or the reply receive fails, return False."""
+        if a reply_timout is specified, wait for the reply for that amount of time,
+        and return the names of the cubeboxes whose status differs from the cubemaster's.
+        If the request send or the reply receive fails, return None."""
         msg = cm.CubeMsgRequestAllCubeboxesStatusHashes(self.net.node_name)
-        report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
-        if not report:
-            self.log.error("Failed to send the request all cubeboxes status hashes message")
-            return True
-        if reply_timeout is not None:
-            reply_msg = self.net.wait_for_message(msgtype=cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUS_HASHES,
-                                                  timeout=reply_timeout)
-            if not reply_msg:
-                self.log.error("Failed to receive the all cubeboxes status hashes reply")
-                return False
-            return self._handle_reply_all_cubeboxes_status_hashes(reply_msg)
-
-
-    @cubetry
-    def _handle_reply_all_teams_status_hashes(self, message: cm.CubeMessage) -> bool:
-        self.log.info(f"Received reply all teams status hashes message from {message.sender}")
-        self.log.critical("_handle_reply_all_teams_status_hashes: not implemented")
-        return False
+        # subscribe before sending the request, so that a quick reply cannot be missed
+        with self.net.subscribe(cm.CubeMsgTypes.REPLY_ALL_CUBEBOXES_STATUS_HASHES) as subscription:
+            report = self.net.send_msg_to_cubemaster(msg, require_ack=False)
+            if not report:
+                self.log.error("Failed to send the request all cubeboxes status hashes message")
+                return None
+            if reply_timeout is not None:
+                reply_msg = self.net.wait_for_subscribed_message(subscription, timeout=reply_timeout)
+                if not reply_msg:
+                    self.log.error("Failed to receive the all cubeboxes status hashes reply")
+                    return None
+                return self._handle_reply_all_cubeboxes_status_hashes(reply_msg)
+            return ()
 
     @cubetry
-    def _handle_reply_all_cubeboxes_status_hashes(self, message: cm.CubeMessage) -> bool:
-        self.log.info(f"Received reply all cubeboxes status hashes message from {message.sender}")
-        self.log.critical("_handle_reply_all_cubeboxes_status_hashes: not implemented")
-        return False
+    def reconcile_with_cubemaster(self, reply_timeout: Seconds = None) -> bool:
+        """Repairs the differences between our game status and the cubemaster's by walking down its hash tree:
+        the root hashes are compared first, then the hashes of the teams or of the cubeboxes if they differ,
+        only the records whose hashes differ are fetched, and the teams the cubemaster no longer has are removed.
+        Returns True if our game status is now the same as the cubemaster's."""
+        reply_timeout = reply_timeout or STATUS_REPLY_TIMEOUT
+        bucket_hashes = self.request_cubemaster_status_hash(reply_timeout)
+        if bucket_hashes is None:
+            return False
+        local_bucket_hashes = self.game_status.bucket_hashes
+        if bucket_hashes == local_bucket_hashes:
+            self.log.debug("Game status in sync with the cubemaster")
+            return True
+        self.log.info("Game status differs from the cubemaster's. Reconciling.")
+        success = True
+
+        teams_key = cube_game.CubeTeamsStatusList.JSON_ROOT_OBJECT_NAME
+        if bucket_hashes.get(teams_key) != local_bucket_hashes[teams_key]:
+            # also removes the teams the cubemaster no longer has
+            team_names = self.request_all_teams_status_hashes(reply_timeout)
+            if team_names is None:
+                success = False
+            for team_name in team_names or ():
+                # the cubemaster's status of a team is authoritative: don't merge it with ours
+                if not self._request_team_status(team_name, reply_timeout, replace=True):
+                    self.log.error(f"Failed to reconcile the status of team {team_name}")
+                    success = False
+
+        cubeboxes_key = cube_game.CubeboxesStatusList.JSON_ROOT_OBJECT_NAME
+        if bucket_hashes.get(cubeboxes_key) != local_bucket_hashes[cubeboxes_key]:
+            node_names = self.request_all_cubeboxes_status_hashes(reply_timeout)
+            if node_names is None:
+                success = False
+            for node_name in node_names or ():
+                cube_id = cubeid.node_name_to_cubebox_index(node_name)
+                if not self._request_cubebox_status_from_cubemaster(cube_id, reply_timeout):
+                    self.log.error(f"Failed to reconcile the status of {node_name}")
+                    success = False
+
+        if not success:
+            return False
+        # the cubemaster's status may have changed meanwhile: the next reconciliation will catch up
+        if self.game_status.bucket_hashes != bucket_hashes:
+            self.log.warning("Game status still differs from the cubemaster's after the reconciliation")
+            return False
+        self.log.success("Game status reconciled with the cubemaster")
+        return True
 
 def test():
     import atexit